@@ -1,38 +1,80 @@
 import logging
+import logging.handlers
+import queue
+import atexit
 import threading
 import sqlite3
 import requests
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 import json
-from urllib.parse import parse_qs, urlparse
+from urllib.parse import parse_qs, urlparse, unquote
 from datetime import datetime, timedelta
 import secrets
+import heapq
+import socket
 import os
+import stat
 import time
-
-# Настройка логирования с поддержкой Unicode
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('manage.log', encoding='utf-8'),
-        logging.StreamHandler()
-    ]
-)
+import hashlib
+import mimetypes
+from collections import deque
+from contextlib import contextmanager
+import bisect
+import gzip
+import shutil
+import re
+import ipaddress
+import csv
+import io
+import sys
+import socketserver
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow не установлен - миниатюры отдаются в исходном размере
+    Image = None
+
+# Логирование
+LOG_FILE = 'manage.log'
+LOG_MAX_BYTES = 10 * 1024 * 1024  # Ротация manage.log по размеру (10 МБ)
+LOG_BACKUP_COUNT = 5
+LOG_QUEUE_SIZE = 10000  # При переполнении очереди записи отбрасываются, а не блокируют запрос
+BLOCK_LOG_WINDOW = 60  # Окно агрегации повторяющихся предупреждений о блокировках (секунды)
+BLOCK_LOG_MAX_KEYS = 10000  # Максимум отслеживаемых источников предупреждений в окне
+SLOW_QUERY_LOG = 'slow_queries.log'  # Медленные запросы SQLite вместе с EXPLAIN QUERY PLAN
 logger = logging.getLogger(__name__)
+slow_query_logger = logging.getLogger('slow_sql')
 
 # Конфигурация
 SERVER_PORT = 8080
+SERVER_UNIX_SOCKET = None  # Путь к Unix-сокету (например '/run/clanbenz/http.sock') - слушать его вместо TCP-порта
+SERVER_UNIX_SOCKET_MODE = 0o660  # Права на сокет: доступ только владельцу и группе прокси
 DATABASE_NAME = "clan_benz.db"
 MANAGE_PASSWORD = "admin123"
 
 # Ограничения посещений
 VISIT_LIMIT = 15  # Максимум 15 посещений в минуту
 VISIT_BLOCK_TIME = 60  # Блокировка на 1 минуту при превышении
+APPLICATION_INTERVAL = 3600  # Одна заявка с IP не чаще раза в час
+# Классы ограничений: бюджет стоимости запросов в минуту, у каждого класса свой.
+# Стоимость задает маршрут (cost): страница стоит 4, поэтому в 'static' по-прежнему VISIT_LIMIT страниц,
+# а кэшированные данные по 1 не вытесняют обычный просмотр. Превышение блокирует только этот класс.
+RATE_LIMIT_CLASSES = {
+    'static': VISIT_LIMIT * 4,  # Страницы и кэшируемые данные
+    'api': 30,  # Публичные JSON-эндпоинты с запросами к базам
+    'write': 10,  # Изменяющие запросы: заявка, вход в админку
+    'admin': 120  # Админка без действующей сессии (сессии - см. PROTECTION_ALLOWLIST_ADMINS)
+}
+PAGE_COST = 4
+# Классы, которые считаются алгоритмом GCRA (ведро токенов) в памяти вместо скользящего окна по request_logs:
+# скорость - бюджет класса в минуту, плюс всплеск до RATE_LIMIT_BURST единиц стоимости без ожидания
+RATE_LIMIT_GCRA_CLASSES = ()  # например ('static', 'api')
+RATE_LIMIT_BURST = {'static': PAGE_COST * 5, 'api': 10, 'write': 5, 'admin': 40}
 
 # Глобальные переменные для управления
 server_httpd = None
 server_thread = None
+log_queue_handler = None  # Создается setup_logging() при запуске
 
 # Режим технического обслуживания
 MAINTENANCE_MODE = False
@@ -44,14 +86,104 @@ visits_count = 0
 unique_visitors = set()
 
 # Сессии для админ панели
-admin_sessions = {}
+ADMIN_SESSION_LIFETIME = 3600  # Время жизни сессии без активности (1 час)
+ADMIN_SESSION_SWEEP_INTERVAL = 60  # Период фоновой очистки просроченных сессий
+ADMIN_SESSIONS_FILE = "admin_sessions.json"  # None - сессии не переживают перезапуск
 
 # Защита от DDoS атак
 ddos_protection_db = "ddos_protection.db"
-REQUEST_LIMIT = 100  # 100 запросов в минуту для DDoS защиты
+# DDoS-лимит - стоимость запросов всех классов в минуту. Он не ниже суммы бюджетов классов с их всплесками:
+# клиент, уложившийся в каждый бюджет, не должен получать блокировку всего сайта на BLOCK_TIME
+REQUEST_LIMIT = sum(RATE_LIMIT_CLASSES.values()) + sum(RATE_LIMIT_BURST.values())
 BLOCK_TIME = 300  # Блокировка на 5 минут для DDoS
+DB_BUSY_TIMEOUT = 2.0  # Сколько запрос ждет, пока другой поток пишет в базу (секунды)
+PROTECTION_FAIL_CLOSED = True  # База защиты занята дольше DB_BUSY_TIMEOUT - отвечать 503, а не пропускать запрос
+PROTECTION_BUSY_RETRY_AFTER = 5  # Retry-After в ответе 503 при занятой базе защиты
+# Лимиты считаются по подсети клиента: смена адреса внутри нее не дает нового лимита
+RATE_LIMIT_IPV4_PREFIX = 32  # 32 - каждый адрес отдельно, 24 - вся подсеть /24
+RATE_LIMIT_IPV6_PREFIX = 64  # 64 или 56 (от 1 до 64)
 ip_request_times = {}
 
+# Работа за обратным прокси (nginx)
+TRUSTED_PROXIES = ()  # IP и подсети прокси, например ('127.0.0.1', '10.0.0.0/8'); Unix-сокет доверенный всегда
+PROXY_CLIENT_IP_HEADER = 'X-Forwarded-For'  # Заголовок, который выставляет прокси: 'X-Forwarded-For' или 'Forwarded'
+PROXY_PROTOCOL = False  # Доверенные прокси начинают соединение строкой PROXY protocol v1
+PROXY_HEADER_TIMEOUT = 5  # Сколько ждать строку PROXY protocol (секунды)
+
+# Адаптивные пороги: с ростом нагрузки лимиты ужесточаются и блокировки удлиняются, со спадом - обратно
+ADAPTIVE_THRESHOLDS_ENABLED = False
+ADAPTIVE_RPS_CAPACITY = 200  # Запросов в секунду, которые сервер держит без деградации
+ADAPTIVE_MAX_IN_FLIGHT = 64  # Одновременно обрабатываемых запросов
+ADAPTIVE_LATENCY_TARGET = 0.25  # Целевой p95 длительности запроса (секунды)
+ADAPTIVE_INTERVAL = 1.0  # Пересчет уровня нагрузки не чаще раза в столько секунд
+ADAPTIVE_COOLDOWN = 30  # Сколько нагрузка держится ниже порога выхода, прежде чем уровень понизится
+ADAPTIVE_LEVELS = (
+    # (порог входа, порог выхода, множитель лимитов, множитель времени блокировки)
+    (0.0, 0.0, 1.0, 1),  # Обычная нагрузка
+    (0.7, 0.5, 0.7, 2),  # Повышенная
+    (1.0, 0.8, 0.5, 4),  # Перегрузка
+    (1.5, 1.2, 0.3, 8)  # Атака
+)
+
+# Доверенные клиенты без учета лимитов (проверка в памяти до обращения к SQLite)
+PROTECTION_ALLOWLIST = ()  # IP и подсети мониторинга и проверок здоровья, например ('10.0.5.0/24',)
+PROTECTION_ALLOWLIST_ADMINS = True  # Запросы с действующей сессией администратора тоже не учитываются
+
+# Обнаружение тяжелых источников трафика (Count-Min Sketch + top-K в фиксированной памяти)
+HEAVY_HITTER_ENABLED = True
+HEAVY_HITTER_DIMENSIONS = ('prefix', 'user_agent', 'path', 'prefix+path', 'user_agent+path')
+HEAVY_HITTER_IPV4_PREFIX = 24  # Подсети для измерения 'prefix'
+HEAVY_HITTER_IPV6_PREFIX = 48
+HEAVY_HITTER_WINDOW = 60  # Окно подсчета (секунды); сравнение идет с предыдущим окном
+HEAVY_HITTER_SKETCH_WIDTH = 2048
+HEAVY_HITTER_SKETCH_DEPTH = 4
+HEAVY_HITTER_TOP_K = 20
+HEAVY_HITTER_MIN_REQUESTS = 300  # Тяжелый источник: не меньше стольких запросов за окно,
+HEAVY_HITTER_MIN_SHARE = 0.2  # не меньше такой доли всех запросов окна
+HEAVY_HITTER_SPIKE_FACTOR = 3  # и во столько раз больше, чем в предыдущем окне
+HEAVY_HITTER_AUTO_BLOCK = False  # Блокировать подсеть-источник (измерения с 'prefix') через ручные блокировки
+HEAVY_HITTER_BLOCK_HOURS = 1
+
+# Ограничения тела POST-запросов
+REQUEST_BODY_MAX_SIZE = 64 * 1024  # Размер тела по умолчанию, если маршрут не задает свой
+REQUEST_BODY_TIMEOUT = 10  # Крайний срок чтения всего тела (секунды)
+REQUEST_BODY_CHUNK_SIZE = 16 * 1024
+body_rejections = {'too_large': 0, 'timeout': 0, 'length_required': 0, 'malformed': 0}
+body_rejections_lock = threading.Lock()
+
+# Метрики Prometheus
+METRICS_ALLOWED_IPS = ('127.0.0.1', '::1')  # Кому доступен /metrics
+METRICS_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Трассировка запросов SQLite
+SQL_TRACE_ENABLED = True
+SLOW_QUERY_THRESHOLD = 0.05  # Запросы дольше 50 мс пишутся в SLOW_QUERY_LOG с планом выполнения
+SQL_TRACE_MAX_STATEMENTS = 1000  # Предел числа отслеживаемых шаблонов запросов
+
+# Тайминги фаз обработки запроса
+SERVER_TIMING_ENABLED = False  # Добавлять заголовок Server-Timing в ответы
+SERVER_TIMING_SAMPLES = 2048  # Последние N замеров каждой фазы для перцентилей
+
+# Структурированный журнал доступа
+ACCESS_LOG_ENABLED = True
+ACCESS_LOG_DIR = "access_logs"  # Часовые сегменты access-ГГГГММДД-ЧЧ.ndjson, закрытые сжимаются в .gz
+ACCESS_LOG_QUEUE_SIZE = 50000
+
+# Массовый импорт блокировок
+BLOCKLIST_IMPORT_MAX_SIZE = 16 * 1024 * 1024  # Размер загружаемого списка (и в теле, и из файла)
+BLOCKLIST_IMPORT_DIR = "blocklists"  # Импорт по JSON {"path": ...} читает только имена файлов из этого каталога
+BLOCKLIST_EXPORT_BATCH = 1000  # Строк на одну порцию при потоковой выгрузке
+
+# Выборочный профилировщик
+PROFILER_DIR = "profiles"  # Файлы profile-ГГГГММДД-ЧЧММСС-ммм.collapsed / .top.txt
+PROFILER_INTERVAL = 0.01  # Период снятия стеков всех потоков (секунды)
+PROFILER_MAX_DURATION = 300  # Максимальная длительность одного сеанса
+PROFILER_KEEP_FILES = 20  # Сколько последних профилей хранить на диске
+
+# Порядок стадий обработки запроса (None - по объявленной стоимости, дешевые первыми);
+# 'admin_auth' обязательна, без нее сервер не запустится
+MIDDLEWARE_ORDER = None
+
 # Фотографии для галереи
 GALLERY_IMAGES = [
     "https://i.postimg.cc/tRvPcHPQ/1image.png",
@@ -67,6 +199,162 @@ GALLERY_IMAGES = [
     "https://i.postimg.cc/bNGbcFHS/photo1.jpg"
 ]
 
+# Локальный кэш галереи
+GALLERY_CACHE_DIR = "gallery_cache"
+GALLERY_THUMB_SIZE = (640, 480)  # Миниатюры для горизонтальной ленты
+GALLERY_FETCH_TIMEOUT = 15  # Таймаут загрузки изображения с внешнего хоста
+GALLERY_MAX_IMAGE_SIZE = 20 * 1024 * 1024  # Максимальный размер исходного изображения
+GALLERY_CACHE_MAX_AGE = 31536000  # Кэширование в браузере на 1 год (файлы неизменяемы)
+GALLERY_RETRY_INTERVAL = 300  # Повторная попытка загрузки после ошибки через 5 минут
+gallery_locks = {}
+gallery_fetch_failures = {}
+gallery_locks_guard = threading.Lock()
+
+# Статические файлы
+STATIC_DIR = "static"
+STATIC_CACHE_MAX_AGE = 3600  # Кэширование статики в браузере на 1 час
+STATIC_STAT_INTERVAL = 1.0  # Как часто перепроверять файл на диске (секунды)
+static_file_cache = {}
+static_file_cache_lock = threading.Lock()
+
+
+# ==================== ЛОГИРОВАНИЕ ====================
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler с ограниченной очередью: не ждет места, а считает потерянные записи"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self.dropped_lock = threading.Lock()
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            with self.dropped_lock:
+                self.dropped += 1
+
+
+def setup_logging():
+    """Настройка неблокирующего логирования: запись в файл и консоль в отдельном потоке
+
+    Вызывается при запуске сервера, а не при импорте: импорт модуля не
+    создает файлов журналов и не запускает потоков. Повторный вызов ничего не меняет.
+    """
+    global log_queue_handler
+    if log_queue_handler is not None:
+        return log_queue_handler
+
+    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    file_handler = logging.handlers.RotatingFileHandler(
+        LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+    file_handler.setFormatter(formatter)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+    slow_query_handler = logging.handlers.RotatingFileHandler(
+        SLOW_QUERY_LOG, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+    slow_query_handler.setFormatter(formatter)
+    # Очередь общая: медленные запросы пишутся только в SLOW_QUERY_LOG, остальное - в manage.log и консоль
+    slow_query_handler.addFilter(logging.Filter(slow_query_logger.name))
+    def not_slow_query(record):
+        return record.name != slow_query_logger.name
+
+    file_handler.addFilter(not_slow_query)
+    stream_handler.addFilter(not_slow_query)
+
+    queue_handler = DroppingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+    listener = logging.handlers.QueueListener(queue_handler.queue, file_handler, stream_handler, slow_query_handler)
+    listener.start()
+    # Дописываем очередь в файл при завершении процесса
+    atexit.register(listener.stop)
+
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.INFO)
+    root_logger.addHandler(queue_handler)
+    slow_query_logger.addHandler(queue_handler)
+    slow_query_logger.propagate = False
+    log_queue_handler = queue_handler
+    return queue_handler
+
+
+class BlockLogAggregator:
+    """Агрегация повторяющихся предупреждений о блокировках
+
+    Первое предупреждение по ключу пишется сразу, повторы в течение окна
+    только считаются, по окончании окна пишется одна сводная строка.
+    """
+
+    def __init__(self, window, max_keys):
+        self.window = window
+        self.max_keys = max_keys
+        self.entries = {}  # ключ -> [время начала окна, сообщение, подавлено]
+        self.overflow = 0
+        self.suppressed_total = 0
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+
+    def warning(self, key, message):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and now - entry[0] < self.window:
+                entry[2] += 1
+                self.suppressed_total += 1
+                return
+            if entry is None and len(self.entries) >= self.max_keys:
+                self.overflow += 1
+                self.suppressed_total += 1
+                return
+            previous = entry
+            self.entries[key] = [now, message, 0]
+
+        if previous is not None and previous[2]:
+            logger.warning(f"{previous[1]} (ещё {previous[2]:,} повторов подавлено)")
+        logger.warning(message)
+
+    def flush(self):
+        """Сводка по завершившимся окнам"""
+        now = time.monotonic()
+        summaries = []
+        with self.lock:
+            for key, (started, message, suppressed) in list(self.entries.items()):
+                if now - started >= self.window:
+                    del self.entries[key]
+                    if suppressed:
+                        summaries.append(f"{message} (ещё {suppressed:,} повторов подавлено)")
+            if self.overflow:
+                summaries.append(f"Подавлено ещё {self.overflow:,} предупреждений о блокировках других источников")
+                self.overflow = 0
+
+        for summary in summaries:
+            logger.warning(summary)
+
+    def start_flusher(self):
+        """Периодический вывод сводок в фоне"""
+        def run():
+            while not self.stop_event.wait(self.window):
+                self.flush()
+
+        threading.Thread(target=run, name='block-log-flusher', daemon=True).start()
+
+    def stop(self):
+        """Остановка фонового вывода сводок"""
+        self.stop_event.set()
+
+
+block_log = BlockLogAggregator(BLOCK_LOG_WINDOW, BLOCK_LOG_MAX_KEYS)
+
+
+def get_logging_stats():
+    """Состояние очереди логирования"""
+    return {
+        'queue_size': log_queue_handler.queue.qsize() if log_queue_handler else 0,
+        'queue_capacity': LOG_QUEUE_SIZE,
+        'dropped': log_queue_handler.dropped if log_queue_handler else 0,
+        'suppressed_block_warnings': block_log.suppressed_total
+    }
+
 
 # ==================== РЕЖИМ ТЕХНИЧЕСКОГО ОБСЛУЖИВАНИЯ ====================
 
@@ -103,13 +391,365 @@ def get_maintenance_status():
     return MAINTENANCE_MODE
 
 
+# ==================== МЕТРИКИ ====================
+
+class MetricsRegistry:
+    """Счетчики и гистограммы в формате Prometheus
+
+    Обновление - одно увеличение значения под коротким замком. Экспорт
+    копирует значения под замком и форматирует текст уже без него, так что
+    опрос /metrics не задерживает обработку запросов.
+    """
+
+    def __init__(self):
+        self.definitions = {}  # имя -> (тип, описание, метки, границы корзин)
+        self.counters = {}  # (имя, значения меток) -> число
+        self.histograms = {}  # (имя, значения меток) -> [счетчики корзин, сумма, количество]
+        self.gauges = []  # (имя, описание, метки, функция -> [(значения меток, значение)], тип)
+        self.lock = threading.Lock()
+
+    def counter(self, name, help_text, labels=()):
+        self.definitions[name] = ('counter', help_text, labels, None)
+
+    def histogram(self, name, help_text, labels=(), buckets=None):
+        self.definitions[name] = ('histogram', help_text, labels, tuple(buckets or METRICS_LATENCY_BUCKETS))
+
+    def gauge(self, name, help_text, labels, collect, metric_type='gauge'):
+        """Значения, собираемые в момент экспорта (тип counter - для накопленных счетчиков)"""
+        self.gauges.append((name, help_text, labels, collect, metric_type))
+
+    def inc(self, name, label_values=(), amount=1):
+        key = (name, label_values)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, label_values, value):
+        buckets = self.definitions[name][3]
+        index = bisect.bisect_left(buckets, value)
+        key = (name, label_values)
+        with self.lock:
+            series = self.histograms.get(key)
+            if series is None:
+                series = self.histograms[key] = [[0] * (len(buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    @staticmethod
+    def _format_labels(names, values, extra=None):
+        pairs = [(name, value) for name, value in zip(names, values)]
+        if extra:
+            pairs.append(extra)
+        if not pairs:
+            return ''
+        escaped = []
+        for name, value in pairs:
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            escaped.append(f'{name}="{value}"')
+        return '{' + ','.join(escaped) + '}'
+
+    def render(self):
+        """Текст в формате Prometheus exposition"""
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {key: (list(series[0]), series[1], series[2]) for key, series in self.histograms.items()}
+
+        lines = []
+        for name, (metric_type, help_text, label_names, buckets) in self.definitions.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            if metric_type == 'counter':
+                for (series_name, values), value in counters.items():
+                    if series_name == name:
+                        lines.append(f'{name}{self._format_labels(label_names, values)} {value}')
+            else:
+                for (series_name, values), (counts, total, count) in histograms.items():
+                    if series_name != name:
+                        continue
+                    cumulative = 0
+                    for bound, bucket_count in zip(buckets + (float('inf'),), counts):
+                        cumulative += bucket_count
+                        le = '+Inf' if bound == float('inf') else repr(bound)
+                        lines.append(f'{name}_bucket{self._format_labels(label_names, values, ("le", le))} {cumulative}')
+                    lines.append(f'{name}_sum{self._format_labels(label_names, values)} {total}')
+                    lines.append(f'{name}_count{self._format_labels(label_names, values)} {count}')
+
+        for name, help_text, label_names, collect, metric_type in self.gauges:
+            try:
+                samples = collect()
+            except Exception as e:
+                logger.error(f"Ошибка сбора метрики {name}: {e}")
+                continue
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for values, value in samples:
+                lines.append(f'{name}{self._format_labels(label_names, values)} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = MetricsRegistry()
+METRICS.counter('clan_http_requests_total', 'Запросы по маршрутам, методам и статусам', ('route', 'method', 'status'))
+METRICS.histogram('clan_http_request_duration_seconds', 'Длительность обработки запроса', ('route',))
+METRICS.counter('clan_protection_decisions_total', 'Решения защиты от DDoS и ограничения посещений', ('reason',))
+METRICS.histogram('clan_sqlite_operation_duration_seconds', 'Длительность операций SQLite', ('database',))
+METRICS.counter('clan_heavy_hitter_alerts_total', 'Всплески трафика от одного значения измерения', ('dimension',))
+METRICS.counter('clan_protection_allowlist_hits_total', 'Запросы, пропущенные без учета лимитов', ('match',))
+for _reason in ('allowed', 'visit_limit', 'ddos', 'manual_block', 'allowlisted', 'db_busy'):
+    METRICS.inc('clan_protection_decisions_total', (_reason,), 0)
+for _match in ('address', 'admin_session'):
+    METRICS.inc('clan_protection_allowlist_hits_total', (_match,), 0)
+
+
+class PhaseTimingStats:
+    """Перцентили длительности фаз обработки запроса по последним замерам"""
+
+    def __init__(self, samples):
+        self.samples = samples
+        self.phases = {}  # фаза -> deque последних длительностей
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def record(self, phases):
+        with self.lock:
+            for name, duration in phases.items():
+                window = self.phases.get(name)
+                if window is None:
+                    window = self.phases[name] = deque(maxlen=self.samples)
+                window.append(duration)
+                self.counts[name] = self.counts.get(name, 0) + 1
+
+    def summary(self):
+        """Перцентили по фазам в миллисекундах"""
+        with self.lock:
+            snapshot = {name: sorted(window) for name, window in self.phases.items()}
+            counts = dict(self.counts)
+
+        result = {}
+        for name, values in snapshot.items():
+            last = len(values) - 1
+            result[name] = {
+                'count': counts[name],
+                'p50_ms': round(values[int(last * 0.50)] * 1000, 3),
+                'p95_ms': round(values[int(last * 0.95)] * 1000, 3),
+                'p99_ms': round(values[int(last * 0.99)] * 1000, 3),
+                'max_ms': round(values[last] * 1000, 3)
+            }
+        return result
+
+
+phase_timings = PhaseTimingStats(SERVER_TIMING_SAMPLES)
+
+
+def get_process_memory_bytes():
+    """Резидентная память процесса (RSS)"""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        # Не Linux: пиковое значение из getrusage (килобайты на Linux/BSD)
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+process_start_time = time.time()
+METRICS.gauge('process_resident_memory_bytes', 'Резидентная память процесса', (),
+              lambda: [((), get_process_memory_bytes())])
+METRICS.gauge('process_cpu_seconds_total', 'Процессорное время процесса (user + system)', (),
+              lambda: [((), round(sum(os.times()[:2]), 3))], 'counter')
+METRICS.gauge('process_start_time_seconds', 'Время запуска процесса', (),
+              lambda: [((), process_start_time)])
+METRICS.gauge('clan_queue_depth', 'Длина очередей фоновых писателей', ('queue',),
+              lambda: [(('logging',), get_logging_stats()['queue_size']), (('access_log',), access_log.queue.qsize())])
+METRICS.gauge('clan_queue_dropped_total', 'Записи, отброшенные из-за переполнения очереди', ('queue',),
+              lambda: [(('logging',), get_logging_stats()['dropped']), (('access_log',), access_log.dropped)],
+              'counter')
+METRICS.gauge('clan_manual_blocks_active', 'Действующие ручные блокировки', (),
+              lambda: [((), manual_blocklist.count())])
+METRICS.gauge('clan_gcra_keys', 'Ключи ограничения скорости GCRA в памяти', (),
+              lambda: [((), gcra_limiter.count())])
+METRICS.gauge('clan_protection_load_level', 'Уровень нагрузки адаптивных порогов (0 - обычный)', (),
+              lambda: [((), adaptive_thresholds.level)])
+METRICS.gauge('clan_protection_load_score', 'Нагрузка: максимум отношений RPS, одновременных запросов и p95 к целевым', (),
+              lambda: [((), round(adaptive_thresholds.score, 3))])
+METRICS.gauge('clan_protection_effective_threshold', 'Действующие пороги защиты', ('threshold',),
+              lambda: [((name,), value) for name, value in get_effective_thresholds().items() if name != 'classes'])
+METRICS.gauge('clan_protection_effective_budget', 'Действующие бюджеты классов ограничений в минуту', ('class',),
+              lambda: [((limit_class,), value['budget'])
+                       for limit_class, value in get_effective_thresholds()['classes'].items()])
+METRICS.gauge('clan_admin_sessions_active', 'Действующие сессии администратора', (),
+              lambda: [((), admin_sessions.count_active())])
+METRICS.gauge('clan_rejected_bodies_total', 'Отклоненные тела запросов по причинам', ('reason',),
+              lambda: [((reason,), count) for reason, count in get_body_rejections().items()], 'counter')
+
+
+SQL_LITERAL_PATTERN = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+class SqlTraceStats:
+    """Статистика по шаблонам запросов SQLite: число, суммарное и максимальное время, строки"""
+
+    def __init__(self, max_statements):
+        self.max_statements = max_statements
+        self.statements = {}  # (база, шаблон) -> [число, суммарное время, максимум, строки]
+        self.templates = {}  # текст запроса -> шаблон
+        self.overflow = 0
+        self.lock = threading.Lock()
+
+    def template(self, sql):
+        """Шаблон запроса: пробелы схлопнуты, литералы заменены на ?"""
+        with self.lock:
+            template = self.templates.get(sql)
+        if template is None:
+            template = SQL_LITERAL_PATTERN.sub('?', ' '.join(sql.split()))
+            with self.lock:
+                if len(self.templates) < self.max_statements * 4:
+                    self.templates[sql] = template
+        return template
+
+    def record(self, key, elapsed, rows=0):
+        with self.lock:
+            entry = self.statements.get(key)
+            if entry is None:
+                if len(self.statements) >= self.max_statements:
+                    self.overflow += 1
+                    return
+                entry = self.statements[key] = [0, 0.0, 0.0, 0]
+            entry[0] += 1
+            entry[1] += elapsed
+            if elapsed > entry[2]:
+                entry[2] = elapsed
+            entry[3] += rows
+
+    def add_rows(self, key, rows):
+        with self.lock:
+            entry = self.statements.get(key)
+            if entry is not None:
+                entry[3] += rows
+
+    def top(self, limit=20):
+        """Самые затратные запросы по суммарному времени"""
+        with self.lock:
+            items = [(key, list(entry)) for key, entry in self.statements.items()]
+        items.sort(key=lambda item: item[1][1], reverse=True)
+        return {
+            'statements': [{
+                'database': database,
+                'sql': template,
+                'count': count,
+                'total_ms': round(total * 1000, 3),
+                'avg_ms': round(total * 1000 / count, 3),
+                'max_ms': round(maximum * 1000, 3),
+                'rows': rows
+            } for (database, template), (count, total, maximum, rows) in items[:limit]],
+            'tracked': len(items),
+            'untracked_executions': self.overflow
+        }
+
+
+sql_trace = SqlTraceStats(SQL_TRACE_MAX_STATEMENTS)
+
+
+def log_slow_query(cursor, sql, parameters, elapsed):
+    """Запись медленного запроса вместе с его планом выполнения"""
+    plan = ''
+    if sql.lstrip()[:6].upper() in ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE') or sql.lstrip()[:4].upper() == 'WITH':
+        try:
+            # Обычный курсор, чтобы EXPLAIN не попадал в трассировку
+            rows = sqlite3.Cursor(cursor.connection).execute('EXPLAIN QUERY PLAN ' + sql, parameters).fetchall()
+            plan = '; '.join(str(row[-1]) for row in rows)
+        except sqlite3.Error as e:
+            plan = f'нет плана: {e}'
+    slow_query_logger.warning(f"Медленный запрос {elapsed * 1000:.1f} мс [{cursor.connection.database_label}] "
+                              f"{' '.join(sql.split())} | план: {plan}")
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Курсор SQLite с учетом времени выполнения запросов"""
+
+    trace_key = None
+
+    def _trace(self, sql, parameters, elapsed):
+        database = self.connection.database_label
+        METRICS.observe('clan_sqlite_operation_duration_seconds', (database,), elapsed)
+        if not SQL_TRACE_ENABLED:
+            self.trace_key = None
+            return
+        self.trace_key = (database, sql_trace.template(sql))
+        # Для изменяющих запросов строки - число затронутых, для выборок считаются при fetch
+        sql_trace.record(self.trace_key, elapsed, max(self.rowcount, 0))
+        if elapsed >= SLOW_QUERY_THRESHOLD and parameters is not None:
+            log_slow_query(self, sql, parameters, elapsed)
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._trace(sql, parameters, time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            # Параметры executemany может быть генератором, план для него не строится
+            self._trace(sql, None, time.perf_counter() - start)
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None and self.trace_key is not None:
+            sql_trace.add_rows(self.trace_key, 1)
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        if self.trace_key is not None:
+            sql_trace.add_rows(self.trace_key, len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        if self.trace_key is not None:
+            sql_trace.add_rows(self.trace_key, len(rows))
+        return rows
+
+
+class TimedConnection(sqlite3.Connection):
+    """Соединение SQLite, выдающее курсоры с учетом времени"""
+
+    def __init__(self, database, *args, **kwargs):
+        super().__init__(database, *args, **kwargs)
+        self.database_label = os.path.basename(str(database))
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+
+def db_connect(database):
+    """Открытие соединения с базой данных"""
+    return sqlite3.connect(database, timeout=DB_BUSY_TIMEOUT, factory=TimedConnection)
+
+
+def is_database_busy(error):
+    """Ошибка SQLite из-за того, что база занята другим писателем дольше таймаута"""
+    return isinstance(error, sqlite3.OperationalError) and ('locked' in str(error) or 'busy' in str(error))
+
+
+def log_protection_db_busy(ip_address, error):
+    """Предупреждение о занятой базе защиты; повторы агрегируются как блокировки"""
+    block_log.warning(('protection_db', 'busy'),
+                      f"База защиты занята, запрос от {ip_address} "
+                      f"{'отклонен' if PROTECTION_FAIL_CLOSED else 'пропущен без проверки'}: {error}")
+
+
 # ==================== БАЗА ДАННЫХ ====================
 
 def init_databases():
     """Инициализация всех баз данных"""
     try:
         # Основная база заявок
-        conn = sqlite3.connect(DATABASE_NAME)
+        conn = db_connect(DATABASE_NAME)
         cursor = conn.cursor()
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS applications (
@@ -139,7 +779,7 @@ def init_databases():
         logger.info("Основная база данных инициализирована")
 
         # База посещений
-        conn = sqlite3.connect(visits_db)
+        conn = db_connect(visits_db)
         cursor = conn.cursor()
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS visits (
@@ -155,8 +795,10 @@ def init_databases():
         logger.info("База посещений инициализирована")
 
         # База для защиты от DDoS и ограничения посещений
-        conn = sqlite3.connect(ddos_protection_db)
+        conn = db_connect(ddos_protection_db)
         cursor = conn.cursor()
+        # Запись на каждый запрос из многих потоков: WAL не блокирует читателей во время записи
+        cursor.execute('PRAGMA journal_mode=WAL')
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS ip_blocks (
                 ip_address TEXT PRIMARY KEY,
@@ -170,14 +812,27 @@ def init_databases():
                 block_expires DATETIME
             )
         ''')
+        # Журнал хранит только последние 2 минуты, поэтому старая схема с текстовым IP просто пересоздается
+        cursor.execute("SELECT name FROM pragma_table_info('request_logs')")
+        columns = {row[0] for row in cursor.fetchall()}
+        if columns and not {'ip_key', 'limit_class', 'cost'} <= columns:
+            cursor.execute('DROP TABLE request_logs')
+            logger.info("Журнал запросов пересоздан с целочисленным ключом подсети")
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS request_logs (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
-                ip_address TEXT NOT NULL,
+                ip_key INTEGER NOT NULL,
                 timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                path TEXT NOT NULL
+                path TEXT NOT NULL,
+                limit_class TEXT NOT NULL DEFAULT 'static',
+                cost REAL NOT NULL DEFAULT 1
             )
         ''')
+        # Покрывающий индекс: сумма стоимости по классу считается без чтения таблицы
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_request_logs_key
+            ON request_logs (ip_key, timestamp, limit_class, cost)
+        ''')
 
         # Таблица для ручной блокировки IP
         cursor.execute('''
@@ -191,58 +846,309 @@ def init_databases():
                 expires_at DATETIME
             )
         ''')
+        # Массовый импорт деактивирует прежние блокировки по адресу - без индекса это полный просмотр на строку
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_manual_blocks_ip ON manual_blocks (ip_address, is_active)')
 
         conn.commit()
         conn.close()
         logger.info("База защиты от DDoS и ограничения посещений инициализирована")
 
+        manual_blocklist.load()
+        ddos_blocks.load()
+
     except Exception as e:
         logger.error(f"Ошибка инициализации баз данных: {e}")
 
 
-def is_ip_manually_blocked(ip_address):
-    """Проверяет, заблокирован ли IP вручную"""
-    try:
-        conn = sqlite3.connect(ddos_protection_db)
-        cursor = conn.cursor()
+IPV4_MAPPED_PREFIX = b'\x00' * 10 + b'\xff\xff'
+
+
+def ip_to_int(ip_address):
+    """Адрес в виде (версия, целое число); IPv4-mapped IPv6 сводится к IPv4
+
+    Быстрее ipaddress.ip_address, вызывается на каждом запросе. Для
+    некорректной строки выбрасывает OSError.
+    """
+    if ':' in ip_address:
+        packed = socket.inet_pton(socket.AF_INET6, ip_address.split('%', 1)[0])
+        if packed[:12] == IPV4_MAPPED_PREFIX:
+            return 4, int.from_bytes(packed[12:], 'big')
+        return 6, int.from_bytes(packed, 'big')
+    return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, ip_address), 'big')
+
+
+def parse_block_target(text):
+    """Нормализация цели блокировки: одиночный IP или подсеть CIDR (IPv4/IPv6)
+
+    Подсеть с полной длиной префикса (/32, /128) сводится к одиночному адресу.
+    Для некорректного значения выбрасывает ValueError.
+    """
+    text = text.strip()
+    if '/' not in text:
+        address = ipaddress.ip_address(text)
+        if address.version == 6 and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        return str(address)
+    network = ipaddress.ip_network(text, strict=False)
+    if network.prefixlen == network.max_prefixlen:
+        return str(network.network_address)
+    return str(network)
+
+
+def rate_limit_key(ip_address):
+    """Ключ учета лимитов: (целое число для request_logs, подпись для ip_blocks и журналов)
+
+    Адрес сводится к подсети RATE_LIMIT_IPV4_PREFIX / RATE_LIMIT_IPV6_PREFIX.
+    IPv4 - число меньше 2**32, IPv6 - старшие 64 бита адреса со знаком
+    (помещаются в INTEGER SQLite). Совпасть с IPv4 могут только префиксы из
+    зарезервированной ::/32, глобальных адресов там нет.
+    """
+    version, value = ip_to_int(ip_address)
+    if version == 4:
+        shift = 32 - RATE_LIMIT_IPV4_PREFIX
+        key = value >> shift << shift
+        if not shift:
+            return key, socket.inet_ntop(socket.AF_INET, key.to_bytes(4, 'big'))
+        return key, f"{socket.inet_ntop(socket.AF_INET, key.to_bytes(4, 'big'))}/{RATE_LIMIT_IPV4_PREFIX}"
+
+    shift = 64 - RATE_LIMIT_IPV6_PREFIX
+    prefix = value >> 64 >> shift << shift
+    label = f"{socket.inet_ntop(socket.AF_INET6, (prefix << 64).to_bytes(16, 'big'))}/{RATE_LIMIT_IPV6_PREFIX}"
+    return (prefix - (1 << 64) if prefix >> 63 else prefix), label
+
+
+class PrefixTrie:
+    """Двоичное дерево префиксов для поиска самого длинного совпадающего префикса
+
+    Узел - список [потомок 0, потомок 1, значение]. Поиск проходит не больше
+    бит, чем длина адреса (32 или 128), сколько бы префиксов ни было в дереве.
+    """
+
+    def __init__(self, bits):
+        self.bits = bits
+        self.root = [None, None, None]
+        self.count = 0
+
+    def insert(self, network, length, value):
+        node = self.root
+        for shift in range(self.bits - 1, self.bits - 1 - length, -1):
+            bit = (network >> shift) & 1
+            if node[bit] is None:
+                node[bit] = [None, None, None]
+            node = node[bit]
+        if node[2] is None:
+            self.count += 1
+        node[2] = value
+
+    def remove(self, network, length):
+        """Удаление префикса; пустые ветви остаются, их немного и они переиспользуются"""
+        node = self.root
+        for shift in range(self.bits - 1, self.bits - 1 - length, -1):
+            node = node[(network >> shift) & 1]
+            if node is None:
+                return False
+        if node[2] is None:
+            return False
+        node[2] = None
+        self.count -= 1
+        return True
 
-        cursor.execute('''
-            SELECT id, block_reason, block_time, expires_at 
-            FROM manual_blocks 
-            WHERE ip_address = ? AND is_active = TRUE
-        ''', (ip_address,))
+    def lookup(self, address):
+        """Значение самого длинного префикса, содержащего адрес, или None"""
+        node = self.root
+        match = node[2]
+        shift = self.bits - 1
+        while shift >= 0:
+            node = node[(address >> shift) & 1]
+            if node is None:
+                break
+            if node[2] is not None:
+                match = node[2]
+            shift -= 1
+        return match
+
+
+class AddressSet:
+    """Набор IP и подсетей из конфигурации с проверкой адреса по деревьям префиксов"""
+
+    def __init__(self, entries=()):
+        self.configure(entries)
+
+    def configure(self, entries):
+        tries = {4: PrefixTrie(32), 6: PrefixTrie(128)}
+        networks = []
+        for entry in entries:
+            try:
+                network = ipaddress.ip_network(parse_block_target(entry), strict=False)
+            except ValueError:
+                logger.error(f"Некорректный адрес или подсеть в конфигурации: {entry}")
+                continue
+            tries[network.version].insert(int(network.network_address), network.prefixlen, True)
+            networks.append(network)
+        self.tries = tries
+        self.networks = networks
+        self.entries = [str(network) for network in networks]
+
+    def __contains__(self, ip_address):
+        if not self.entries:
+            return False
+        try:
+            version, address = ip_to_int(ip_address)
+        except OSError:
+            return False
+        return self.tries[version].lookup(address) is not None
 
-        block = cursor.fetchone()
-        conn.close()
+    def overlaps(self, target):
+        """Пересекается ли адрес или подсеть target хотя бы с одной записью набора"""
+        network = ipaddress.ip_network(parse_block_target(target), strict=False)
+        return any(network.version == entry.version and network.overlaps(entry) for entry in self.networks)
 
-        if block:
-            block_id, reason, block_time, expires_at = block
-
-            # Проверяем срок действия блокировки
-            if expires_at:
-                expires_dt = datetime.fromisoformat(expires_at)
-                if datetime.now() > expires_dt:
-                    # Блокировка истекла, деактивируем её
-                    deactivate_manual_block(block_id)
-                    return False, None
-
-            return True, {
-                'reason': reason,
-                'block_time': block_time,
-                'expires_at': expires_at
-            }
+    def __len__(self):
+        return len(self.entries)
 
-        return False, None
 
-    except Exception as e:
-        logger.error(f"Ошибка проверки ручной блокировки IP: {e}")
+class ManualBlocklist:
+    """Активные ручные блокировки в памяти
+
+    Загружаются из manual_blocks при инициализации баз и обновляются сквозной
+    записью из add_manual_block / remove_manual_block, поэтому проверка IP -
+    поиск в словаре без обращения к базе. Подсети CIDR дополнительно лежат
+    в деревьях префиксов (отдельно IPv4 и IPv6). Сроки блокировок - в min-куче;
+    запись кучи, чья цель с тех пор заблокирована заново, при разборе пропускается.
+    """
+
+    def __init__(self):
+        self.blocks = {}  # IP или подсеть -> {'id', 'reason', 'block_time', 'expires_at', 'expires'}
+        self.tries = {4: PrefixTrie(32), 6: PrefixTrie(128)}
+        self.expiry_heap = []  # (срок, цель, id блокировки)
+        self.lock = threading.Lock()
+
+    def load(self):
+        """Загрузка действующих блокировок из базы"""
+        conn = db_connect(ddos_protection_db)
+        try:
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT id, ip_address, block_reason, block_time, expires_at
+                FROM manual_blocks
+                WHERE is_active = TRUE
+                ORDER BY id
+            ''')
+            rows = cursor.fetchall()
+        finally:
+            conn.close()
+
+        with self.lock:
+            self.blocks = {}
+            self.tries = {4: PrefixTrie(32), 6: PrefixTrie(128)}
+            self.expiry_heap = []
+            skipped = 0
+            for block_id, target, reason, block_time, expires_at in rows:
+                # Старые строки могли сохраниться без проверки цели: одна битая не отменяет остальные
+                try:
+                    self._put(target, block_id, reason, block_time, expires_at)
+                except (TypeError, ValueError) as e:
+                    skipped += 1
+                    logger.error(f"Ручная блокировка #{block_id} пропущена: некорректная запись {target!r} ({e})")
+        logger.info(f"Загружено активных ручных блокировок: {len(self.blocks)}"
+                    f"{f', пропущено некорректных: {skipped}' if skipped else ''}")
+
+    def _put(self, target, block_id, reason, block_time, expires_at):
+        # Разбор до изменения структур: при ошибке ничего не добавляется
+        expires = datetime.fromisoformat(expires_at) if expires_at else None
+        network = ipaddress.ip_network(target, strict=False) if '/' in target else None
+        self.blocks[target] = {'id': block_id, 'target': target, 'reason': reason, 'block_time': block_time,
+                               'expires_at': expires_at, 'expires': expires}
+        if network is not None:
+            self.tries[network.version].insert(int(network.network_address), network.prefixlen, target)
+        if expires is not None:
+            heapq.heappush(self.expiry_heap, (expires, target, block_id))
+
+    def _drop(self, target):
+        if self.blocks.pop(target, None) is not None and '/' in target:
+            network = ipaddress.ip_network(target, strict=False)
+            self.tries[network.version].remove(int(network.network_address), network.prefixlen)
+
+    def add(self, target, block_id, reason, block_time, expires_at):
+        with self.lock:
+            self._drop(target)
+            self._put(target, block_id, reason, block_time, expires_at)
+
+    def remove(self, target):
+        with self.lock:
+            self._drop(target)
+
+    def _match(self, ip_address):
+        """Цель блокировки для IP: точный адрес, затем самая узкая подсеть"""
+        if ip_address in self.blocks:
+            return ip_address
+        if not (self.tries[4].count or self.tries[6].count):
+            return None
+        try:
+            version, address = ip_to_int(ip_address)
+        except OSError:
+            return None
+        return self.tries[version].lookup(address)
+
+    def get(self, ip_address):
+        """Действующая блокировка IP или None; истекшие снимаются из памяти"""
+        while True:
+            target = self._match(ip_address)
+            entry = self.blocks.get(target) if target is not None else None
+            if entry is None:
+                return None
+            if entry['expires'] is None or datetime.now() <= entry['expires']:
+                return entry
+
+            # Истекла - снимаем и ищем более широкую подсеть
+            with self.lock:
+                expired = self.blocks.get(target) is entry
+                if expired:
+                    self._drop(target)
+            if expired:
+                deactivate_manual_block(entry['id'])
+
+    def sweep(self):
+        """Снятие истекших блокировок из памяти по куче сроков"""
+        now = datetime.now()
+        removed = 0
+        with self.lock:
+            while self.expiry_heap and self.expiry_heap[0][0] <= now:
+                _, target, block_id = heapq.heappop(self.expiry_heap)
+                entry = self.blocks.get(target)
+                if entry is not None and entry['id'] == block_id:
+                    self._drop(target)
+                    removed += 1
+        return removed
+
+    def count(self):
+        return len(self.blocks)
+
+    def count_networks(self):
+        return self.tries[4].count + self.tries[6].count
+
+
+manual_blocklist = ManualBlocklist()
+
+
+def is_ip_manually_blocked(ip_address):
+    """Проверяет, заблокирован ли IP вручную (по словарю в памяти)"""
+    block = manual_blocklist.get(ip_address)
+    if block is None:
         return False, None
 
+    return True, {
+        'target': block['target'],
+        'reason': block['reason'],
+        'block_time': block['block_time'],
+        'expires_at': block['expires_at']
+    }
+
 
 def deactivate_manual_block(block_id):
     """Деактивирует ручную блокировку"""
     try:
-        conn = sqlite3.connect(ddos_protection_db)
+        conn = db_connect(ddos_protection_db)
         cursor = conn.cursor()
 
         cursor.execute('''
@@ -260,9 +1166,9 @@ def deactivate_manual_block(block_id):
 
 
 def add_manual_block(ip_address, blocked_by, reason=None, expires_hours=None):
-    """Добавляет ручную блокировку IP"""
+    """Добавляет ручную блокировку IP или подсети (см. parse_block_target)"""
     try:
-        conn = sqlite3.connect(ddos_protection_db)
+        conn = db_connect(ddos_protection_db)
         cursor = conn.cursor()
 
         expires_at = None
@@ -282,6 +1188,9 @@ def add_manual_block(ip_address, blocked_by, reason=None, expires_hours=None):
             (ip_address, blocked_by, block_reason, expires_at)
             VALUES (?, ?, ?, ?)
         ''', (ip_address, blocked_by, reason, expires_at))
+        block_id = cursor.lastrowid
+        cursor.execute('SELECT block_time FROM manual_blocks WHERE id = ?', (block_id,))
+        block_time = cursor.fetchone()[0]
 
         # Также обновляем основную таблицу блокировок
         cursor.execute('''
@@ -292,6 +1201,7 @@ def add_manual_block(ip_address, blocked_by, reason=None, expires_hours=None):
 
         conn.commit()
         conn.close()
+        manual_blocklist.add(ip_address, block_id, reason, block_time, expires_at)
 
         logger.info(f"IP {ip_address} заблокирован вручную. Причина: {reason}")
         return True
@@ -304,7 +1214,7 @@ def add_manual_block(ip_address, blocked_by, reason=None, expires_hours=None):
 def remove_manual_block(ip_address):
     """Удаляет ручную блокировку IP"""
     try:
-        conn = sqlite3.connect(ddos_protection_db)
+        conn = db_connect(ddos_protection_db)
         cursor = conn.cursor()
 
         # Деактивируем ручные блокировки
@@ -323,6 +1233,7 @@ def remove_manual_block(ip_address):
 
         conn.commit()
         conn.close()
+        manual_blocklist.remove(ip_address)
 
         logger.info(f"Ручная блокировка IP {ip_address} снята")
         return True
@@ -332,10 +1243,116 @@ def remove_manual_block(ip_address):
         return False
 
 
+def parse_expires_hours(value):
+    """Срок блокировки в часах: None или '' - бессрочно, иначе целое больше нуля (ValueError)"""
+    if value is None or value == '':
+        return None
+    try:
+        hours = int(value)
+    except TypeError:
+        raise ValueError(f'некорректный срок блокировки: {value!r}')
+    if hours <= 0:
+        raise ValueError(f'срок блокировки должен быть больше нуля: {hours}')
+    return hours
+
+
+def resolve_blocklist_path(name):
+    """Путь к файлу списка в BLOCKLIST_IMPORT_DIR или None
+
+    Принимается только относительное имя внутри каталога: абсолютные пути,
+    компоненты .. и ссылки, ведущие наружу, отклоняются.
+    """
+    if not BLOCKLIST_IMPORT_DIR or not isinstance(name, str) or not name or os.path.isabs(name):
+        return None
+    if '..' in name.replace('\\', '/').split('/'):
+        return None
+    import_root = os.path.realpath(BLOCKLIST_IMPORT_DIR)
+    file_path = os.path.realpath(os.path.join(import_root, name))
+    if os.path.commonpath([import_root, file_path]) != import_root or file_path == import_root:
+        return None
+    return file_path
+
+
+def bulk_add_manual_blocks(entries, blocked_by):
+    """Массовое добавление блокировок одной транзакцией
+
+    entries - словарь цель (IP или подсеть) -> (причина, срок в часах или None).
+    Возвращает число добавленных блокировок. Срок не больше нуля - ValueError.
+    """
+    if not entries:
+        return 0
+    now = datetime.now()
+    rows = []
+    for target, (reason, expires_hours) in entries.items():
+        if expires_hours is not None and expires_hours <= 0:
+            raise ValueError(f'срок блокировки {target} должен быть больше нуля: {expires_hours}')
+        expires_at = (now + timedelta(hours=expires_hours)).isoformat() if expires_hours else None
+        rows.append((target, blocked_by, reason, expires_at))
+
+    conn = db_connect(ddos_protection_db)
+    try:
+        cursor = conn.cursor()
+        # Блокировка записи до чтения MAX(id): параллельная вставка не попадет в выборку добавленных
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('SELECT COALESCE(MAX(id), 0) FROM manual_blocks')
+        last_id = cursor.fetchone()[0]
+
+        cursor.executemany('''
+            UPDATE manual_blocks SET is_active = FALSE WHERE ip_address = ? AND is_active = TRUE
+        ''', ((row[0],) for row in rows))
+        cursor.executemany('''
+            INSERT INTO manual_blocks (ip_address, blocked_by, block_reason, expires_at)
+            VALUES (?, ?, ?, ?)
+        ''', rows)
+        cursor.executemany('''
+            INSERT OR REPLACE INTO ip_blocks
+            (ip_address, block_start_time, is_blocked, block_reason, is_manual_block, blocked_by, block_expires)
+            VALUES (?, ?, TRUE, ?, TRUE, ?, ?)
+        ''', ((target, now.isoformat(), f'manual: {reason}', blocked_by, expires_at)
+              for target, blocked_by, reason, expires_at in rows))
+
+        cursor.execute('''
+            SELECT id, ip_address, block_reason, block_time, expires_at
+            FROM manual_blocks WHERE id > ?
+        ''', (last_id,))
+        added = cursor.fetchall()
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    for block_id, target, reason, block_time, expires_at in added:
+        manual_blocklist.add(target, block_id, reason, block_time, expires_at)
+    logger.info(f"Массовый импорт: заблокировано {len(added)} адресов и подсетей ({blocked_by})")
+    return len(added)
+
+
+def iter_manual_blocks(batch_size=BLOCKLIST_EXPORT_BATCH):
+    """Потоковое чтение активных блокировок порциями"""
+    conn = db_connect(ddos_protection_db)
+    try:
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT ip_address, block_reason, blocked_by, block_time, expires_at
+            FROM manual_blocks
+            WHERE is_active = TRUE
+            ORDER BY id
+        ''')
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        conn.close()
+
+
 def get_manual_blocks():
     """Получает список всех активных ручных блокировок"""
     try:
-        conn = sqlite3.connect(ddos_protection_db)
+        conn = db_connect(ddos_protection_db)
         cursor = conn.cursor()
 
         cursor.execute('''
@@ -350,6 +1367,7 @@ def get_manual_blocks():
             blocks.append({
                 'id': row[0],
                 'ip_address': row[1],
+                'is_network': '/' in row[1],
                 'blocked_by': row[2],
                 'reason': row[3],
                 'block_time': row[4],
@@ -365,43 +1383,198 @@ def get_manual_blocks():
         return []
 
 
-def check_visit_limit(ip_address, path='/'):
-    """Проверка ограничения посещений (15 в минуту)"""
+class AdaptiveThresholds:
+    """Уровень нагрузки сервера и множители лимитов с гистерезисом
+
+    Нагрузка - максимум из трех отношений: запросы в секунду к
+    ADAPTIVE_RPS_CAPACITY, пик одновременных запросов к ADAPTIVE_MAX_IN_FLIGHT
+    и p95 длительности к ADAPTIVE_LATENCY_TARGET. Уровень повышается сразу,
+    как только нагрузка достигла порога входа следующего уровня, а
+    понижается на один, когда она продержалась ниже порога выхода текущего
+    ADAPTIVE_COOLDOWN секунд - так пороги не колеблются на границе.
+    Пересчет идет по ходу запросов, не чаще ADAPTIVE_INTERVAL.
+
+    Ожидание тела запроса от клиента не входит ни в длительность, ни в число
+    одновременных запросов, а запросы, отклоненные при чтении тела, не
+    попадают в p95: иначе медленные клиенты (slowloris) сами поднимали бы
+    уровень.
+    """
+
+    def __init__(self, levels):
+        self.levels = levels
+        self.level = 0
+        self.score = 0.0
+        self.signals = {'rps': 0.0, 'in_flight': 0, 'p95_ms': 0.0}
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.requests = 0
+        self.latencies = []
+        self.last_update = time.monotonic()
+        self.below_since = None
+        self.lock = threading.Lock()
+
+    def request_started(self):
+        with self.lock:
+            self.in_flight += 1
+            if self.in_flight > self.peak_in_flight:
+                self.peak_in_flight = self.in_flight
+
+    def request_finished(self, duration):
+        """Завершение запроса; duration=None - не учитывать длительность в p95"""
+        with self.lock:
+            self.in_flight -= 1
+            self.requests += 1
+            if duration is not None:
+                self.latencies.append(duration)
+            now = time.monotonic()
+            if now - self.last_update >= ADAPTIVE_INTERVAL:
+                self._update(now)
+
+    @contextmanager
+    def waiting_for_client(self):
+        """Запрос ждет данных от клиента и на это время не считается одновременно обрабатываемым"""
+        with self.lock:
+            self.in_flight -= 1
+        try:
+            yield
+        finally:
+            self.request_started()
+
+    def refresh(self):
+        """Пересчет без новых запросов (простой сервера тоже снижает уровень)"""
+        with self.lock:
+            now = time.monotonic()
+            if now - self.last_update >= ADAPTIVE_INTERVAL:
+                self._update(now)
+
+    def _update(self, now):
+        latencies = sorted(self.latencies)
+        p95 = latencies[int((len(latencies) - 1) * 0.95)] if latencies else 0.0
+        rps = self.requests / (now - self.last_update)
+        self.signals = {'rps': round(rps, 1), 'in_flight': self.peak_in_flight, 'p95_ms': round(p95 * 1000, 1)}
+        self.score = max(rps / ADAPTIVE_RPS_CAPACITY, self.peak_in_flight / ADAPTIVE_MAX_IN_FLIGHT,
+                         p95 / ADAPTIVE_LATENCY_TARGET)
+        self.requests = 0
+        self.latencies = []
+        self.peak_in_flight = self.in_flight
+        self.last_update = now
+
+        level = self.level
+        while level + 1 < len(self.levels) and self.score >= self.levels[level + 1][0]:
+            level += 1
+        if level > self.level:
+            logger.warning(f"Уровень нагрузки повышен: {self.level} -> {level} (нагрузка {self.score:.2f}, "
+                           f"{self.signals})")
+            self.level = level
+            self.below_since = None
+        elif self.level and self.score < self.levels[self.level][1]:
+            if self.below_since is None:
+                self.below_since = now
+            elif now - self.below_since >= ADAPTIVE_COOLDOWN:
+                logger.info(f"Уровень нагрузки понижен: {self.level} -> {self.level - 1} (нагрузка {self.score:.2f})")
+                self.level -= 1
+                self.below_since = now
+        else:
+            self.below_since = None
+
+    def limit(self, base):
+        """Действующий лимит для базового значения"""
+        if not ADAPTIVE_THRESHOLDS_ENABLED:
+            return base
+        return max(1, round(base * self.levels[self.level][2]))
+
+    def block_time(self, base):
+        """Действующее время блокировки для базового значения (секунды)"""
+        if not ADAPTIVE_THRESHOLDS_ENABLED:
+            return base
+        return round(base * self.levels[self.level][3])
+
+    def get_stats(self):
+        self.refresh()
+        return {
+            'enabled': ADAPTIVE_THRESHOLDS_ENABLED,
+            'level': self.level,
+            'score': round(self.score, 3),
+            'signals': self.signals,
+            'effective': get_effective_thresholds()
+        }
+
+
+adaptive_thresholds = AdaptiveThresholds(ADAPTIVE_LEVELS)
+
+
+def class_budget(limit_class):
+    """Действующий бюджет класса в минуту
+
+    Не меньше стоимости самого дорогого маршрута класса: иначе при
+    ужесточении такой маршрут был бы недоступен даже с первого запроса.
+    """
+    return max(ROUTES.max_cost.get(limit_class, 1), adaptive_thresholds.limit(RATE_LIMIT_CLASSES[limit_class]))
+
+
+def class_burst(limit_class):
+    """Действующий всплеск класса для GCRA, с тем же нижним пределом, что и бюджет"""
+    return max(ROUTES.max_cost.get(limit_class, 1), adaptive_thresholds.limit(RATE_LIMIT_BURST[limit_class]))
+
+
+def get_effective_thresholds():
+    """Действующие сейчас пороги защиты с учетом уровня нагрузки"""
+    return {
+        'request_limit': adaptive_thresholds.limit(REQUEST_LIMIT),
+        'block_time': adaptive_thresholds.block_time(BLOCK_TIME),
+        'visit_block_time': adaptive_thresholds.block_time(VISIT_BLOCK_TIME),
+        'classes': {limit_class: {'budget': class_budget(limit_class), 'burst': class_burst(limit_class)}
+                    for limit_class in RATE_LIMIT_CLASSES}
+    }
+
+
+def _class_block_key(ip_label, limit_class):
+    """Ключ блокировки класса в ip_blocks; блокировка за DDoS хранится под самой подписью подсети"""
+    return f'{ip_label}#{limit_class}'
+
+
+def check_visit_limit(ip_address, path='/', limit_class='static', cost=1):
+    """Проверка ограничения посещений: стоимость запросов класса за минуту в пределах его бюджета"""
     try:
         # Сначала проверяем ручную блокировку
         is_manual_blocked, block_info = is_ip_manually_blocked(ip_address)
         if is_manual_blocked:
-            logger.warning(f"Доступ запрещен: IP {ip_address} заблокирован вручную. Причина: {block_info['reason']}")
+            block_log.warning((ip_address, 'manual_block'),
+                              f"Доступ запрещен: IP {ip_address} заблокирован вручную. Причина: {block_info['reason']}")
             return False, "manual_block"
 
-        conn = sqlite3.connect(ddos_protection_db)
+        # Лимиты считаются по подсети, а не по отдельному адресу
+        ip_key, ip_label = rate_limit_key(ip_address)
+
+        conn = db_connect(ddos_protection_db)
         cursor = conn.cursor()
 
         current_time = datetime.now()
         one_minute_ago = (current_time - timedelta(minutes=1)).isoformat()
 
-        # Проверяем, заблокирован ли IP за превышение лимита посещений
+        # Проверяем блокировки подсети: за DDoS (весь сайт) и за превышение бюджета этого класса
+        block_key = _class_block_key(ip_label, limit_class)
         cursor.execute('''
-            SELECT block_start_time, is_blocked, block_reason FROM ip_blocks 
-            WHERE ip_address = ? AND is_blocked = TRUE AND is_manual_block = FALSE
-        ''', (ip_address,))
+            SELECT ip_address, block_start_time, block_reason FROM ip_blocks 
+            WHERE ip_address IN (?, ?) AND is_blocked = TRUE AND is_manual_block = FALSE
+        ''', (ip_label, block_key))
 
-        blocked_ip = cursor.fetchone()
-
-        if blocked_ip:
-            block_start_time = datetime.fromisoformat(blocked_ip[0])
-            block_reason = blocked_ip[2] if blocked_ip[2] else 'ddos'
+        for blocked_key, block_start, block_reason in cursor.fetchall():
+            block_start_time = datetime.fromisoformat(block_start)
+            block_reason = block_reason if block_reason else 'ddos'
             time_diff = current_time - block_start_time
+            # Блокировка за DDoS длится BLOCK_TIME, за превышение бюджета класса - VISIT_BLOCK_TIME
+            block_time = adaptive_thresholds.block_time(VISIT_BLOCK_TIME if block_reason == 'visit_limit' else BLOCK_TIME)
 
             # Если прошло больше времени блокировки - разблокируем
-            if time_diff.total_seconds() >= VISIT_BLOCK_TIME:
+            if time_diff.total_seconds() >= block_time:
                 cursor.execute('''
                     UPDATE ip_blocks 
                     SET is_blocked = FALSE, request_count = 1 
                     WHERE ip_address = ? AND is_manual_block = FALSE
-                ''', (ip_address,))
+                ''', (blocked_key,))
                 conn.commit()
-                logger.info(f"IP разблокирован после превышения лимита: {ip_address}")
+                logger.info(f"IP разблокирован после превышения лимита: {blocked_key}")
             else:
                 conn.close()
                 # Если заблокирован за превышение лимита посещений
@@ -411,91 +1584,428 @@ def check_visit_limit(ip_address, path='/'):
                 else:
                     return False, "ddos"
 
-        # Подсчитываем все запросы за последнюю минуту
+        # Подсчитываем стоимость запросов класса за последнюю минуту
         cursor.execute('''
-            SELECT COUNT(*) FROM request_logs 
-            WHERE ip_address = ? AND timestamp > ?
-        ''', (ip_address, one_minute_ago))
+            SELECT COUNT(*), COALESCE(SUM(cost), 0) FROM request_logs 
+            WHERE ip_key = ? AND timestamp > ? AND limit_class = ?
+        ''', (ip_key, one_minute_ago, limit_class))
 
-        total_requests = cursor.fetchone()[0]
+        total_requests, used_budget = cursor.fetchone()
+        budget = max(cost, class_budget(limit_class))
 
-        # Если превышен лимит посещений - блокируем IP
-        if total_requests >= VISIT_LIMIT:
+        # Если запрос не укладывается в бюджет класса - блокируем подсеть для этого класса
+        if used_budget + cost > budget:
             cursor.execute('''
                 INSERT OR REPLACE INTO ip_blocks 
                 (ip_address, block_start_time, is_blocked, request_count, block_reason, is_manual_block)
                 VALUES (?, ?, TRUE, ?, 'visit_limit', FALSE)
-            ''', (ip_address, current_time.isoformat(), total_requests))
+            ''', (block_key, current_time.isoformat(), total_requests))
             conn.commit()
             conn.close()
-            logger.warning(f"IP заблокирован за превышение лимита посещений: {ip_address}, запросов: {total_requests}")
+            block_log.warning((ip_label, 'visit_limit', limit_class),
+                              f"IP заблокирован за превышение лимита посещений: {ip_label}, класс {limit_class}, "
+                              f"стоимость {used_budget:g} из {budget}")
             return False, "visit_limit"
 
         # Логируем текущий запрос
         cursor.execute('''
-            INSERT INTO request_logs (ip_address, path, timestamp)
-            VALUES (?, ?, ?)
-        ''', (ip_address, path, current_time.isoformat()))
+            INSERT INTO request_logs (ip_key, path, timestamp, limit_class, cost)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (ip_key, path, current_time.isoformat(), limit_class, cost))
 
         # Обновляем счетчик в ip_blocks
         cursor.execute('''
             INSERT OR REPLACE INTO ip_blocks 
             (ip_address, block_start_time, request_count, is_blocked, block_reason, is_manual_block)
             VALUES (?, ?, ?, FALSE, 'normal', FALSE)
-        ''', (ip_address, current_time.isoformat(), total_requests + 1))
+        ''', (ip_label, current_time.isoformat(), total_requests + 1))
 
         conn.commit()
         conn.close()
 
-        logger.debug(f"Запрос от {ip_address} ({path}), всего запросов за минуту: {total_requests + 1}")
+        logger.debug(f"Запрос от {ip_address} ({path}), стоимость класса {limit_class} с {ip_label} "
+                     f"за минуту: {used_budget + cost:g} из {budget}")
         return True, "allowed"
 
     except Exception as e:
+        if is_database_busy(e):
+            log_protection_db_busy(ip_address, e)
+            return not PROTECTION_FAIL_CLOSED, "db_busy"
         logger.error(f"Ошибка проверки ограничения посещений: {e}")
         return True, "error"
 
 
+class GcraLimiter:
+    """Ограничение скорости по алгоритму GCRA (ведро токенов)
+
+    На ключ хранится одно число - теоретическое время прихода следующего
+    запроса (TAT). Запрос стоимостью c сдвигает TAT на c интервалов и
+    разрешен, если TAT уходит вперед не больше чем на всплеск. Проверка -
+    O(1) в памяти, без журнала запросов и блокировок на фиксированное время.
+    Ключи, у которых ведро снова полное, удаляет sweep().
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self.tat = {}  # (ключ подсети, класс) -> TAT по clock()
+        self.clock = clock
+        self.lock = threading.Lock()
+
+    def check(self, key, rate_per_minute, burst, cost):
+        """(разрешен ли запрос, через сколько секунд его можно повторить)"""
+        interval = 60.0 / rate_per_minute
+        now = self.clock()
+        with self.lock:
+            tat = self.tat.get(key, now)
+            if tat < now:
+                tat = now
+            allow_at = tat + (cost - burst) * interval
+            if allow_at > now:
+                return False, allow_at - now
+            self.tat[key] = tat + cost * interval
+        return True, 0.0
+
+    def remaining(self, key, rate_per_minute, burst):
+        """Сколько единиц стоимости можно потратить прямо сейчас"""
+        interval = 60.0 / rate_per_minute
+        tat = self.tat.get(key)
+        if tat is None:
+            return burst
+        return max(0.0, burst - max(0.0, tat - self.clock()) / interval)
+
+    def sweep(self):
+        """Удаление ключей с полным ведром: для них отсутствие записи равнозначно"""
+        now = self.clock()
+        with self.lock:
+            expired = [key for key, tat in self.tat.items() if tat <= now]
+            for key in expired:
+                del self.tat[key]
+        return len(expired)
+
+    def count(self):
+        return len(self.tat)
+
+
+gcra_limiter = GcraLimiter()
+# DDoS-лимит классов GCRA: REQUEST_LIMIT единиц стоимости в минуту на подсеть, тоже в памяти
+gcra_ddos_limiter = GcraLimiter()
+
+
+class DdosBlocks:
+    """Действующие блокировки подсетей за DDoS в памяти - копия строк ip_blocks с причиной 'ddos'
+
+    Классы GCRA не обращаются к SQLite на каждый запрос, а блокировка за
+    DDoS действует на весь сайт, каким бы классом она ни была выставлена.
+    Поэтому block_for_ddos() пишет и в ip_blocks, и сюда, а при запуске
+    действующие блокировки загружаются из базы.
+    """
+
+    def __init__(self):
+        self.blocks = {}  # подпись подсети -> время начала блокировки
+        self.lock = threading.Lock()
+
+    def load(self):
+        conn = db_connect(ddos_protection_db)
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT ip_address, block_start_time FROM ip_blocks
+            WHERE is_blocked = TRUE AND is_manual_block = FALSE AND block_reason = 'ddos'
+        ''')
+        rows = cursor.fetchall()
+        conn.close()
+        with self.lock:
+            self.blocks = {ip_label: datetime.fromisoformat(started) for ip_label, started in rows}
+
+    def add(self, ip_label, started):
+        with self.lock:
+            self.blocks[ip_label] = started
+
+    def remaining(self, ip_label):
+        """Сколько секунд осталось до конца блокировки (0 - подсеть не заблокирована)"""
+        started = self.blocks.get(ip_label)
+        if started is None:
+            return 0.0
+        return max(0.0, adaptive_thresholds.block_time(BLOCK_TIME) - (datetime.now() - started).total_seconds())
+
+    def sweep(self):
+        with self.lock:
+            expired = [ip_label for ip_label in self.blocks if self.remaining(ip_label) <= 0]
+            for ip_label in expired:
+                del self.blocks[ip_label]
+        return len(expired)
+
+    def count(self):
+        return len(self.blocks)
+
+
+ddos_blocks = DdosBlocks()
+
+
+def block_for_ddos(ip_label, request_count):
+    """Блокировка подсети за DDoS на всех классах: строка ip_blocks и копия в памяти"""
+    current_time = datetime.now()
+    ddos_blocks.add(ip_label, current_time)
+    block_log.warning((ip_label, 'ddos'),
+                      f"IP заблокирован за DDoS: {ip_label}, стоимость запросов: {request_count:g}")
+    conn = db_connect(ddos_protection_db)
+    try:
+        conn.execute('''
+            INSERT OR REPLACE INTO ip_blocks
+            (ip_address, block_start_time, is_blocked, request_count, block_reason, is_manual_block)
+            VALUES (?, ?, TRUE, ?, 'ddos', FALSE)
+        ''', (ip_label, current_time.isoformat(), request_count))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def check_rate_gcra(ip_address, limit_class, cost=1):
+    """Проверка бюджета класса и DDoS-лимита алгоритмом GCRA: (разрешен ли запрос, причина, секунд до повтора)"""
+    try:
+        is_manual_blocked, block_info = is_ip_manually_blocked(ip_address)
+        if is_manual_blocked:
+            block_log.warning((ip_address, 'manual_block'),
+                              f"Доступ запрещен: IP {ip_address} заблокирован вручную. Причина: {block_info['reason']}")
+            return False, "manual_block", 0.0
+
+        ip_key, ip_label = rate_limit_key(ip_address)
+
+        # Блокировка за DDoS (в том числе выставленная классами скользящего окна)
+        block_left = ddos_blocks.remaining(ip_label)
+        if block_left > 0:
+            return False, "ddos", block_left
+
+        # Всплеск не меньше стоимости запроса, иначе при ужесточении маршрут стал бы недоступен совсем
+        rate = class_budget(limit_class)
+        burst = max(cost, class_burst(limit_class))
+        allowed, retry_after = gcra_limiter.check((ip_key, limit_class), rate, burst, cost)
+        if not allowed:
+            block_log.warning((ip_label, 'visit_limit', limit_class),
+                              f"Запрос отклонен по лимиту скорости: {ip_label}, класс {limit_class}, "
+                              f"повтор через {retry_after:.1f} с")
+            return False, "visit_limit", retry_after
+
+        # DDoS-лимит: стоимость запросов классов GCRA за минуту (классы окна считает check_ddos_protection)
+        ddos_limit = adaptive_thresholds.limit(REQUEST_LIMIT)
+        allowed, _ = gcra_ddos_limiter.check(ip_key, ddos_limit, max(cost, ddos_limit), cost)
+        if not allowed:
+            block_for_ddos(ip_label, ddos_limit)
+            return False, "ddos", ddos_blocks.remaining(ip_label)
+        return True, "allowed", 0.0
+
+    except Exception as e:
+        if is_database_busy(e):
+            # Блокировка уже действует в памяти, не записалась только строка ip_blocks
+            log_protection_db_busy(ip_address, e)
+            return False, "ddos", ddos_blocks.remaining(ip_label)
+        logger.error(f"Ошибка проверки лимита скорости: {e}")
+        return True, "error", 0.0
+
+
 def check_ddos_protection(ip_address):
-    """Проверка защиты от DDoS атак (более строгие лимиты)"""
+    """Проверка защиты от DDoS атак (более строгие лимиты): (разрешен ли запрос, причина)"""
     try:
-        conn = sqlite3.connect(ddos_protection_db)
+        ip_key, ip_label = rate_limit_key(ip_address)
+        conn = db_connect(ddos_protection_db)
         cursor = conn.cursor()
 
         current_time = datetime.now()
         one_minute_ago = (current_time - timedelta(minutes=1)).isoformat()
 
-        # Получаем количество запросов за последнюю минуту
+        # Стоимость запросов всех классов за последнюю минуту (по покрывающему индексу)
         cursor.execute('''
-            SELECT COUNT(*) FROM request_logs 
-            WHERE ip_address = ? AND timestamp > ?
-        ''', (ip_address, one_minute_ago))
+            SELECT COALESCE(SUM(cost), 0) FROM request_logs 
+            WHERE ip_key = ? AND timestamp > ?
+        ''', (ip_key, one_minute_ago))
 
         request_count = cursor.fetchone()[0]
 
         # Если превышен DDoS лимит - блокируем IP
-        if request_count >= REQUEST_LIMIT:
-            cursor.execute('''
-                INSERT OR REPLACE INTO ip_blocks 
-                (ip_address, block_start_time, is_blocked, request_count, block_reason, is_manual_block)
-                VALUES (?, ?, TRUE, ?, 'ddos', FALSE)
-            ''', (ip_address, current_time.isoformat(), request_count))
-            conn.commit()
+        if request_count >= adaptive_thresholds.limit(REQUEST_LIMIT):
             conn.close()
-            logger.warning(f"IP заблокирован за DDoS: {ip_address}, запросов: {request_count}")
-            return False
+            block_for_ddos(ip_label, request_count)
+            return False, "ddos"
 
         conn.close()
-        return True
+        return True, "allowed"
 
     except Exception as e:
+        if is_database_busy(e):
+            log_protection_db_busy(ip_address, e)
+            return not PROTECTION_FAIL_CLOSED, "db_busy"
         logger.error(f"Ошибка проверки DDoS защиты: {e}")
-        return True
+        return True, "error"
+
+
+# ==================== ТЯЖЕЛЫЕ ИСТОЧНИКИ ТРАФИКА ====================
+
+def network_label(ip_address, ipv4_prefix, ipv6_prefix):
+    """Подсеть адреса в виде '203.0.113.0/24'"""
+    version, value = ip_to_int(ip_address)
+    if version == 4:
+        shift = 32 - ipv4_prefix
+        address = socket.inet_ntop(socket.AF_INET, (value >> shift << shift).to_bytes(4, 'big'))
+        return f'{address}/{ipv4_prefix}'
+    shift = 128 - ipv6_prefix
+    return f"{socket.inet_ntop(socket.AF_INET6, (value >> shift << shift).to_bytes(16, 'big'))}/{ipv6_prefix}"
+
+
+class CountMinSketch:
+    """Оценка частот в фиксированной памяти: depth строк по width счетчиков
+
+    Оценка - минимум по строкам, поэтому может быть только завышена (на
+    долю от общего числа событий порядка e/width).
+    """
+
+    def __init__(self, width, depth):
+        self.width = width
+        self.seeds = [secrets.randbits(32) for _ in range(depth)]
+        self.rows = [[0] * width for _ in range(depth)]
+
+    def add(self, item):
+        """Учет события, возвращает новую оценку"""
+        estimate = None
+        for seed, row in zip(self.seeds, self.rows):
+            index = hash((seed, item)) % self.width
+            row[index] += 1
+            if estimate is None or row[index] < estimate:
+                estimate = row[index]
+        return estimate
+
+    def estimate(self, item):
+        return min(row[hash((seed, item)) % self.width] for seed, row in zip(self.seeds, self.rows))
+
+
+class HeavyHitterDetector:
+    """Обнаружение всплесков трафика от одного значения измерения (подсеть, User-Agent, путь и их сочетания)
+
+    На каждое измерение - Count-Min Sketch текущего и предыдущего окна и
+    top-K значений по оценке. Значение считается тяжелым, когда за окно оно
+    набрало не меньше HEAVY_HITTER_MIN_REQUESTS запросов и HEAVY_HITTER_MIN_SHARE
+    от всех, и в HEAVY_HITTER_SPIKE_FACTOR раз больше, чем в предыдущем окне.
+    Ботнет, где каждый IP держится ниже лимитов, виден по общей подсети,
+    User-Agent или пути. Память не зависит от числа источников.
+    """
+
+    def __init__(self, dimensions, width, depth, top_k, window):
+        self.dimensions = [(name, tuple(name.split('+'))) for name in dimensions]
+        self.width = width
+        self.depth = depth
+        self.top_k = top_k
+        self.window = window
+        self.alerts = deque(maxlen=100)
+        self.lock = threading.Lock()
+        self.previous = {name: None for name, _ in self.dimensions}
+        self.previous_top = {}
+        self.previous_total = 0
+        self._reset(time.monotonic())
+
+    def _reset(self, now):
+        self.window_start = now
+        self.total = 0
+        self.sketches = {name: CountMinSketch(self.width, self.depth) for name, _ in self.dimensions}
+        self.top = {name: {} for name, _ in self.dimensions}
+        self.alerted = set()
+
+    def _rotate(self, now):
+        if now - self.window_start < self.window:
+            return
+        # Окно, после которого прошло больше одного окна, для сравнения уже не годится
+        recent = now - self.window_start < 2 * self.window
+        self.previous = self.sketches if recent else {name: None for name, _ in self.dimensions}
+        self.previous_top = self.top if recent else {}
+        self.previous_total = self.total if recent else 0
+        self._reset(now)
+
+    def _update_top(self, top, value, estimate):
+        if value in top or len(top) < self.top_k:
+            top[value] = estimate
+            return
+        smallest = min(top, key=top.get)
+        if estimate > top[smallest]:
+            del top[smallest]
+            top[value] = estimate
+
+    def observe(self, ip_address, user_agent, path):
+        """Учет запроса; возвращает подсети, которые нужно заблокировать (при HEAVY_HITTER_AUTO_BLOCK)"""
+        try:
+            prefix = network_label(ip_address, HEAVY_HITTER_IPV4_PREFIX, HEAVY_HITTER_IPV6_PREFIX)
+        except OSError:
+            prefix = ip_address
+        values = {'prefix': prefix, 'user_agent': (user_agent or '-')[:200], 'path': path}
+
+        to_block = []
+        now = time.monotonic()
+        with self.lock:
+            self._rotate(now)
+            self.total += 1
+            threshold = max(HEAVY_HITTER_MIN_REQUESTS, HEAVY_HITTER_MIN_SHARE * self.total)
+            for name, parts in self.dimensions:
+                value = values[parts[0]] if len(parts) == 1 else ' | '.join(values[part] for part in parts)
+                estimate = self.sketches[name].add(value)
+                self._update_top(self.top[name], value, estimate)
+                if estimate < threshold or (name, value) in self.alerted:
+                    continue
+
+                # Без предыдущего окна (после запуска или простоя) сравнивать не с чем
+                previous_sketch = self.previous[name]
+                if previous_sketch is None:
+                    continue
+                previous = previous_sketch.estimate(value)
+                if estimate < HEAVY_HITTER_SPIKE_FACTOR * previous:
+                    continue
+
+                self.alerted.add((name, value))
+                blocked = HEAVY_HITTER_AUTO_BLOCK and 'prefix' in parts
+                self.alerts.append({
+                    'time': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                    'dimension': name,
+                    'value': value,
+                    'estimate': estimate,
+                    'previous': previous,
+                    'total': self.total,
+                    'action': 'block' if blocked else 'alert'
+                })
+                if blocked:
+                    to_block.append((prefix, name, value, estimate))
+                METRICS.inc('clan_heavy_hitter_alerts_total', (name,))
+                logger.warning(f"Всплеск трафика: {name} = {value}, {estimate} запросов за окно "
+                               f"(в прошлом окне {previous}, всего {self.total})")
+        return to_block
+
+    def get_stats(self, limit=10):
+        with self.lock:
+            self._rotate(time.monotonic())
+            top = self.top if self.total else self.previous_top
+            return {
+                'window_seconds': self.window,
+                'window_requests': self.total,
+                'previous_window_requests': self.previous_total,
+                'top': {name: sorted(values.items(), key=lambda item: -item[1])[:limit]
+                        for name, values in top.items()},
+                'alerts': list(self.alerts)[::-1]
+            }
+
+
+heavy_hitters = HeavyHitterDetector(HEAVY_HITTER_DIMENSIONS, HEAVY_HITTER_SKETCH_WIDTH, HEAVY_HITTER_SKETCH_DEPTH,
+                                    HEAVY_HITTER_TOP_K, HEAVY_HITTER_WINDOW)
+
+
+def observe_heavy_hitters(ip_address, user_agent, path):
+    """Учет запроса в детекторе и автоматическая блокировка подсетей-источников"""
+    for target, dimension, value, estimate in heavy_hitters.observe(ip_address, user_agent, path):
+        # Проверяется сама блокируемая подсеть: она не должна задевать наши прокси и разрешенные адреса
+        if (trusted_proxies.overlaps(target) or protection_allowlist.overlaps(target)
+                or manual_blocklist.get(target) is not None):
+            continue
+        reason = f"Всплеск трафика ({dimension}: {value}, {estimate} запросов за {HEAVY_HITTER_WINDOW} с)"
+        if add_manual_block(parse_block_target(target), 'heavy_hitter', reason, HEAVY_HITTER_BLOCK_HOURS):
+            block_log.warning((target, 'heavy_hitter'), f"Подсеть {target} заблокирована автоматически: {reason}")
 
 
 def cleanup_old_logs():
     """Очистка старых логов запросов (старше 2 минут)"""
     try:
-        conn = sqlite3.connect(ddos_protection_db)
+        conn = db_connect(ddos_protection_db)
         cursor = conn.cursor()
 
         two_minutes_ago = (datetime.now() - timedelta(minutes=2)).isoformat()
@@ -506,7 +2016,13 @@ def cleanup_old_logs():
         cursor.execute('DELETE FROM ip_blocks WHERE is_blocked = FALSE AND block_start_time < ?',
                        (two_minutes_ago,))
 
-        # Деактивируем просроченные ручные блокировки
+        # Ключи GCRA с полным ведром и истекшие блокировки за DDoS больше не нужны
+        gcra_limiter.sweep()
+        gcra_ddos_limiter.sweep()
+        ddos_blocks.sweep()
+
+        # Деактивируем просроченные ручные блокировки (в памяти и в базе)
+        manual_blocklist.sweep()
         cursor.execute('''
             UPDATE manual_blocks 
             SET is_active = FALSE 
@@ -524,7 +2040,7 @@ def can_submit_application(ip_address):
     """Проверяет, может ли IP отправить новую заявку (не чаще 1 раза в час)"""
     conn = None
     try:
-        conn = sqlite3.connect(DATABASE_NAME)
+        conn = db_connect(DATABASE_NAME)
         cursor = conn.cursor()
 
         cursor.execute('''
@@ -538,7 +2054,7 @@ def can_submit_application(ip_address):
             last_time = datetime.fromisoformat(result[0])
             time_diff = datetime.now() - last_time
             # Проверяем, прошло ли больше часа
-            if time_diff.total_seconds() < 3600:
+            if time_diff.total_seconds() < APPLICATION_INTERVAL:
                 logger.info(f"IP {ip_address} пытается отправить заявку раньше чем через час")
                 return False
 
@@ -555,7 +2071,7 @@ def can_submit_application(ip_address):
 def update_application_limit(ip_address):
     """Обновляет время последней заявки для IP"""
     try:
-        conn = sqlite3.connect(DATABASE_NAME)
+        conn = db_connect(DATABASE_NAME)
         cursor = conn.cursor()
 
         current_time = datetime.now().isoformat()
@@ -577,7 +2093,7 @@ def save_application(application_data):
     """Сохранение заявки в базу данных"""
     conn = None
     try:
-        conn = sqlite3.connect(DATABASE_NAME)
+        conn = db_connect(DATABASE_NAME)
         cursor = conn.cursor()
         cursor.execute('''
             INSERT INTO applications 
@@ -618,7 +2134,7 @@ def save_application(application_data):
 def save_visit(ip, user_agent, path):
     """Сохранение информации о посещении"""
     try:
-        conn = sqlite3.connect(visits_db)
+        conn = db_connect(visits_db)
         cursor = conn.cursor()
         cursor.execute('''
             INSERT INTO visits (ip_address, user_agent, path)
@@ -638,7 +2154,7 @@ def save_visit(ip, user_agent, path):
 def get_visit_stats():
     """Получение статистики посещений"""
     try:
-        conn = sqlite3.connect(visits_db)
+        conn = db_connect(visits_db)
         cursor = conn.cursor()
 
         cursor.execute('SELECT COUNT(*) FROM visits')
@@ -669,7 +2185,7 @@ def get_visit_stats():
 def get_all_applications():
     """Получение всех заявок"""
     try:
-        conn = sqlite3.connect(DATABASE_NAME)
+        conn = db_connect(DATABASE_NAME)
         cursor = conn.cursor()
         cursor.execute('SELECT * FROM applications ORDER BY timestamp DESC')
         applications = []
@@ -696,7 +2212,7 @@ def get_all_applications():
 def get_statistics():
     """Получение статистики заявок"""
     try:
-        conn = sqlite3.connect(DATABASE_NAME)
+        conn = db_connect(DATABASE_NAME)
         cursor = conn.cursor()
 
         cursor.execute('SELECT COUNT(*) FROM applications')
@@ -727,7 +2243,7 @@ def get_statistics():
 def get_extended_statistics():
     """Получение расширенной статистики"""
     try:
-        conn = sqlite3.connect(DATABASE_NAME)
+        conn = db_connect(DATABASE_NAME)
         cursor = conn.cursor()
 
         # Основная статистика заявок
@@ -785,27 +2301,167 @@ def get_extended_statistics():
         }
 
 
+def get_database_status():
+    """Проверка доступности всех баз данных"""
+    failed = []
+    for database in (DATABASE_NAME, visits_db, ddos_protection_db):
+        try:
+            conn = db_connect(database)
+            conn.cursor().execute('SELECT 1')
+            conn.close()
+        except Exception as e:
+            logger.error(f"База данных {database} недоступна: {e}")
+            failed.append(database)
+    return f"Ошибка: {', '.join(failed)}" if failed else 'Работает'
+
+
+# ==================== СЕССИИ АДМИНИСТРАТОРА ====================
+
+class AdminSessionStore:
+    """Потокобезопасное хранилище сессий администратора
+
+    Сессии хранятся в словаре хэш токена -> срок действия по монотонным часам,
+    сроки дублируются в min-куче, которую периодически разбирает фоновый поток.
+    В куче одна запись на сессию: продление сессии меняет только словарь,
+    а устаревшая запись кучи при извлечении перекладывается с новым сроком.
+    """
+
+    def __init__(self, lifetime, persist_path=None):
+        self.lifetime = lifetime
+        self.persist_path = persist_path
+        self.sessions = {}
+        self.expiry_heap = []
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()  # Запись файла отдельно: проверка сессий не ждет диск
+        self.dirty = False
+        self.stop_event = threading.Event()
+
+    @staticmethod
+    def _hash_token(token):
+        # В памяти и на диске храним только хэш: файл сессий не раскрывает cookie
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    def create(self):
+        """Создание новой сессии, возвращает токен для cookie"""
+        token = secrets.token_hex(16)
+        key = self._hash_token(token)
+        expires = time.monotonic() + self.lifetime
+        with self.lock:
+            self.sessions[key] = expires
+            heapq.heappush(self.expiry_heap, (expires, key))
+        self.save()
+        return token
+
+    def validate(self, token):
+        """Проверка токена с продлением сессии"""
+        key = self._hash_token(token)
+        now = time.monotonic()
+        with self.lock:
+            expires = self.sessions.get(key)
+            if expires is None:
+                return False
+            if expires <= now:
+                # Запись в куче удалит фоновая очистка
+                del self.sessions[key]
+                return False
+            self.sessions[key] = now + self.lifetime
+            self.dirty = True
+            return True
+
+    def revoke(self, token):
+        """Удаление сессии"""
+        with self.lock:
+            removed = self.sessions.pop(self._hash_token(token), None) is not None
+        if removed:
+            self.save()
+
+    def sweep(self):
+        """Удаление просроченных сессий, возвращает их количество"""
+        now = time.monotonic()
+        removed = 0
+        with self.lock:
+            while self.expiry_heap and self.expiry_heap[0][0] <= now:
+                heap_expires, key = heapq.heappop(self.expiry_heap)
+                expires = self.sessions.get(key)
+                if expires is None:
+                    continue
+                if expires > now:
+                    # Сессию продлили после записи в кучу
+                    heapq.heappush(self.expiry_heap, (expires, key))
+                else:
+                    del self.sessions[key]
+                    removed += 1
+        if removed or self.dirty:
+            self.save()
+        return removed
+
+    def count_active(self):
+        """Количество действующих сессий"""
+        now = time.monotonic()
+        with self.lock:
+            return sum(1 for expires in self.sessions.values() if expires > now)
+
+    def save(self):
+        """Сохранение сессий на диск (сроки переводятся в настенное время)"""
+        if not self.persist_path:
+            return
+        # Снимок и запись под одной блокировкой: параллельные сохранения не пишут
+        # общий временный файл одновременно, а последним на диск попадает последний снимок
+        with self.save_lock:
+            with self.lock:
+                offset = time.time() - time.monotonic()
+                data = {key: expires + offset for key, expires in self.sessions.items()}
+                self.dirty = False
+            temp_path = self.persist_path + '.tmp'
+            try:
+                fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    json.dump(data, f)
+                os.replace(temp_path, self.persist_path)
+            except Exception as e:
+                logger.error(f"Ошибка сохранения сессий администратора: {e}")
+
+    def load(self):
+        """Загрузка сохраненных сессий, просроченные отбрасываются"""
+        if not self.persist_path or not os.path.exists(self.persist_path):
+            return
+        try:
+            with open(self.persist_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            offset = time.time() - time.monotonic()
+            now = time.monotonic()
+            with self.lock:
+                for key, wall_expires in data.items():
+                    expires = wall_expires - offset
+                    if expires > now:
+                        self.sessions[key] = expires
+                        heapq.heappush(self.expiry_heap, (expires, key))
+            logger.info(f"Восстановлено сессий администратора: {len(self.sessions)}")
+        except Exception as e:
+            logger.error(f"Ошибка загрузки сессий администратора: {e}")
+
+    def start_sweeper(self, interval):
+        """Запуск фоновой очистки просроченных сессий"""
+        def run():
+            while not self.stop_event.wait(interval):
+                try:
+                    self.sweep()
+                except Exception as e:
+                    logger.error(f"Ошибка очистки сессий администратора: {e}")
+
+        threading.Thread(target=run, name='admin-session-sweeper', daemon=True).start()
+
+
+admin_sessions = AdminSessionStore(ADMIN_SESSION_LIFETIME, ADMIN_SESSIONS_FILE)
+
+
 def check_admin_auth(cookie_header):
     """Проверка авторизации администратора"""
     if not cookie_header:
         return False
 
-    try:
-        cookies = parse_cookies(cookie_header)
-        session_id = cookies.get('admin_session')
-        if session_id and session_id in admin_sessions:
-            # Проверяем время жизни сессии (1 час)
-            session_time = admin_sessions[session_id]
-            if (datetime.now() - session_time).total_seconds() < 3600:
-                # Обновляем время сессии
-                admin_sessions[session_id] = datetime.now()
-                return True
-            else:
-                # Удаляем просроченную сессию
-                del admin_sessions[session_id]
-    except:
-        pass
-    return False
+    session_id = parse_cookies(cookie_header).get('admin_session')
+    return bool(session_id) and admin_sessions.validate(session_id)
 
 
 def parse_cookies(cookie_header):
@@ -820,15 +2476,1099 @@ def parse_cookies(cookie_header):
 
 def create_admin_session():
     """Создание новой сессии администратора"""
-    session_id = secrets.token_hex(16)
-    admin_sessions[session_id] = datetime.now()
-    return session_id
+    return admin_sessions.create()
+
+
+# ==================== ГАЛЕРЕЯ ====================
+
+def get_gallery_image_id(url):
+    """Стабильный идентификатор изображения галереи по его URL"""
+    return hashlib.sha1(url.encode('utf-8')).hexdigest()[:16]
+
+
+def get_gallery_source_url(image_id):
+    """Поиск исходного URL изображения по идентификатору"""
+    for url in GALLERY_IMAGES:
+        if get_gallery_image_id(url) == image_id:
+            return url
+    return None
+
+
+def get_gallery_entries():
+    """Список изображений галереи с локальными URL"""
+    entries = []
+    for url in GALLERY_IMAGES:
+        image_id = get_gallery_image_id(url)
+        entries.append({
+            'id': image_id,
+            'url': f'/gallery/{image_id}',
+            'thumb': f'/gallery/{image_id}/thumb'
+        })
+    return entries
+
+
+def _get_gallery_lock(image_id):
+    """Блокировка на изображение, чтобы один файл не скачивался параллельно"""
+    with gallery_locks_guard:
+        lock = gallery_locks.get(image_id)
+        if lock is None:
+            lock = gallery_locks[image_id] = threading.Lock()
+        return lock
+
+
+def _get_gallery_extension(url):
+    """Расширение файла в кэше по URL источника"""
+    extension = os.path.splitext(urlparse(url).path)[1].lower()
+    if extension not in ('.jpg', '.jpeg', '.png', '.gif', '.webp'):
+        extension = '.jpg'
+    return extension
+
+
+def get_gallery_cache_path(url, thumb=False):
+    """Путь к оригиналу или миниатюре в локальном кэше"""
+    image_id = get_gallery_image_id(url)
+    suffix = '.thumb' if thumb else ''
+    return os.path.join(GALLERY_CACHE_DIR, f"{image_id}{suffix}{_get_gallery_extension(url)}")
+
+
+def fetch_gallery_image(url):
+    """Загрузка изображения в локальный кэш (один раз), возвращает путь к файлу"""
+    cache_path = get_gallery_cache_path(url)
+    if os.path.exists(cache_path):
+        return cache_path
+
+    # Недоступный источник не опрашиваем на каждый запрос
+    failed_at = gallery_fetch_failures.get(url)
+    if failed_at is not None and time.monotonic() - failed_at < GALLERY_RETRY_INTERVAL:
+        return None
+
+    with _get_gallery_lock(get_gallery_image_id(url)):
+        # Пока ждали блокировку, файл мог скачать другой поток
+        if os.path.exists(cache_path):
+            return cache_path
+
+        os.makedirs(GALLERY_CACHE_DIR, exist_ok=True)
+        temp_path = cache_path + '.part'
+        try:
+            with requests.get(url, timeout=GALLERY_FETCH_TIMEOUT, stream=True) as response:
+                response.raise_for_status()
+                # Страница ошибки или заглушка хостинга с кодом 200 не должна попасть в кэш как изображение
+                content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+                if content_type and not content_type.startswith(('image/', 'application/octet-stream')):
+                    raise ValueError(f"ответ не является изображением ({content_type})")
+                downloaded = 0
+                with open(temp_path, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=65536):
+                        downloaded += len(chunk)
+                        if downloaded > GALLERY_MAX_IMAGE_SIZE:
+                            raise ValueError(f"изображение больше {GALLERY_MAX_IMAGE_SIZE} байт")
+                        f.write(chunk)
+            # Атомарная замена: читатели никогда не видят недокачанный файл
+            os.replace(temp_path, cache_path)
+            gallery_fetch_failures.pop(url, None)
+            logger.info(f"Изображение галереи загружено в кэш: {url} ({downloaded} байт)")
+            return cache_path
+        except Exception as e:
+            gallery_fetch_failures[url] = time.monotonic()
+            logger.error(f"Ошибка загрузки изображения галереи {url}: {e}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return None
+
+
+def make_gallery_thumbnail(url):
+    """Создание уменьшенной копии изображения, возвращает путь к миниатюре"""
+    thumb_path = get_gallery_cache_path(url, thumb=True)
+    if os.path.exists(thumb_path):
+        return thumb_path
+
+    source_path = fetch_gallery_image(url)
+    if source_path is None:
+        return None
+    if Image is None:
+        return source_path
+
+    with _get_gallery_lock(get_gallery_image_id(url)):
+        if os.path.exists(thumb_path):
+            return thumb_path
+
+        temp_path = thumb_path + '.part'
+        try:
+            with Image.open(source_path) as image:
+                image_format = image.format
+                image.thumbnail(GALLERY_THUMB_SIZE)
+                if image_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+                    image = image.convert('RGB')
+                image.save(temp_path, format=image_format, optimize=True)
+            os.replace(temp_path, thumb_path)
+            return thumb_path
+        except Exception as e:
+            logger.error(f"Ошибка создания миниатюры {url}: {e}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return source_path
+
+
+def prefetch_gallery_images():
+    """Фоновая загрузка всех изображений галереи и миниатюр"""
+    for url in GALLERY_IMAGES:
+        make_gallery_thumbnail(url)
+    logger.info(f"Кэш галереи подготовлен: {len(GALLERY_IMAGES)} изображений")
+
+
+def parse_range_header(range_header, file_size):
+    """Разбор заголовка Range (один диапазон), возвращает (start, end) или None
+
+    Для неудовлетворимого диапазона выбрасывает ValueError.
+    """
+    if not range_header or not range_header.startswith('bytes='):
+        return None
+
+    ranges = range_header[len('bytes='):].strip()
+    if ',' in ranges:
+        # Несколько диапазонов не поддерживаем - отдаем файл целиком
+        return None
+
+    start_str, sep, end_str = ranges.partition('-')
+    if not sep:
+        return None
+
+    try:
+        if start_str:
+            start = int(start_str)
+            end = int(end_str) if end_str else file_size - 1
+        else:
+            # Суффиксный диапазон: последние N байт
+            start = max(0, file_size - int(end_str))
+            end = file_size - 1
+    except ValueError:
+        # Синтаксически неверный Range игнорируется
+        return None
+
+    if start >= file_size or start > end:
+        raise ValueError("диапазон за пределами файла")
+
+    return start, min(end, file_size - 1)
+
+
+# ==================== СТАТИЧЕСКИЕ ФАЙЛЫ ====================
+
+def resolve_static_path(url_path):
+    """Путь к файлу в STATIC_DIR по URL или None при попытке выйти за пределы каталога"""
+    static_root = os.path.realpath(STATIC_DIR)
+    relative_path = unquote(url_path[len('/static/'):] if url_path.startswith('/static/') else url_path.lstrip('/'))
+    file_path = os.path.realpath(os.path.join(static_root, relative_path))
+    if os.path.commonpath([static_root, file_path]) != static_root or file_path == static_root:
+        return None
+    return file_path
+
+
+def get_static_file_info(file_path, file_stat=None):
+    """Метаданные файла (размер, mtime, ETag, тип) из кэша в памяти
+
+    Файл перепроверяется на диске не чаще раза в STATIC_STAT_INTERVAL секунд,
+    при изменении размера или mtime запись пересчитывается. Для уже открытого
+    файла передается его os.fstat - запись сверяется с ним сразу.
+    """
+    now = time.monotonic()
+    info = static_file_cache.get(file_path)
+    if file_stat is None:
+        if info is not None and now - info['checked_at'] < STATIC_STAT_INTERVAL:
+            return info
+        try:
+            file_stat = os.stat(file_path)
+        except OSError:
+            file_stat = None
+
+    if file_stat is None or not stat.S_ISREG(file_stat.st_mode):
+        with static_file_cache_lock:
+            static_file_cache.pop(file_path, None)
+        return None
+
+    if info is not None and info['size'] == file_stat.st_size and info['mtime_ns'] == file_stat.st_mtime_ns:
+        info['checked_at'] = now
+        return info
+
+    info = {
+        'size': file_stat.st_size,
+        'mtime_ns': file_stat.st_mtime_ns,
+        'last_modified': time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(file_stat.st_mtime)),
+        'etag': f'"{file_stat.st_size:x}-{file_stat.st_mtime_ns:x}"',
+        'content_type': mimetypes.guess_type(file_path)[0] or 'application/octet-stream',
+        'checked_at': now
+    }
+    with static_file_cache_lock:
+        static_file_cache[file_path] = info
+    return info
+
+
+def etag_matches(if_none_match, etag):
+    """Совпадение ETag со списком из If-None-Match (слабое сравнение: префикс W/ не учитывается)"""
+    if if_none_match.strip() == '*':
+        return True
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+# ==================== ТЕЛО ЗАПРОСА ====================
+
+class RequestBodyError(Exception):
+    """Тело запроса отклонено: содержит HTTP-статус и причину для счетчиков"""
+
+    def __init__(self, status, reason, message):
+        super().__init__(message)
+        self.status = status
+        self.reason = reason
+
+
+class UrlencodedBodyParser:
+    """Инкрементальный разбор application/x-www-form-urlencoded по мере чтения"""
+
+    def __init__(self):
+        self.fields = {}
+        self.tail = b''
+
+    def feed(self, chunk):
+        data = self.tail + chunk
+        # Разбираем только завершенные пары, неполный хвост ждет следующего чанка
+        complete, sep, self.tail = data.rpartition(b'&')
+        if sep:
+            self._parse(complete)
+
+    def close(self):
+        self._parse(self.tail)
+        self.tail = b''
+        return self.fields
+
+    def _parse(self, data):
+        if not data:
+            return
+        try:
+            text = data.decode('utf-8')
+        except UnicodeDecodeError:
+            raise RequestBodyError(400, 'malformed', 'Некорректная кодировка данных')
+        # Пустые поля сохраняются: проверка формы сообщает, какое именно поле не заполнено
+        for key, values in parse_qs(text, keep_blank_values=True).items():
+            self.fields.setdefault(key, []).extend(values)
+
+
+class JsonBodyParser:
+    """Накопление JSON-тела (размер уже ограничен) с разбором по завершении"""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, chunk):
+        # Отбрасываем не JSON-объект по первому байту, не дожидаясь всего тела
+        if not self.buffer.strip() and chunk.lstrip()[:1] not in (b'', b'{'):
+            raise RequestBodyError(400, 'malformed', 'Ожидается JSON-объект')
+        self.buffer += chunk
+
+    def close(self):
+        try:
+            data = json.loads(self.buffer.decode('utf-8'))
+        except (UnicodeDecodeError, ValueError):
+            raise RequestBodyError(400, 'malformed', 'Некорректный JSON')
+        if not isinstance(data, dict):
+            raise RequestBodyError(400, 'malformed', 'Ожидается JSON-объект')
+        return data
+
+
+class BlocklistBodyParser:
+    """Построчный разбор списка блокировок по мере чтения
+
+    Строка - IP или подсеть, в формате CSV дополнительно причина и срок в
+    часах: "203.0.113.0/24,сканер,24". Пустые строки и строки с # пропускаются,
+    заголовок CSV распознается по первой колонке.
+    """
+
+    MAX_REPORTED_ERRORS = 20
+
+    def __init__(self, default_reason=None, default_expires_hours=None):
+        self.default_reason = default_reason
+        self.default_expires_hours = default_expires_hours
+        self.entries = {}
+        self.invalid = 0
+        self.invalid_lines = []  # Только номера: содержимое строк в ответ не возвращается
+        self.line_number = 0
+        self.tail = b''
+
+    def feed(self, chunk):
+        lines = (self.tail + chunk).split(b'\n')
+        self.tail = lines.pop()
+        for line in lines:
+            self._parse_line(line)
+
+    def close(self):
+        if self.tail:
+            self._parse_line(self.tail)
+            self.tail = b''
+        return self
+
+    def _parse_line(self, raw):
+        self.line_number += 1
+        try:
+            line = raw.decode('utf-8-sig').strip()
+        except UnicodeDecodeError:
+            raise RequestBodyError(400, 'malformed', 'Некорректная кодировка данных')
+        if not line or line.startswith('#'):
+            return
+
+        fields = [field.strip() for field in next(csv.reader([line]))]
+        if self.line_number == 1 and fields[0].lower() in ('ip', 'ip_address', 'target', 'cidr'):
+            return
+        try:
+            target = parse_block_target(fields[0])
+            reason = fields[1] if len(fields) > 1 and fields[1] else self.default_reason
+            expires_hours = self.default_expires_hours
+            if len(fields) > 2 and fields[2]:
+                expires_hours = parse_expires_hours(fields[2])
+        except ValueError:
+            self.invalid += 1
+            if len(self.invalid_lines) < self.MAX_REPORTED_ERRORS:
+                self.invalid_lines.append(self.line_number)
+            return
+        self.entries[target] = (reason, expires_hours)
+
+
+def count_body_rejection(reason):
+    """Учет отклоненных тел запросов"""
+    with body_rejections_lock:
+        body_rejections[reason] = body_rejections.get(reason, 0) + 1
+
+
+def get_body_rejections():
+    """Счетчики отклоненных тел запросов"""
+    with body_rejections_lock:
+        return dict(body_rejections)
+
+
+# ==================== МАРШРУТИЗАЦИЯ ====================
+
+class Route:
+    """Маршрут и его метаданные"""
+
+    __slots__ = ('methods', 'path', 'handler', 'prefix', 'auth', 'cost', 'limit_class', 'log_visit',
+                 'maintenance_exempt', 'max_body')
+
+    def __init__(self, methods, path, handler, prefix=False, auth=None, cost=1, limit_class=None, log_visit=True,
+                 maintenance_exempt=False, max_body=None):
+        self.methods = methods
+        self.path = path
+        self.handler = handler  # Имя метода ClanRequestHandler
+        self.prefix = prefix
+        self.auth = auth  # None, 'page' (редирект на логин) или 'api' (403)
+        self.cost = cost  # Стоимость запроса в бюджете класса ограничений, 0 - без учета
+        # Класс из RATE_LIMIT_CLASSES; по умолчанию админка - 'admin', остальное - 'static'
+        self.limit_class = limit_class or ('admin' if path.startswith('/admin') else 'static')
+        self.log_visit = log_visit
+        self.maintenance_exempt = maintenance_exempt
+        self.max_body = max_body or REQUEST_BODY_MAX_SIZE  # Максимальный размер тела запроса
+
+
+class RouteTable:
+    """Таблица маршрутов: точные пути в словаре, префиксные группы по первому сегменту пути"""
+
+    def __init__(self):
+        self.exact = {}  # path -> {method: Route}
+        self.prefix_groups = {}  # первый сегмент -> [(prefix, {method: Route})]
+        self.max_cost = {}  # класс ограничений -> стоимость самого дорогого маршрута
+
+    def add(self, route):
+        self.max_cost[route.limit_class] = max(self.max_cost.get(route.limit_class, 0), route.cost)
+        if route.prefix:
+            segment = route.path.strip('/').split('/', 1)[0]
+            group = self.prefix_groups.setdefault(segment, [])
+            for prefix, methods in group:
+                if prefix == route.path:
+                    break
+            else:
+                methods = {}
+                group.append((route.path, methods))
+                group.sort(key=lambda item: len(item[0]), reverse=True)
+        else:
+            methods = self.exact.setdefault(route.path, {})
+
+        for method in route.methods:
+            methods[method] = route
+
+    def resolve(self, method, path):
+        """Поиск маршрута, возвращает (route, разрешенные методы)
+
+        route равен None, если путь неизвестен (пустой набор методов -> 404)
+        или метод не поддерживается (непустой набор -> 405).
+        """
+        methods = self.exact.get(path)
+        if methods is None:
+            segment = path.lstrip('/').split('/', 1)[0]
+            for prefix, group_methods in self.prefix_groups.get(segment, ()):
+                if path.startswith(prefix):
+                    methods = group_methods
+                    break
+            else:
+                return None, ()
+
+        return methods.get(method), methods.keys()
+
+
+ROUTES = RouteTable()
+
+
+def get_route_costs():
+    """Класс ограничений и стоимость каждого маршрута: путь (с * для префиксных) -> описание"""
+    routes = {}
+    entries = [(path, methods) for path, methods in ROUTES.exact.items()]
+    entries += [(prefix + '*', methods) for group in ROUTES.prefix_groups.values() for prefix, methods in group]
+    for path, methods in entries:
+        for method, route_entry in methods.items():
+            routes.setdefault(path, {'methods': [], 'class': route_entry.limit_class, 'cost': route_entry.cost})
+            routes[path]['methods'].append(method)
+    return routes
+
+
+def route(methods, path, **options):
+    """Декоратор регистрации обработчика ClanRequestHandler в таблице маршрутов"""
+    if isinstance(methods, str):
+        methods = (methods,)
+
+    def decorator(func):
+        ROUTES.add(Route(tuple(methods), path, func.__name__, **options))
+        return func
+
+    return decorator
+
+
+class MiddlewareStage:
+    """Стадия конвейера обработки запроса со статистикой выполнения"""
+
+    __slots__ = ('name', 'cost', 'handler', 'can_reject', 'required', 'calls', 'rejections', 'total_time',
+                 'max_time')
+
+    def __init__(self, name, cost, handler, can_reject=True, required=False):
+        self.name = name
+        self.cost = cost  # Объявленная стоимость: 1 - проверка в памяти, 100 - запросы к SQLite
+        self.handler = handler  # Имя метода ClanRequestHandler, возвращает False если ответ уже отправлен
+        self.can_reject = can_reject
+        self.required = required  # Стадию безопасности нельзя исключить через MIDDLEWARE_ORDER
+        self.calls = 0
+        self.rejections = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+
+
+class MiddlewarePipeline:
+    """Конвейер проверок перед обработчиком маршрута
+
+    Стадии, способные отклонить запрос, выполняются по возрастанию стоимости,
+    стадии-наблюдатели (например, запись посещения) - после них.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.order = []
+        self.lock = threading.Lock()
+
+    def add(self, stage):
+        self.stages[stage.name] = stage
+        self.order = sorted(self.stages.values(), key=lambda stage: (not stage.can_reject, stage.cost))
+
+    def configure(self, order=None):
+        """Установка порядка стадий из списка имен (стадии вне списка отключаются)
+
+        Без списка стадии сортируются по объявленной стоимости. Обязательные
+        стадии (авторизация админки) отключить нельзя - их отсутствие в
+        списке является ошибкой конфигурации.
+        """
+        if order is not None:
+            unknown = set(order) - set(self.stages)
+            if unknown:
+                raise ValueError(f"Неизвестные стадии конвейера: {', '.join(sorted(unknown))}")
+            missing = [name for name, stage in self.stages.items() if stage.required and name not in order]
+            if missing:
+                raise ValueError(f"Обязательные стадии конвейера отсутствуют в порядке: {', '.join(missing)}")
+            self.order = [self.stages[name] for name in order]
+        else:
+            self.order = sorted(self.stages.values(), key=lambda stage: (not stage.can_reject, stage.cost))
+
+    def run(self, request_handler, route):
+        """Выполнение стадий, возвращает False если какая-то стадия отклонила запрос"""
+        for stage in self.order:
+            start = time.perf_counter()
+            passed = getattr(request_handler, stage.handler)(route)
+            elapsed = time.perf_counter() - start
+            request_handler.phase_times[stage.name] = elapsed
+
+            with self.lock:
+                stage.calls += 1
+                stage.total_time += elapsed
+                if elapsed > stage.max_time:
+                    stage.max_time = elapsed
+                if not passed:
+                    stage.rejections += 1
+
+            if not passed:
+                request_handler.rejected_by = stage.name
+                return False
+        return True
+
+    def get_stats(self):
+        """Статистика стадий в порядке выполнения"""
+        with self.lock:
+            return [{
+                'name': stage.name,
+                'cost': stage.cost,
+                'calls': stage.calls,
+                'rejections': stage.rejections,
+                'avg_ms': round(stage.total_time / stage.calls * 1000, 3) if stage.calls else 0,
+                'max_ms': round(stage.max_time * 1000, 3)
+            } for stage in self.order]
+
+
+MIDDLEWARE = MiddlewarePipeline()
+
+
+def middleware(name, cost, can_reject=True, required=False):
+    """Декоратор регистрации стадии конвейера (метод ClanRequestHandler)"""
+
+    def decorator(func):
+        MIDDLEWARE.add(MiddlewareStage(name, cost, func.__name__, can_reject, required))
+        return func
+
+    return decorator
+
+
+# ==================== ПРОФИЛИРОВАНИЕ ====================
+
+class SamplingProfiler:
+    """Выборочный профилировщик всех потоков процесса
+
+    Отдельный поток раз в PROFILER_INTERVAL снимает стеки через
+    sys._current_frames(), обслуживающие потоки не инструментируются,
+    поэтому накладные расходы не зависят от числа запросов. Результат -
+    свернутые стеки для flamegraph.pl/speedscope и сводка по функциям.
+    Простаивающие потоки (ожидание соединения, очереди, события или
+    следующего запроса keep-alive) в выборку не попадают.
+    """
+
+    # Листовые кадры (файл, функция) блокирующих ожиданий служебных потоков
+    IDLE_LEAVES = {('selectors.py', 'select'), ('threading.py', 'wait'), ('queue.py', 'get'),
+                   ('socket.py', 'accept')}
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.started_at = None
+        self.duration = 0
+        self.last_result = None
+        self.labels = {}  # code object -> подпись кадра
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, duration, interval=PROFILER_INTERVAL):
+        """Запуск сеанса на duration секунд; False, если сеанс уже идет"""
+        with self.lock:
+            if self.is_running():
+                return False
+            self.stop_event.clear()
+            self.started_at = time.time()
+            self.duration = duration
+            self.thread = threading.Thread(target=self._run, args=(duration, interval),
+                                           name='sampling-profiler', daemon=True)
+            self.thread.start()
+        logger.info(f"Профилирование запущено на {duration} с")
+        return True
+
+    def stop(self):
+        """Досрочная остановка сеанса, результат сохраняется"""
+        if not self.is_running():
+            return False
+        self.stop_event.set()
+        self.thread.join()
+        return True
+
+    def _label(self, code):
+        label = self.labels.get(code)
+        if label is None:
+            label = self.labels[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+        return label
+
+    @classmethod
+    def _is_idle(cls, frame):
+        """Поток ждет работы, а не выполняет ее"""
+        code = frame.f_code
+        leaf = (os.path.basename(code.co_filename), code.co_name)
+        if leaf in cls.IDLE_LEAVES:
+            return True
+        # Соединение keep-alive ждет строку следующего запроса
+        caller = frame.f_back
+        return (leaf == ('socket.py', 'readinto') and caller is not None
+                and caller.f_code.co_name == 'handle_one_request'
+                and os.path.basename(caller.f_code.co_filename) == 'server.py')
+
+    def _run(self, duration, interval):
+        own_id = threading.get_ident()
+        stacks = {}
+        samples = 0
+        idle = 0
+        deadline = time.monotonic() + duration
+
+        while not self.stop_event.is_set() and time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                if self._is_idle(frame):
+                    idle += 1
+                    continue
+                path = []
+                while frame is not None:
+                    path.append(self._label(frame.f_code))
+                    frame = frame.f_back
+                key = ';'.join(reversed(path))
+                stacks[key] = stacks.get(key, 0) + 1
+            samples += 1
+            self.stop_event.wait(interval)
+
+        try:
+            self.last_result = self._save(stacks, samples, idle)
+            logger.info(f"Профилирование завершено: {samples} выборок, {self.last_result['name']}")
+        except Exception as e:
+            logger.error(f"Ошибка сохранения профиля: {e}")
+
+    def _save(self, stacks, samples, idle):
+        own_time = {}
+        total_time = {}
+        for key, count in stacks.items():
+            frames = key.split(';')
+            own_time[frames[-1]] = own_time.get(frames[-1], 0) + count
+            # Рекурсивная функция в одном стеке учитывается один раз
+            for label in set(frames):
+                total_time[label] = total_time.get(label, 0) + count
+
+        stack_samples = sum(stacks.values()) or 1
+        top = [{'function': label, 'own': count, 'total': total_time[label],
+                'own_percent': round(count * 100 / stack_samples, 2)}
+               for label, count in heapq.nlargest(50, own_time.items(), key=lambda item: item[1])]
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        # Миллисекунды в имени: короткие сеансы подряд не перезаписывают друг друга
+        now = datetime.now()
+        name = now.strftime('profile-%Y%m%d-%H%M%S-') + f'{now.microsecond // 1000:03d}'
+        with open(os.path.join(self.output_dir, name + '.collapsed'), 'w', encoding='utf-8') as f:
+            for key, count in sorted(stacks.items()):
+                f.write(f"{key} {count}\n")
+        with open(os.path.join(self.output_dir, name + '.top.txt'), 'w', encoding='utf-8') as f:
+            f.write(f"Выборок: {samples}, стеков потоков: {stack_samples}, простаивающих пропущено: {idle}\n\n")
+            f.write(f"{'своё':>8} {'%':>7} {'всего':>8}  функция\n")
+            for entry in top:
+                f.write(f"{entry['own']:>8} {entry['own_percent']:>7} {entry['total']:>8}  {entry['function']}\n")
+
+        self._prune()
+        return {'name': name, 'samples': samples, 'idle_skipped': idle, 'top': top[:20]}
+
+    def _prune(self):
+        """Удаление старых профилей сверх PROFILER_KEEP_FILES"""
+        names = sorted({name.split('.')[0] for name in os.listdir(self.output_dir) if name.startswith('profile-')})
+        for name in names[:-PROFILER_KEEP_FILES]:
+            for suffix in ('.collapsed', '.top.txt'):
+                try:
+                    os.remove(os.path.join(self.output_dir, name + suffix))
+                except OSError:
+                    pass
+
+    def list_files(self):
+        try:
+            return sorted((name for name in os.listdir(self.output_dir) if name.startswith('profile-')), reverse=True)
+        except OSError:
+            return []
+
+    def get_status(self):
+        running = self.is_running()
+        return {
+            'running': running,
+            'remaining_seconds': max(0, int(self.started_at + self.duration - time.time())) if running else 0,
+            'interval_ms': PROFILER_INTERVAL * 1000,
+            'last': self.last_result,
+            'files': self.list_files()
+        }
+
+
+profiler = SamplingProfiler(PROFILER_DIR)
+
+
+# ==================== ЖУРНАЛ ДОСТУПА ====================
+
+class AccessLogWriter:
+    """Структурированный журнал доступа в формате NDJSON
+
+    Запросы только кладут запись в ограниченную очередь, запись на диск
+    идет в отдельном потоке. Каждый час открывается новый сегмент,
+    закрытые сегменты сжимаются gzip.
+    """
+
+    def __init__(self, directory, queue_size):
+        self.directory = directory
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.dropped = 0
+        self.written = 0
+        self.running = False
+        self.thread = None
+        self.segment_hour = None
+        self.segment_file = None
+        self.segment_path = None
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='access-log-writer', daemon=True)
+        self.thread.start()
+        # Дописываем очередь в файл при завершении процесса
+        atexit.register(self.stop)
+
+    def stop(self, timeout=5):
+        """Остановка: новые записи не принимаются, накопленные в очереди дописываются на диск"""
+        if not self.running:
+            return
+        self.running = False
+        try:
+            # Метка конца очереди: поток запишет все, что стоит перед ней, и закроет сегмент
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            logger.error("Журнал доступа не дописан: очередь не освободилась при остановке")
+            return
+        self.thread.join(timeout)
+
+    def write(self, record):
+        if not self.running:
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _segment_path(self, hour):
+        return os.path.join(self.directory, f'access-{hour}.ndjson')
+
+    def _compress_leftovers(self):
+        """Сжатие сегментов, оставшихся несжатыми после прошлого запуска"""
+        current_path = self._segment_path(time.strftime('%Y%m%d-%H'))
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith('.ndjson') and path != current_path:
+                self._compress_segment(path)
+
+    def _run(self):
+        # Сжатие в потоке писателя не задерживает запуск сервера, записи пока копятся в очереди
+        self._compress_leftovers()
+        stopping = False
+        while not stopping:
+            record = self.queue.get()
+            stopping = record is None
+            batch = [] if stopping else [record]
+            # Забираем накопившиеся записи пачкой - одна запись в файл на пачку
+            while not stopping and len(batch) < 1000:
+                try:
+                    record = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if record is None:
+                    stopping = True
+                else:
+                    batch.append(record)
+            if not batch:
+                continue
+            try:
+                self._write_batch(batch)
+            except Exception as e:
+                logger.error(f"Ошибка записи журнала доступа: {e}")
+
+        if self.segment_file is not None:
+            self.segment_file.close()
+            self.segment_file = None
+            self.segment_hour = None
+
+    def _write_batch(self, batch):
+        hour = time.strftime('%Y%m%d-%H', time.localtime(batch[0]['ts']))
+        if hour != self.segment_hour:
+            self._rotate(hour)
+        lines = [json.dumps(record, ensure_ascii=False, separators=(',', ':')) for record in batch]
+        self.segment_file.write('\n'.join(lines) + '\n')
+        self.segment_file.flush()
+        self.written += len(batch)
+
+    def _rotate(self, hour):
+        closed_path = self.segment_path
+        if self.segment_file is not None:
+            self.segment_file.close()
+        self.segment_hour = hour
+        self.segment_path = self._segment_path(hour)
+        self.segment_file = open(self.segment_path, 'a', encoding='utf-8')
+        if closed_path and closed_path != self.segment_path:
+            threading.Thread(target=self._compress_segment, args=(closed_path,), daemon=True).start()
+
+    @staticmethod
+    def _compress_segment(path):
+        """Сжатие закрытого сегмента через временный .gz.part
+
+        Прерванное сжатие оставляет только .part, который при следующем
+        запуске перезаписывается; исходный сегмент удаляется лишь после
+        того, как готовый .gz занял свое место.
+        """
+        part_path = path + '.gz.part'
+        try:
+            with open(path, 'rb') as source, gzip.open(part_path, 'wb') as target:
+                shutil.copyfileobj(source, target)
+            os.replace(part_path, path + '.gz')
+            os.remove(path)
+        except Exception as e:
+            logger.error(f"Ошибка сжатия сегмента журнала доступа {path}: {e}")
+
+    def get_stats(self):
+        return {
+            'queue_size': self.queue.qsize(),
+            'written': self.written,
+            'dropped': self.dropped
+        }
+
+
+access_log = AccessLogWriter(ACCESS_LOG_DIR, ACCESS_LOG_QUEUE_SIZE)
+
+
+class CountingWriter:
+    """Обертка над wfile, считающая отправленные байты и время записи в сокет"""
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.bytes_written = 0
+        self.write_time = 0.0
+
+    def write(self, data):
+        start = time.perf_counter()
+        try:
+            return self.raw.write(data)
+        finally:
+            self.write_time += time.perf_counter() - start
+            self.bytes_written += len(data)
+
+    def flush(self):
+        return self.raw.flush()
+
+    def close(self):
+        return self.raw.close()
+
+    @property
+    def closed(self):
+        return self.raw.closed
+
+
+# ==================== ОБРАТНЫЙ ПРОКСИ ====================
+
+# Адрес собеседника по Unix-сокету: не IP, поэтому не входит ни в METRICS_ALLOWED_IPS, ни в другие списки
+UNIX_SOCKET_PEER = 'unix'
+trusted_proxies = AddressSet(TRUSTED_PROXIES)
+protection_allowlist = AddressSet(PROTECTION_ALLOWLIST)
+
+
+def _strip_port(node):
+    """'[2001:db8::1]:4711' -> '2001:db8::1', '192.0.2.1:80' -> '192.0.2.1'"""
+    if node.startswith('['):
+        return node[1:].split(']', 1)[0]
+    if node.count(':') == 1:
+        return node.split(':', 1)[0]
+    return node
+
+
+def _forwarded_chain(headers):
+    """Адреса из заголовка прокси по порядку: первый клиент, ..., последний прокси перед нами"""
+    values = headers.get_all(PROXY_CLIENT_IP_HEADER) or []
+    if PROXY_CLIENT_IP_HEADER.lower() != 'forwarded':
+        return [_strip_port(part.strip()) for value in values for part in value.split(',')]
+
+    # RFC 7239: Forwarded: for=192.0.2.60;proto=http, for="[2001:db8::1]:4711"
+    chain = []
+    for value in values:
+        for element in value.split(','):
+            node = ''
+            for pair in element.split(';'):
+                name, _, item = pair.strip().partition('=')
+                if name.lower() == 'for':
+                    node = _strip_port(item.strip().strip('"'))
+            chain.append(node)
+    return chain
+
+
+def resolve_client_ip(peer_ip, headers):
+    """Адрес клиента за доверенным прокси peer_ip
+
+    Цепочка из заголовка разбирается справа налево: адреса доверенных прокси
+    пропускаются, первый недоверенный - клиент. Эту часть цепочки дописали
+    наши прокси, левее нее клиент может подставить что угодно. Нераспознанный
+    элемент ("unknown", обфусцированное имя) останавливает разбор на последнем
+    известном адресе.
+    """
+    client_ip = peer_ip
+    for node in reversed(_forwarded_chain(headers)):
+        try:
+            ip_to_int(node)
+        except OSError:
+            break
+        client_ip = node
+        if node not in trusted_proxies:
+            break
+    return client_ip
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """HTTP-сервер на Unix-сокете для работы за локальным прокси без TCP"""
+
+    daemon_threads = True
+
+    def server_bind(self):
+        # Сокет, оставшийся от прошлого запуска, мешает bind
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        super().server_bind()
+        os.chmod(self.server_address, SERVER_UNIX_SOCKET_MODE)
 
 
 # ==================== ВЕБ-СЕРВЕР КЛАНА ====================
 
 class ClanRequestHandler(BaseHTTPRequestHandler):
 
+    def setup(self):
+        super().setup()
+        self.wfile = CountingWriter(self.wfile)
+
+        # У собеседника по Unix-сокету нет адреса: это локальный прокси, он доверенный,
+        # а адрес клиента обязан прийти от него (заголовок или PROXY protocol)
+        self.via_unix_socket = not isinstance(self.client_address, tuple)
+        if self.via_unix_socket:
+            self.client_address = (UNIX_SOCKET_PEER, 0)
+        self.peer_ip = self.client_address[0]
+        self.peer_trusted = self.via_unix_socket or self.peer_ip in trusted_proxies
+        self.proxy_header_invalid = False
+        if PROXY_PROTOCOL and self.peer_trusted:
+            self._read_proxy_header()
+        self.client_ip = self.peer_ip
+
+    def _read_proxy_header(self):
+        """Строка PROXY protocol v1 в начале соединения: PROXY TCP4 <клиент> <сервер> <порт> <порт>"""
+        previous_timeout = self.connection.gettimeout()
+        try:
+            self.connection.settimeout(PROXY_HEADER_TIMEOUT)
+            line = self.rfile.readline(108)
+        except OSError:
+            line = b''
+        finally:
+            self.connection.settimeout(previous_timeout)
+
+        parts = line.decode('ascii', 'replace').split()
+        if line.endswith(b'\r\n') and len(parts) >= 2 and parts[0] == 'PROXY':
+            # UNKNOWN - соединение самого прокси (например, проверка здоровья)
+            if parts[1] == 'UNKNOWN':
+                return
+            if parts[1] in ('TCP4', 'TCP6') and len(parts) == 6:
+                try:
+                    ip_to_int(parts[2])
+                except OSError:
+                    pass
+                else:
+                    self.peer_ip = parts[2]
+                    self.peer_trusted = parts[2] in trusted_proxies
+                    return
+        self.proxy_header_invalid = True
+        logger.warning(f"Соединение от прокси {self.peer_ip} без корректной строки PROXY protocol закрыто")
+
+    def parse_request(self):
+        # Запрос прочитан: с этого момента он учитывается в нагрузке для адаптивных порогов
+        adaptive_thresholds.request_started()
+        self.load_started = time.perf_counter()
+        if not super().parse_request():
+            return False
+        if self.peer_trusted:
+            self.client_ip = resolve_client_ip(self.peer_ip, self.headers)
+        if self.client_ip == UNIX_SOCKET_PEER:
+            # Иначе все клиенты сокета делили бы один ключ лимитов
+            self.send_error(400, f'Requires {PROXY_CLIENT_IP_HEADER} header')
+            return False
+        return True
+
+    def handle_one_request(self):
+        """Обработка запроса с записью в структурированный журнал доступа"""
+        if self.proxy_header_invalid:
+            self.close_connection = True
+            return
+        self.client_ip = self.peer_ip
+        self.command = None
+        self.route = None
+        self.response_status = None
+        self.protection_decision = None
+        self.retry_after = None
+        self.load_started = None
+        self.body_read_time = 0.0
+        self.body_rejected = False
+        self.rejected_by = None
+        self.phase_times = {}
+        self.handler_started = None
+        self.handler_write_time = 0.0
+        self.request_started = time.perf_counter()
+        bytes_before = self.wfile.bytes_written
+        write_time_before = self.wfile.write_time
+
+        try:
+            super().handle_one_request()
+        finally:
+            if self.load_started is not None:
+                # Длительность без ожидания тела от клиента; отклоненные при чтении тела в p95 не попадают
+                duration = None if self.body_rejected else (
+                    time.perf_counter() - self.load_started - self.body_read_time)
+                adaptive_thresholds.request_finished(duration)
+            if self.command:
+                phases = self._current_phase_times()
+                phases['write'] = self.wfile.write_time - write_time_before
+                phase_timings.record(phases)
+                self._record_request_metrics()
+                if ACCESS_LOG_ENABLED:
+                    self._write_access_record(bytes_before)
+
+    def _record_request_metrics(self):
+        """Учет завершенного запроса в метриках"""
+        route_label = self.route.path if self.route else 'unmatched'
+        METRICS.inc('clan_http_requests_total', (route_label, self.command, str(self.response_status)))
+        METRICS.observe('clan_http_request_duration_seconds', (route_label,),
+                        time.perf_counter() - self.request_started)
+        if self.protection_decision and self.protection_decision != 'skipped':
+            METRICS.inc('clan_protection_decisions_total', (self.protection_decision,))
+
+    def _write_access_record(self, bytes_before):
+        """Запись завершенного запроса в журнал доступа"""
+        record = {
+            'ts': round(time.time(), 3),
+            'ip': self.client_ip,
+            'm': self.command,
+            'route': self.route.path if self.route else None,
+            'st': self.response_status,
+            'b': self.wfile.bytes_written - bytes_before,
+            'lat': round((time.perf_counter() - self.request_started) * 1000, 3),
+            'dec': self.protection_decision
+        }
+        if self.route is None:
+            record['path'] = self.path[:200]
+        if self.rejected_by:
+            record['rej'] = self.rejected_by
+        access_log.write(record)
+
+    def send_response(self, code, message=None):
+        self.response_status = code
+        super().send_response(code, message)
+
     def _set_cors_headers(self):
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS, PUT, DELETE')
@@ -840,16 +3580,205 @@ class ClanRequestHandler(BaseHTTPRequestHandler):
         self._set_cors_headers()
         self.end_headers()
 
+    def _send_json(self, data, status=200, cors=False):
+        """Отправка JSON-ответа"""
+        with self._phase('serialize'):
+            body = json.dumps(data, default=str).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-type', 'application/json')
+        if cors:
+            self._set_cors_headers()
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_html(self, html, status=200):
+        """Отправка HTML-страницы"""
+        with self._phase('serialize'):
+            body = html.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-type', 'text/html; charset=utf-8')
+        self.end_headers()
+        self.wfile.write(body)
+
+    @contextmanager
+    def _phase(self, name):
+        """Учет времени фазы обработки запроса"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phase_times[name] = self.phase_times.get(name, 0.0) + time.perf_counter() - start
+
+    def _current_phase_times(self):
+        """Фазы запроса на текущий момент: время обработчика без сериализации и записи"""
+        phases = dict(self.phase_times)
+        now = time.perf_counter()
+        if self.handler_started is not None:
+            handler_time = (now - self.handler_started - phases.get('serialize', 0.0)
+                            - (self.wfile.write_time - self.handler_write_time))
+            phases['handler'] = max(0.0, handler_time)
+        phases['total'] = now - self.request_started
+        return phases
+
+    def end_headers(self):
+        if SERVER_TIMING_ENABLED:
+            self.send_header('Server-Timing', ', '.join(
+                f'{name};dur={duration * 1000:.2f}' for name, duration in self._current_phase_times().items()))
+        super().end_headers()
+
+    def read_body(self, parser):
+        """Чтение тела запроса частями с ограничением размера и времени
+
+        Размер проверяется по Content-Length до чтения, чтение прерывается
+        по истечении REQUEST_BODY_TIMEOUT. Возвращает результат parser.close().
+        """
+        if self.headers.get('Transfer-Encoding'):
+            raise RequestBodyError(411, 'length_required', 'Требуется Content-Length')
+
+        try:
+            content_length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            raise RequestBodyError(400, 'malformed', 'Некорректный Content-Length')
+        if content_length < 0:
+            raise RequestBodyError(400, 'malformed', 'Некорректный Content-Length')
+        if content_length > self.route.max_body:
+            raise RequestBodyError(413, 'too_large', f'Тело запроса больше {self.route.max_body} байт')
+
+        deadline = time.monotonic() + REQUEST_BODY_TIMEOUT
+        previous_timeout = self.connection.gettimeout()
+        remaining = content_length
+        body_started = time.perf_counter()
+        try:
+            with adaptive_thresholds.waiting_for_client():
+                while remaining > 0:
+                    time_left = deadline - time.monotonic()
+                    if time_left <= 0:
+                        raise RequestBodyError(408, 'timeout', 'Превышено время передачи данных')
+                    self.connection.settimeout(time_left)
+                    try:
+                        chunk = self.rfile.read1(min(REQUEST_BODY_CHUNK_SIZE, remaining))
+                    except socket.timeout:
+                        raise RequestBodyError(408, 'timeout', 'Превышено время передачи данных')
+                    if not chunk:
+                        raise RequestBodyError(400, 'malformed', 'Соединение закрыто до получения всех данных')
+                    remaining -= len(chunk)
+                    parser.feed(chunk)
+        finally:
+            self.connection.settimeout(previous_timeout)
+            self.body_read_time += time.perf_counter() - body_started
+
+        return parser.close()
+
+    def read_form(self):
+        """Разбор urlencoded-тела, при ошибке отправляет ответ и возвращает None"""
+        return self._read_body_or_reject(UrlencodedBodyParser())
+
+    def read_json(self):
+        """Разбор JSON-тела, при ошибке отправляет ответ и возвращает None"""
+        return self._read_body_or_reject(JsonBodyParser())
+
+    def _read_body_or_reject(self, parser):
+        try:
+            return self.read_body(parser)
+        except RequestBodyError as e:
+            self.body_rejected = True
+            count_body_rejection(e.reason)
+            block_log.warning((self.client_ip, e.reason),
+                              f"Тело запроса от {self.client_ip} отклонено ({e.status}): {e}")
+            # Непрочитанный остаток тела в сокете - соединение дальше не используем
+            self.close_connection = True
+            self._send_json({'status': 'error', 'success': False, 'message': str(e)}, e.status, cors=True)
+            return None
+
+    @middleware('admin_auth', cost=1, required=True)
+    def _middleware_admin_auth(self, route):
+        """Авторизация администратора для закрытых маршрутов (проверка в памяти)"""
+        if not route.auth or check_admin_auth(self.headers.get('Cookie', '')):
+            return True
+
+        if route.auth == 'page':
+            self.redirect_to_admin_login()
+        else:
+            self.send_error(403)
+        return False
+
+    @middleware('maintenance', cost=1)
+    def _middleware_maintenance(self, route):
+        """Режим обслуживания (кроме админки)"""
+        if MAINTENANCE_MODE and not route.maintenance_exempt:
+            self.serve_maintenance_page()
+            return False
+        return True
+
+    @middleware('protection', cost=100)
+    def _middleware_protection(self, route):
+        """Защита от DDoS и ограничение посещений (запросы к SQLite)"""
+        if not route.cost:
+            # Бесплатные маршруты (галерея, статика) не учитываются в лимитах,
+            # но ручная блокировка действует и на них: поиск в памяти без SQLite
+            if is_ip_manually_blocked(self.client_ip)[0] and not self._protection_allowlist_match():
+                self.protection_decision = 'manual_block'
+                self._send_manual_block_error(self.client_ip)
+                return False
+            self.protection_decision = 'skipped'
+            return True
+
+        # Доверенные клиенты не учитываются в лимитах и не пишутся в request_logs
+        allowlist_match = self._protection_allowlist_match()
+        if allowlist_match:
+            self.protection_decision = 'allowlisted'
+            METRICS.inc('clan_protection_allowlist_hits_total', (allowlist_match,))
+            return True
+        return self._check_protection()
+
+    def _protection_allowlist_match(self):
+        """Почему запрос пропускается без проверки лимитов: 'address', 'admin_session' или None"""
+        if self.client_ip in protection_allowlist:
+            return 'address'
+        if PROTECTION_ALLOWLIST_ADMINS:
+            cookie_header = self.headers.get('Cookie', '')
+            if 'admin_session=' in cookie_header and check_admin_auth(cookie_header):
+                return 'admin_session'
+        return None
+
+    @middleware('visit_log', cost=50, can_reject=False)
+    def _middleware_visit_log(self, route):
+        """Сохранение информации о посещении"""
+        if route.log_visit:
+            save_visit(self.client_ip, self.headers.get('User-Agent', ''), self.path)
+        return True
+
     def _check_protection(self):
         """Проверка защиты от DDoS и ограничения посещений"""
-        ip_address = self.client_address[0]
+        ip_address = self.client_ip
 
         # Очищаем старые логи раз в 20 запросов (для оптимизации)
         if hash(ip_address) % 20 == 0:
-            cleanup_old_logs()
+            with self._phase('cleanup'):
+                cleanup_old_logs()
+
+        # Всплески от подсети, User-Agent или пути (при автоблокировке подсеть блокируется до проверок ниже)
+        if HEAVY_HITTER_ENABLED:
+            observe_heavy_hitters(ip_address, self.headers.get('User-Agent', ''), self.route.path)
+
+        limit_class = self.route.limit_class
+        if limit_class in RATE_LIMIT_GCRA_CLASSES:
+            # Ведро токенов в памяти: без request_logs, SQLite только при блокировке за DDoS
+            visit_allowed, visit_reason, self.retry_after = check_rate_gcra(ip_address, limit_class, self.route.cost)
+            self.protection_decision = visit_reason
+            if visit_allowed:
+                return True
+            if visit_reason == "manual_block":
+                self._send_manual_block_error(ip_address)
+            elif visit_reason == "ddos":
+                self._send_ddos_error(ip_address)
+            else:
+                self._send_visit_limit_error(ip_address)
+            return False
 
-        # Сначала проверяем ограничение посещений (15 в минуту)
-        visit_allowed, visit_reason = check_visit_limit(ip_address, self.path)
+        # Сначала проверяем бюджет класса маршрута
+        visit_allowed, visit_reason = check_visit_limit(ip_address, self.path, limit_class, self.route.cost)
+        self.protection_decision = visit_reason
 
         if not visit_allowed:
             if visit_reason == "manual_block":
@@ -858,14 +3787,23 @@ class ClanRequestHandler(BaseHTTPRequestHandler):
             elif visit_reason == "visit_limit":
                 self._send_visit_limit_error(ip_address)
                 return False
+            elif visit_reason == "db_busy":
+                self._send_protection_busy_error()
+                return False
             else:
                 # Если заблокирован за DDoS
                 self._send_ddos_error(ip_address)
                 return False
 
         # Затем проверяем защиту от DDoS (более строгие лимиты)
-        if not check_ddos_protection(ip_address):
-            self._send_ddos_error(ip_address)
+        ddos_allowed, ddos_reason = check_ddos_protection(ip_address)
+        if ddos_reason != "allowed":
+            self.protection_decision = ddos_reason
+        if not ddos_allowed:
+            if ddos_reason == "db_busy":
+                self._send_protection_busy_error()
+            else:
+                self._send_ddos_error(ip_address)
             return False
 
         return True
@@ -955,8 +3893,14 @@ class ClanRequestHandler(BaseHTTPRequestHandler):
 
     def _send_visit_limit_error(self, ip_address):
         """Отправка ошибки превышения лимита посещений"""
+        # Окно блокирует на VISIT_BLOCK_TIME, GCRA сообщает точное время до следующего токена
+        if self.retry_after:
+            wait_seconds = int(self.retry_after) + 1
+        else:
+            wait_seconds = int(adaptive_thresholds.block_time(VISIT_BLOCK_TIME))
         self.send_response(429)  # Too Many Requests
         self.send_header('Content-type', 'text/html; charset=utf-8')
+        self.send_header('Retry-After', str(wait_seconds))
         self.end_headers()
 
         error_html = f"""
@@ -1037,7 +3981,7 @@ class ClanRequestHandler(BaseHTTPRequestHandler):
                 </div>
 
                 <div class="countdown">
-                    ⏳ До разблокировки: 1 минута
+                    ⏳ До разблокировки: {wait_seconds} с
                 </div>
 
                 <p>Пожалуйста, подождите немного перед следующим посещением.</p>
@@ -1045,10 +3989,10 @@ class ClanRequestHandler(BaseHTTPRequestHandler):
             </div>
 
             <script>
-                // Автоматический редирект через 60 секунд
+                // Автоматический редирект после разблокировки
                 setTimeout(function() {{
                     window.location.href = '/';
-                }}, 60000);
+                }}, {wait_seconds * 1000});
             </script>
         </body>
         </html>
@@ -1099,6 +4043,23 @@ class ClanRequestHandler(BaseHTTPRequestHandler):
         """
         self.wfile.write(error_html.encode('utf-8'))
 
+    def _send_protection_busy_error(self):
+        """Ответ 503, когда лимиты нельзя проверить: база защиты занята"""
+        self.send_response(503)  # Service Unavailable
+        self.send_header('Retry-After', str(PROTECTION_BUSY_RETRY_AFTER))
+        self.send_header('Content-type', 'text/html; charset=utf-8')
+        self.end_headers()
+        self.wfile.write(f"""
+        <!DOCTYPE html>
+        <html>
+        <head><title>Service Unavailable</title><meta charset="utf-8"></head>
+        <body style="font-family: Arial, sans-serif; background: #1a1a1a; color: white; text-align: center;">
+            <h1>Сервер перегружен</h1>
+            <p>Повторите запрос через {PROTECTION_BUSY_RETRY_AFTER} секунд.</p>
+        </body>
+        </html>
+        """.encode('utf-8'))
+
     def serve_maintenance_page(self):
         """Отображение страницы технического обслуживания"""
         html = """
@@ -1225,94 +4186,46 @@ class ClanRequestHandler(BaseHTTPRequestHandler):
         self.wfile.write(html.encode('utf-8'))
 
     def do_GET(self):
-        # Проверка защиты от DDoS и ограничения посещений
-        if not self._check_protection():
-            return
+        self._dispatch('GET')
 
-        # Проверка режима обслуживания (кроме админки)
-        if MAINTENANCE_MODE and not self.path.startswith('/admin'):
-            self.serve_maintenance_page()
-            return
-
-        # Сохраняем информацию о посещении
-        save_visit(self.client_address[0], self.headers.get('User-Agent', ''), self.path)
-
-        parsed_path = urlparse(self.path)
-        path = parsed_path.path
-
-        # Маршрутизация запросов
-        if path == '/':
-            self.serve_html()
-        elif path == '/zayavka':
-            self.serve_application_page()
-        elif path == '/applications':
-            self.serve_applications()
-        elif path == '/statistics':
-            self.serve_statistics()
-        elif path == '/gallery-images':
-            self.serve_gallery_images()
-        elif path == '/rate-limit-status':
-            self.serve_rate_limit_status()
-        elif path.startswith('/admin'):
-            self.handle_admin_request(path)
-        else:
-            self.send_error(404)
+    def do_HEAD(self):
+        self._dispatch('HEAD')
 
     def do_POST(self):
-        # Проверка защиты от DDoS и ограничения посещений
-        if not self._check_protection():
+        self._dispatch('POST')
+
+    def _dispatch(self, method):
+        """Маршрутизация запроса по таблице ROUTES"""
+        self.route_path = urlparse(self.path).path
+        route, allowed_methods = ROUTES.resolve(method, self.route_path)
+
+        # Неизвестные пути и методы отклоняем до любой работы с базой данных
+        if route is None:
+            if allowed_methods:
+                self.send_response(405)  # Method Not Allowed
+                self.send_header('Allow', ', '.join(sorted(allowed_methods)))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+            else:
+                self.send_error(404)
             return
 
-        parsed_path = urlparse(self.path)
-        path = parsed_path.path
-
-        if path == '/submit_application':
-            self.handle_application()
-        elif path.startswith('/admin'):
-            self.handle_admin_post_request(path)
-        else:
-            self.send_error(404)
-
-    def handle_admin_request(self, path):
-        """Обработка запросов админки"""
-        if path == '/admin' or path == '/admin/':
-            self.serve_admin_page()
-        elif path == '/admin/login':
-            self.serve_admin_login_page()
-        elif path == '/admin/api/stats':
-            self.serve_admin_api_stats()
-        elif path == '/admin/api/applications':
-            self.serve_admin_applications()
-        elif path == '/admin/api/manual-blocks':
-            self.serve_admin_manual_blocks()
-        elif path == '/admin/logout':
-            self.handle_admin_logout()
-        else:
-            self.send_error(404)
+        self.route = route
+        if not MIDDLEWARE.run(self, route):
+            return
 
-    def handle_admin_post_request(self, path):
-        """Обработка POST запросов админки"""
-        if path == '/admin/api/login':
-            self.handle_admin_login()
-        elif path == '/admin/api/manual-blocks/add':
-            self.handle_admin_add_manual_block()
-        elif path == '/admin/api/manual-blocks/remove':
-            self.handle_admin_remove_manual_block()
-        elif path == '/admin/api/maintenance/toggle':
-            self.handle_maintenance_toggle()
-        else:
-            self.send_error(404)
+        self.handler_started = time.perf_counter()
+        self.handler_write_time = self.wfile.write_time
+        getattr(self, route.handler)()
 
+    @route('POST', '/admin/api/maintenance/toggle', auth='api', log_visit=False, maintenance_exempt=True,
+           max_body=1024)
     def handle_maintenance_toggle(self):
         """Включение/выключение режима обслуживания"""
-        if not check_admin_auth(self.headers.get('Cookie', '')):
-            self.send_error(403)
-            return
-
         try:
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            data = json.loads(post_data.decode('utf-8'))
+            data = self.read_json()
+            if data is None:
+                return
 
             enabled = data.get('enabled', False)
             success = save_maintenance_mode(enabled)
@@ -1326,30 +4239,24 @@ class ClanRequestHandler(BaseHTTPRequestHandler):
             logger.error(f"Ошибка переключения режима обслуживания: {e}")
             self.send_error(500)
 
+    @route('GET', '/', cost=PAGE_COST)
     def serve_html(self):
         """Отдача HTML страницы клана"""
         try:
-            html_content = self.get_html_content()
-            self.send_response(200)
-            self.send_header('Content-type', 'text/html; charset=utf-8')
-            self.end_headers()
-            self.wfile.write(html_content.encode('utf-8'))
+            self._send_html(self.get_html_content())
         except Exception as e:
             logger.error(f"Error serving HTML: {e}")
             self.send_error(500)
 
+    @route('GET', '/zayavka', cost=PAGE_COST)
     def serve_application_page(self):
         """Отдача страницы с формой заявки"""
         try:
             # Проверяем, может ли пользователь отправить заявку
-            ip_address = self.client_address[0]
+            ip_address = self.client_ip
             can_submit = can_submit_application(ip_address)
 
-            html_content = self.get_application_page_content(can_submit)
-            self.send_response(200)
-            self.send_header('Content-type', 'text/html; charset=utf-8')
-            self.end_headers()
-            self.wfile.write(html_content.encode('utf-8'))
+            self._send_html(self.get_application_page_content(can_submit))
         except Exception as e:
             logger.error(f"Error serving application page: {e}")
             self.send_error(500)
@@ -1834,7 +4741,7 @@ class ClanRequestHandler(BaseHTTPRequestHandler):
             </footer>
 
             <script>
-                const GALLERY_IMAGES = """ + json.dumps(GALLERY_IMAGES) + """;
+                const GALLERY_IMAGES = """ + json.dumps(get_gallery_entries()) + """;
 
                 // Загрузка галереи
                 function loadGallery() {
@@ -1842,14 +4749,14 @@ class ClanRequestHandler(BaseHTTPRequestHandler):
                         const gallery = document.getElementById('gallery');
                         gallery.innerHTML = '';
 
-                        GALLERY_IMAGES.forEach((imageUrl, index) => {
+                        GALLERY_IMAGES.forEach((image, index) => {
                             const galleryItem = document.createElement('div');
                             galleryItem.className = 'gallery-item';
                             galleryItem.innerHTML = `
-                                <img src="${imageUrl}" alt="Фото клана BENZ ${index + 1}" loading="lazy">
+                                <img src="${image.thumb}" alt="Фото клана BENZ ${index + 1}" loading="lazy">
                             `;
                             galleryItem.onclick = function() {
-                                openModal(imageUrl, index + 1);
+                                openModal(image.url, index + 1);
                             };
                             gallery.appendChild(galleryItem);
                         });
@@ -2325,11 +5232,15 @@ class ClanRequestHandler(BaseHTTPRequestHandler):
         </html>
         """
 
+    @route('POST', '/submit_application', cost=5, limit_class='write', log_visit=False, max_body=32 * 1024)
     def handle_application(self):
         """Обработка заявки"""
         try:
-            content_length = int(self.headers.get('Content-Length', 0))
-            if content_length == 0:
+            form_data = self.read_form()
+            if form_data is None:
+                return
+
+            if not form_data:
                 self.send_response(400)
                 self.send_header('Content-type', 'application/json')
                 self._set_cors_headers()
@@ -2337,9 +5248,6 @@ class ClanRequestHandler(BaseHTTPRequestHandler):
                 self.wfile.write(json.dumps({'status': 'error', 'message': 'Пустые данные'}).encode())
                 return
 
-            post_data = self.rfile.read(content_length)
-            form_data = parse_qs(post_data.decode('utf-8'))
-
             # Валидация обязательных полей
             required_fields = ['nickname', 'steamId', 'playtime', 'discord', 'role', 'message']
             for field in required_fields:
@@ -2358,7 +5266,7 @@ class ClanRequestHandler(BaseHTTPRequestHandler):
                 'discord': form_data['discord'][0].strip(),
                 'role': form_data['role'][0].strip(),
                 'message': form_data['message'][0].strip(),
-                'ip': self.client_address[0]
+                'ip': self.client_ip
             }
 
             # Проверка часов
@@ -2412,181 +5320,305 @@ class ClanRequestHandler(BaseHTTPRequestHandler):
             self.end_headers()
             self.wfile.write(json.dumps({'status': 'error', 'message': 'Внутренняя ошибка сервера'}).encode())
 
+    @route('GET', '/applications', cost=3, limit_class='api')
     def serve_applications(self):
         """API для получения заявок"""
         try:
             applications = get_all_applications()
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self._set_cors_headers()
-            self.end_headers()
-            response = {'total': len(applications), 'applications': applications}
-            self.wfile.write(json.dumps(response, default=str).encode('utf-8'))
+            self._send_json({'total': len(applications), 'applications': applications}, cors=True)
         except Exception as e:
             logger.error(f"Error serving applications: {e}")
             self.send_error(500)
 
+    @route('GET', '/statistics', cost=2, limit_class='api')
     def serve_statistics(self):
         """API для получения статистики"""
         try:
-            stats = get_statistics()
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self._set_cors_headers()
-            self.end_headers()
-            self.wfile.write(json.dumps(stats, default=str).encode('utf-8'))
+            self._send_json(get_statistics(), cors=True)
         except Exception as e:
             logger.error(f"Error serving statistics: {e}")
             self.send_error(500)
 
+    @route('GET', '/gallery-images')
     def serve_gallery_images(self):
         """API для получения изображений галереи"""
         try:
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self._set_cors_headers()
-            self.end_headers()
-            self.wfile.write(json.dumps(GALLERY_IMAGES).encode('utf-8'))
+            self._send_json(get_gallery_entries(), cors=True)
         except Exception as e:
             logger.error(f"Error serving gallery images: {e}")
             self.send_error(500)
 
+    @route(('GET', 'HEAD'), '/gallery/', prefix=True, cost=0, log_visit=False)
+    def serve_gallery_file(self):
+        """Отдача изображения галереи или миниатюры из локального кэша"""
+        parts = self.route_path.strip('/').split('/')
+        if len(parts) not in (2, 3) or (len(parts) == 3 and parts[2] != 'thumb'):
+            self.send_error(404)
+            return
+
+        source_url = get_gallery_source_url(parts[1])
+        if source_url is None:
+            self.send_error(404)
+            return
+
+        thumb = len(parts) == 3
+        file_path = make_gallery_thumbnail(source_url) if thumb else fetch_gallery_image(source_url)
+        if file_path is None:
+            # Кэш недоступен - отправляем браузер к оригиналу, чтобы галерея не ломалась
+            self.send_response(302)
+            self.send_header('Location', source_url)
+            self.end_headers()
+            return
+
+        self.serve_static_file(file_path, f'public, max-age={GALLERY_CACHE_MAX_AGE}, immutable')
+
+    @route(('GET', 'HEAD'), '/static/', prefix=True, cost=0, log_visit=False)
+    @route(('GET', 'HEAD'), '/favicon.ico', cost=0, log_visit=False)
+    def serve_static(self):
+        """Отдача файла из каталога статики"""
+        file_path = resolve_static_path(self.route_path)
+        if file_path is None:
+            self.send_error(404)
+            return
+
+        self.serve_static_file(file_path, f'public, max-age={STATIC_CACHE_MAX_AGE}')
+
+    def serve_static_file(self, file_path, cache_control):
+        """Отдача файла без копирования через sendfile с поддержкой Range, HEAD и ETag"""
+        info = get_static_file_info(file_path)
+        if info is None:
+            self.send_error(404)
+            return
+
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match and etag_matches(if_none_match, info['etag']):
+            self.send_response(304)  # Not Modified
+            self.send_header('ETag', info['etag'])
+            self.send_header('Cache-Control', cache_control)
+            self.end_headers()
+            return
+
+        try:
+            f = open(file_path, 'rb')
+        except OSError:
+            self.send_error(404)
+            return
+
+        with f:
+            # Кэш мог отстать на STATIC_STAT_INTERVAL: длина и версия - у открытого файла
+            info = get_static_file_info(file_path, os.fstat(f.fileno()))
+            if info is None:
+                self.send_error(404)
+                return
+            file_size = info['size']
+            etag = info['etag']
+
+            byte_range = None
+            if_range = self.headers.get('If-Range')
+            # Range применяется только если клиент ждет ту же версию файла
+            if not if_range or if_range.strip() in (etag, info['last_modified']):
+                try:
+                    byte_range = parse_range_header(self.headers.get('Range'), file_size)
+                except ValueError:
+                    self.send_response(416)  # Range Not Satisfiable
+                    self.send_header('Content-Range', f'bytes */{file_size}')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+            if byte_range:
+                start, end = byte_range
+                self.send_response(206)  # Partial Content
+                self.send_header('Content-Range', f'bytes {start}-{end}/{file_size}')
+            else:
+                start, end = 0, file_size - 1
+                self.send_response(200)
+
+            length = end - start + 1
+            self.send_header('Content-type', info['content_type'])
+            self.send_header('Content-Length', str(length))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', info['last_modified'])
+            self.send_header('Cache-Control', cache_control)
+            self.end_headers()
+
+            if self.command == 'HEAD' or length <= 0:
+                return
+
+            # Заголовки уже в сокете, тело уходит напрямую из файла (os.sendfile)
+            self.wfile.flush()
+            sendfile_started = time.perf_counter()
+            self.wfile.bytes_written += self.connection.sendfile(f, offset=start, count=length)
+            self.wfile.write_time += time.perf_counter() - sendfile_started
+
+    @route('GET', '/rate-limit-status', limit_class='api')
     def serve_rate_limit_status(self):
         """API для проверки текущего статуса ограничений"""
         try:
-            ip_address = self.client_address[0]
-            conn = sqlite3.connect(ddos_protection_db)
+            ip_address = self.client_ip
+            ip_key, ip_label = rate_limit_key(ip_address)
+            conn = db_connect(ddos_protection_db)
             cursor = conn.cursor()
 
             current_time = datetime.now()
             one_minute_ago = (current_time - timedelta(minutes=1)).isoformat()
 
-            # Получаем количество запросов за последнюю минуту
+            # Получаем количество и стоимость запросов за последнюю минуту по классам
             cursor.execute('''
-                SELECT COUNT(*) FROM request_logs 
-                WHERE ip_address = ? AND timestamp > ?
-            ''', (ip_address, one_minute_ago))
+                SELECT limit_class, COUNT(*), SUM(cost) FROM request_logs 
+                WHERE ip_key = ? AND timestamp > ?
+                GROUP BY limit_class
+            ''', (ip_key, one_minute_ago))
 
-            current_requests = cursor.fetchone()[0]
-            remaining_requests = max(0, VISIT_LIMIT - current_requests)
+            usage = {limit_class: (count, used) for limit_class, count, used in cursor.fetchall()}
+            current_requests = sum(count for count, _ in usage.values())
+            ddos_used = sum(used for _, used in usage.values())
 
-            # Проверяем блокировку
+            # Проверяем блокировки: ручную, за DDoS и по классам
             cursor.execute('''
-                SELECT block_start_time, block_reason FROM ip_blocks 
-                WHERE ip_address = ? AND is_blocked = TRUE
-            ''', (ip_address,))
-
-            blocked_result = cursor.fetchone()
-            blocked = blocked_result is not None
-            block_reason = blocked_result[1] if blocked else None
+                SELECT ip_address, block_reason FROM ip_blocks 
+                WHERE (ip_address IN (?, ?) OR ip_address LIKE ?) AND is_blocked = TRUE
+            ''', (ip_address, ip_label, _class_block_key(ip_label, '%')))
 
+            blocks = dict(cursor.fetchall())
             conn.close()
 
+            classes = {}
+            # Бюджеты с учетом текущего уровня нагрузки
+            for limit_class in RATE_LIMIT_CLASSES:
+                budget = class_budget(limit_class)
+                if limit_class in RATE_LIMIT_GCRA_CLASSES:
+                    burst = class_burst(limit_class)
+                    remaining = gcra_limiter.remaining((ip_key, limit_class), budget, burst)
+                    classes[limit_class] = {
+                        'algorithm': 'gcra',
+                        'budget': budget,
+                        'burst': burst,
+                        'remaining': round(remaining, 2),
+                        'blocked': False
+                    }
+                    continue
+                used = usage.get(limit_class, (0, 0))[1]
+                classes[limit_class] = {
+                    'algorithm': 'window',
+                    'budget': budget,
+                    'used': used,
+                    'remaining': max(0, budget - used),
+                    'blocked': _class_block_key(ip_label, limit_class) in blocks
+                }
+
+            blocked = bool(blocks)
+            block_reason = next(iter(blocks.values())) if blocked else None
+
             status_data = {
                 'ip': ip_address,
+                'rate_limit_key': ip_label,
                 'current_requests': current_requests,
                 'limit': VISIT_LIMIT,
-                'remaining': remaining_requests,
+                'remaining': int(classes['static']['remaining'] // PAGE_COST),
+                'ddos_limit': adaptive_thresholds.limit(REQUEST_LIMIT),
+                'ddos_used': ddos_used,
                 'blocked': blocked,
                 'block_reason': block_reason,
+                'classes': classes,
+                'routes': get_route_costs(),
                 'reset_time': (current_time + timedelta(minutes=1)).isoformat()
             }
 
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self._set_cors_headers()
-            self.end_headers()
-            self.wfile.write(json.dumps(status_data).encode('utf-8'))
+            self._send_json(status_data, cors=True)
 
         except Exception as e:
             logger.error(f"Ошибка получения статуса ограничений: {e}")
             self.send_error(500)
 
-    # ==================== АДМИН ПАНЕЛЬ ====================
-
-    def serve_admin_page(self):
-        """Главная страница админки"""
-        if not check_admin_auth(self.headers.get('Cookie', '')):
-            self.redirect_to_admin_login()
+    @route('GET', '/metrics', cost=0, log_visit=False, maintenance_exempt=True)
+    def serve_metrics(self):
+        """Метрики в формате Prometheus"""
+        if self.client_ip not in METRICS_ALLOWED_IPS:
+            self.send_error(403)
             return
 
-        html = self.get_admin_page_content()
+        body = METRICS.render().encode('utf-8')
         self.send_response(200)
-        self.send_header('Content-type', 'text/html; charset=utf-8')
+        self.send_header('Content-type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
         self.end_headers()
-        self.wfile.write(html.encode('utf-8'))
+        self.wfile.write(body)
+
+    # ==================== АДМИН ПАНЕЛЬ ====================
+
+    @route('GET', '/admin', auth='page', cost=PAGE_COST, maintenance_exempt=True)
+    @route('GET', '/admin/', auth='page', cost=PAGE_COST, maintenance_exempt=True)
+    def serve_admin_page(self):
+        """Главная страница админки"""
+        self._send_html(self.get_admin_page_content())
 
+    @route('GET', '/admin/login', maintenance_exempt=True)
     def serve_admin_login_page(self):
         """Страница входа в админку"""
-        html = self.get_admin_login_page_content()
-        self.send_response(200)
-        self.send_header('Content-type', 'text/html; charset=utf-8')
-        self.end_headers()
-        self.wfile.write(html.encode('utf-8'))
+        self._send_html(self.get_admin_login_page_content())
 
+    @route('GET', '/admin/api/stats', auth='api', log_visit=False, maintenance_exempt=True)
     def serve_admin_api_stats(self):
         """API статистики для админки"""
-        if not check_admin_auth(self.headers.get('Cookie', '')):
-            self.send_error(403)
-            return
-
         stats = {
             'applications': get_extended_statistics(),
             'visits': get_visit_stats(),
             'services': {
                 'server': 'Запущен',
                 'server_port': SERVER_PORT,
-                'database': 'Работает'
+                'database': get_database_status()
             },
+            'middleware': MIDDLEWARE.get_stats(),
+            'rejected_bodies': get_body_rejections(),
+            'logging': get_logging_stats(),
+            'access_log': access_log.get_stats(),
+            'timings': phase_timings.summary(),
+            'sql': sql_trace.top(5)['statements'],
+            'heavy_hitters': heavy_hitters.get_stats(3),
+            'protection': adaptive_thresholds.get_stats(),
             'system': {
-                'active_sessions': len(admin_sessions),
+                'active_sessions': admin_sessions.count_active(),
+                'uptime_seconds': int(time.time() - process_start_time),
+                'memory_mb': round(get_process_memory_bytes() / 1024 / 1024, 1),
                 'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
             }
         }
-        self.send_response(200)
-        self.send_header('Content-type', 'application/json')
-        self.end_headers()
-        self.wfile.write(json.dumps(stats, default=str).encode('utf-8'))
+        self._send_json(stats)
 
+    @route('GET', '/admin/api/applications', auth='api', log_visit=False, maintenance_exempt=True)
     def serve_admin_applications(self):
         """API заявок для админки"""
-        if not check_admin_auth(self.headers.get('Cookie', '')):
-            self.send_error(403)
-            return
-
-        applications = get_all_applications()
-        self.send_response(200)
-        self.send_header('Content-type', 'application/json')
-        self.end_headers()
-        self.wfile.write(json.dumps({'applications': applications}, default=str).encode('utf-8'))
+        self._send_json({'applications': get_all_applications()})
 
+    @route('GET', '/admin/api/manual-blocks', auth='api', log_visit=False, maintenance_exempt=True)
     def serve_admin_manual_blocks(self):
-        """API блокировок для админки"""
-        if not check_admin_auth(self.headers.get('Cookie', '')):
-            self.send_error(403)
-            return
-
+        """API блокировок для админки; ?ip=адрес - какая блокировка его покрывает"""
         try:
-            blocks = get_manual_blocks()
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({'blocks': blocks}).encode('utf-8'))
+            ip_address = parse_qs(urlparse(self.path).query).get('ip', [None])[0]
+            if ip_address:
+                blocked, block_info = is_ip_manually_blocked(ip_address.strip())
+                self._send_json({'ip_address': ip_address, 'blocked': blocked, 'block': block_info})
+                return
+            self._send_json({'blocks': get_manual_blocks(), 'networks': manual_blocklist.count_networks()})
         except Exception as e:
             logger.error(f"Ошибка получения списка блокировок: {e}")
             self.send_error(500)
 
+    @route('POST', '/admin/api/login', cost=2, limit_class='write', log_visit=False, maintenance_exempt=True,
+           max_body=1024)
     def handle_admin_login(self):
         """Обработка входа в админку"""
         try:
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            data = json.loads(post_data.decode('utf-8'))
+            data = self.read_json()
+            if data is None:
+                return
 
             if data.get('password') == MANAGE_PASSWORD:
                 session_id = create_admin_session()
                 self.send_response(200)
-                self.send_header('Set-Cookie', f'admin_session={session_id}; Path=/; HttpOnly; Max-Age=3600')
+                self.send_header('Set-Cookie', f'admin_session={session_id}; Path=/; HttpOnly; Max-Age={ADMIN_SESSION_LIFETIME}')
                 self.send_header('Content-type', 'application/json')
                 self.end_headers()
                 self.wfile.write(json.dumps({'success': True}).encode())
@@ -2600,29 +5632,103 @@ class ClanRequestHandler(BaseHTTPRequestHandler):
             logger.error(f"Ошибка входа: {e}")
             self.send_error(500)
 
+    @route('GET', '/admin/api/sql-stats', auth='api', log_visit=False, maintenance_exempt=True)
+    def serve_admin_sql_stats(self):
+        """Самые затратные запросы SQLite по суммарному времени"""
+        try:
+            limit = int(parse_qs(urlparse(self.path).query).get('limit', ['20'])[0])
+        except ValueError:
+            limit = 20
+        self._send_json(sql_trace.top(max(1, min(limit, SQL_TRACE_MAX_STATEMENTS))))
+
+    @route('GET', '/admin/api/heavy-hitters', auth='api', log_visit=False, maintenance_exempt=True)
+    def serve_admin_heavy_hitters(self):
+        """Top-K значений по измерениям за текущее окно и последние всплески"""
+        try:
+            limit = int(parse_qs(urlparse(self.path).query).get('limit', ['10'])[0])
+        except ValueError:
+            limit = 10
+        self._send_json(heavy_hitters.get_stats(max(1, min(limit, HEAVY_HITTER_TOP_K))))
+
+    @route('GET', '/admin/api/profiler', auth='api', log_visit=False, maintenance_exempt=True)
+    def serve_admin_profiler(self):
+        """Состояние профилировщика и список сохраненных профилей"""
+        self._send_json(profiler.get_status())
+
+    @route('POST', '/admin/api/profiler/start', auth='api', log_visit=False, maintenance_exempt=True,
+           max_body=1024)
+    def handle_admin_profiler_start(self):
+        """Запуск профилирования на заданное число секунд"""
+        data = self.read_json()
+        if data is None:
+            return
+
+        try:
+            duration = int(data.get('seconds', 30))
+        except (TypeError, ValueError):
+            self._send_json({'success': False, 'message': 'Некорректная длительность'}, 400)
+            return
+        if not 1 <= duration <= PROFILER_MAX_DURATION:
+            self._send_json({'success': False, 'message': f'Длительность от 1 до {PROFILER_MAX_DURATION} секунд'}, 400)
+            return
+
+        if not profiler.start(duration):
+            self._send_json({'success': False, 'message': 'Профилирование уже запущено'}, 409)
+            return
+        self._send_json({'success': True})
+
+    @route('POST', '/admin/api/profiler/stop', auth='api', log_visit=False, maintenance_exempt=True,
+           max_body=1024)
+    def handle_admin_profiler_stop(self):
+        """Досрочная остановка профилирования"""
+        self._send_json({'success': profiler.stop()})
+
+    @route('GET', '/admin/api/profiler/download', auth='api', log_visit=False, maintenance_exempt=True)
+    def serve_admin_profiler_download(self):
+        """Скачивание файла профиля"""
+        name = parse_qs(urlparse(self.path).query).get('file', [''])[0]
+        # Отдаются только файлы из списка, произвольный путь не пройдет
+        if name not in profiler.list_files():
+            self.send_error(404)
+            return
+
+        try:
+            with open(os.path.join(PROFILER_DIR, name), 'rb') as f:
+                body = f.read()
+        except OSError as e:
+            logger.error(f"Ошибка чтения профиля {name}: {e}")
+            self.send_error(500)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Content-Disposition', f'attachment; filename="{name}"')
+        self.end_headers()
+        self.wfile.write(body)
+
+    @route('GET', '/admin/logout', maintenance_exempt=True)
     def handle_admin_logout(self):
         """Выход из админки"""
         cookie_header = self.headers.get('Cookie', '')
         cookies = parse_cookies(cookie_header)
         session_id = cookies.get('admin_session')
-        if session_id in admin_sessions:
-            del admin_sessions[session_id]
+        if session_id:
+            admin_sessions.revoke(session_id)
 
         self.send_response(302)
         self.send_header('Set-Cookie', 'admin_session=; Path=/; Expires=Thu, 01 Jan 1970 00:00:00 GMT')
         self.send_header('Location', '/admin/login')
         self.end_headers()
 
+    @route('POST', '/admin/api/manual-blocks/add', auth='api', log_visit=False, maintenance_exempt=True,
+           max_body=8 * 1024)
     def handle_admin_add_manual_block(self):
         """Добавление блокировки через админку"""
-        if not check_admin_auth(self.headers.get('Cookie', '')):
-            self.send_error(403)
-            return
-
         try:
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            data = json.loads(post_data.decode('utf-8'))
+            data = self.read_json()
+            if data is None:
+                return
 
             ip_address = data.get('ip_address')
             reason = data.get('block_reason')
@@ -2635,8 +5741,14 @@ class ClanRequestHandler(BaseHTTPRequestHandler):
                 self.wfile.write(json.dumps({'success': False, 'message': 'IP-адрес обязателен'}).encode())
                 return
 
+            try:
+                target = parse_block_target(ip_address)
+            except ValueError:
+                self._send_json({'success': False, 'message': 'Некорректный IP-адрес или подсеть'}, 400)
+                return
+
             blocked_by = "admin"
-            success = add_manual_block(ip_address, blocked_by, reason, int(expires_hours) if expires_hours else None)
+            success = add_manual_block(target, blocked_by, reason, int(expires_hours) if expires_hours else None)
 
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
@@ -2647,16 +5759,104 @@ class ClanRequestHandler(BaseHTTPRequestHandler):
             logger.error(f"Ошибка добавления ручной блокировки: {e}")
             self.send_error(500)
 
-    def handle_admin_remove_manual_block(self):
-        """Снятие блокировки через админку"""
-        if not check_admin_auth(self.headers.get('Cookie', '')):
-            self.send_error(403)
+    @route('POST', '/admin/api/manual-blocks/import', auth='api', cost=20, log_visit=False, maintenance_exempt=True,
+           max_body=BLOCKLIST_IMPORT_MAX_SIZE)
+    def handle_admin_import_manual_blocks(self):
+        """Массовый импорт блокировок: текст/CSV в теле или JSON {"path": ...} с локальным файлом"""
+        query = parse_qs(urlparse(self.path).query)
+        try:
+            reason = query.get('reason', [None])[0]
+            expires_hours = parse_expires_hours(query.get('expires_hours', [''])[0])
+        except ValueError:
+            self._send_json({'success': False, 'message': 'Некорректный срок блокировки'}, 400)
+            return
+
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            data = self.read_json()
+            if data is None:
+                return
+            try:
+                if data.get('expires_hours') is not None:
+                    expires_hours = parse_expires_hours(data['expires_hours'])
+            except ValueError:
+                self._send_json({'success': False, 'message': 'Некорректный срок блокировки'}, 400)
+                return
+            parser = BlocklistBodyParser(data.get('reason') or reason, expires_hours)
+            file_path = resolve_blocklist_path(data.get('path'))
+            if file_path is None:
+                self._send_json({'success': False,
+                                 'message': f'Укажите имя файла в каталоге {BLOCKLIST_IMPORT_DIR}'}, 400)
+                return
+            try:
+                with open(file_path, 'rb') as f:
+                    size = 0
+                    for chunk in iter(lambda: f.read(REQUEST_BODY_CHUNK_SIZE), b''):
+                        size += len(chunk)
+                        if size > BLOCKLIST_IMPORT_MAX_SIZE:
+                            raise RequestBodyError(413, 'too_large', f'Файл больше {BLOCKLIST_IMPORT_MAX_SIZE} байт')
+                        parser.feed(chunk)
+                parser.close()
+            except OSError:
+                self._send_json({'success': False, 'message': 'Не удалось прочитать файл'}, 400)
+                return
+            except RequestBodyError as e:
+                self._send_json({'success': False, 'message': str(e)}, e.status)
+                return
+        else:
+            parser = self._read_body_or_reject(BlocklistBodyParser(reason, expires_hours))
+            if parser is None:
+                return
+
+        try:
+            imported = bulk_add_manual_blocks(parser.entries, 'admin')
+        except ValueError:
+            self._send_json({'success': False, 'message': 'Некорректный срок блокировки'}, 400)
+            return
+        except Exception as e:
+            logger.error(f"Ошибка массового импорта блокировок: {e}")
+            self._send_json({'success': False, 'message': 'Ошибка базы данных'}, 500)
+            return
+
+        self._send_json({'success': True, 'imported': imported, 'invalid': parser.invalid,
+                         'invalid_lines': parser.invalid_lines})
+
+    @route('GET', '/admin/api/manual-blocks/export', auth='api', cost=10, log_visit=False, maintenance_exempt=True)
+    def serve_admin_export_manual_blocks(self):
+        """Потоковая выгрузка активных блокировок (?format=csv или txt)"""
+        export_format = parse_qs(urlparse(self.path).query).get('format', ['csv'])[0]
+        if export_format not in ('csv', 'txt'):
+            self.send_error(400)
             return
 
+        self.send_response(200)
+        self.send_header('Content-type', 'text/csv; charset=utf-8' if export_format == 'csv' else 'text/plain; charset=utf-8')
+        self.send_header('Content-Disposition', f'attachment; filename="manual_blocks.{export_format}"')
+        # Длина заранее неизвестна: конец ответа - закрытие соединения
+        self.close_connection = True
+        self.end_headers()
+
+        try:
+            if export_format == 'csv':
+                self.wfile.write(b'ip_address,reason,blocked_by,block_time,expires_at\n')
+            for rows in iter_manual_blocks():
+                if export_format == 'csv':
+                    buffer = io.StringIO()
+                    csv.writer(buffer, lineterminator='\n').writerows(rows)
+                    chunk = buffer.getvalue()
+                else:
+                    chunk = ''.join(row[0] + '\n' for row in rows)
+                self.wfile.write(chunk.encode('utf-8'))
+        except Exception as e:
+            logger.error(f"Ошибка выгрузки блокировок: {e}")
+
+    @route('POST', '/admin/api/manual-blocks/remove', auth='api', log_visit=False, maintenance_exempt=True,
+           max_body=1024)
+    def handle_admin_remove_manual_block(self):
+        """Снятие блокировки через админку"""
         try:
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
-            data = json.loads(post_data.decode('utf-8'))
+            data = self.read_json()
+            if data is None:
+                return
 
             ip_address = data.get('ip_address')
 
@@ -2667,7 +5867,12 @@ class ClanRequestHandler(BaseHTTPRequestHandler):
                 self.wfile.write(json.dumps({'success': False, 'message': 'IP-адрес обязателен'}).encode())
                 return
 
-            success = remove_manual_block(ip_address)
+            try:
+                target = parse_block_target(ip_address)
+            except ValueError:
+                # Старые записи могли сохраниться без проверки формата - снимаем как есть
+                target = ip_address
+            success = remove_manual_block(target)
 
             self.send_response(200)
             self.send_header('Content-type', 'application/json')
@@ -2768,6 +5973,7 @@ class ClanRequestHandler(BaseHTTPRequestHandler):
                     <button class="tablinks" onclick="openTab(event, 'Applications')">Заявки</button>
                     <button class="tablinks" onclick="openTab(event, 'IPBlocks')">Блокировка IP</button>
                     <button class="tablinks" onclick="openTab(event, 'Maintenance')">Тех. обслуживание</button>
+                    <button class="tablinks" onclick="openTab(event, 'Profiler')">Профилирование</button>
                 </div>
 
                 <div id="Dashboard" class="tabcontent" style="display: block;">
@@ -2797,8 +6003,8 @@ class ClanRequestHandler(BaseHTTPRequestHandler):
                         <h3>Добавить блокировку</h3>
                         <form id="blockIpForm">
                             <div class="form-group">
-                                <label for="ip_address">IP-адрес:</label>
-                                <input type="text" id="ip_address" name="ip_address" required placeholder="Например: 192.168.1.1">
+                                <label for="ip_address">IP-адрес или подсеть (CIDR):</label>
+                                <input type="text" id="ip_address" name="ip_address" required placeholder="Например: 192.168.1.1, 203.0.113.0/24 или 2001:db8::/64">
                             </div>
                             <div class="form-group">
                                 <label for="block_reason">Причина блокировки:</label>
@@ -2818,6 +6024,27 @@ class ClanRequestHandler(BaseHTTPRequestHandler):
                         </form>
                     </div>
 
+                    <div class="control-panel">
+                        <h3>Массовый импорт и выгрузка</h3>
+                        <p>По одному IP или подсети в строке, либо CSV: адрес,причина,срок в часах.</p>
+                        <div class="form-group">
+                            <label for="import_file">Файл со списком:</label>
+                            <input type="file" id="import_file" accept=".txt,.csv,text/plain,text/csv">
+                        </div>
+                        <div class="form-group">
+                            <label for="import_text">Или вставьте список:</label>
+                            <textarea id="import_text" rows="5" placeholder="203.0.113.7&#10;198.51.100.0/24,сканер,24"></textarea>
+                        </div>
+                        <div class="form-group">
+                            <label for="import_reason">Причина по умолчанию:</label>
+                            <input type="text" id="import_reason" placeholder="Например: атака 19.10">
+                        </div>
+                        <button class="btn btn-danger" onclick="importBlocklist()">Импортировать</button>
+                        <a class="btn btn-success" href="/admin/api/manual-blocks/export?format=csv">Выгрузить CSV</a>
+                        <a class="btn btn-success" href="/admin/api/manual-blocks/export?format=txt">Выгрузить список IP</a>
+                        <p id="importResult"></p>
+                    </div>
+
                     <div class="manual-blocks-list">
                         <h3>Активные блокировки</h3>
                         <div id="manualBlocksList">
@@ -2859,6 +6086,32 @@ class ClanRequestHandler(BaseHTTPRequestHandler):
                         </ul>
                     </div>
                 </div>
+
+                <div id="Profiler" class="tabcontent">
+                    <h2>Профилирование</h2>
+
+                    <div class="control-panel">
+                        <h3>Выборочный профилировщик</h3>
+                        <p>Снимает стеки всех потоков сервера без перезапуска, можно включать во время атаки.</p>
+                        <div class="form-group">
+                            <label for="profile_seconds">Длительность (секунды):</label>
+                            <input type="number" id="profile_seconds" value="30" min="1" max=""" + '"' + str(PROFILER_MAX_DURATION) + '"' + """>
+                        </div>
+                        <button class="btn btn-warning" onclick="startProfiler()">▶️ Запустить</button>
+                        <button class="btn btn-danger" onclick="stopProfiler()">⏹️ Остановить</button>
+                        <p id="profilerStatus"></p>
+                    </div>
+
+                    <div class="control-panel">
+                        <h3>Самые затратные функции (последний профиль)</h3>
+                        <div id="profilerTop"></div>
+                    </div>
+
+                    <div class="control-panel">
+                        <h3>Сохраненные профили</h3>
+                        <div id="profilerFiles"></div>
+                    </div>
+                </div>
             </div>
 
             <script>
@@ -2879,9 +6132,17 @@ class ClanRequestHandler(BaseHTTPRequestHandler):
                         loadApplications();
                     } else if (tabName === 'IPBlocks') {
                         loadManualBlocks();
+                    } else if (tabName === 'Profiler') {
+                        loadProfiler();
                     }
                 }
 
+                function escapeHtml(value) {
+                    return String(value).replace(/[&<>"']/g, ch => ({
+                        '&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'
+                    })[ch]);
+                }
+
                 function updateStats() {
                     fetch('/admin/api/stats')
                         .then(response => response.json())
@@ -2922,6 +6183,50 @@ class ClanRequestHandler(BaseHTTPRequestHandler):
                                     </div>
                                 </div>
 
+                                <div class="stat-card">
+                                    <h3>🧩 Конвейер запросов</h3>
+                                    <div style="max-height: 200px; overflow-y: auto;">
+                                        ${data.middleware.map(stage => `
+                                            <p><strong>${stage.name}:</strong> ${stage.avg_ms} мс, отклонено ${stage.rejections} из ${stage.calls}</p>
+                                        `).join('')}
+                                    </div>
+                                </div>
+                                <div class="stat-card">
+                                    <h3>⏱️ Фазы запроса (p50 / p95)</h3>
+                                    <div style="max-height: 200px; overflow-y: auto;">
+                                        ${Object.entries(data.timings).map(([phase, t]) => `
+                                            <p><strong>${phase}:</strong> ${t.p50_ms} / ${t.p95_ms} мс</p>
+                                        `).join('')}
+                                    </div>
+                                </div>
+                                <div class="stat-card">
+                                    <h3>🗄️ Затратные SQL-запросы</h3>
+                                    <div style="max-height: 200px; overflow-y: auto;">
+                                        ${data.sql.map(q => `
+                                            <p title="${escapeHtml(q.sql)}"><strong>${q.total_ms} мс</strong> (${q.count} × ${q.avg_ms} мс) ${q.database}: ${escapeHtml(q.sql.substring(0, 60))}</p>
+                                        `).join('')}
+                                    </div>
+                                </div>
+                                <div class="stat-card">
+                                    <h3>🛡️ Адаптивная защита</h3>
+                                    <p><strong>Уровень нагрузки:</strong> ${data.protection.level} (${data.protection.score})${data.protection.enabled ? '' : ' - не применяется'}</p>
+                                    <p>${data.protection.signals.rps} запросов/с, одновременно ${data.protection.signals.in_flight}, p95 ${data.protection.signals.p95_ms} мс</p>
+                                    <div style="border-top: 1px solid #444; margin: 10px 0; padding-top: 10px;">
+                                        <p><strong>DDoS-лимит:</strong> ${data.protection.effective.request_limit} в минуту, блокировка ${data.protection.effective.block_time} с</p>
+                                        ${Object.entries(data.protection.effective.classes).map(([name, c]) => `
+                                            <p><strong>${name}:</strong> бюджет ${c.budget} в минуту</p>
+                                        `).join('')}
+                                    </div>
+                                </div>
+                                <div class="stat-card">
+                                    <h3>📈 Всплески трафика</h3>
+                                    <p>За окно ${data.heavy_hitters.window_seconds} с: ${data.heavy_hitters.window_requests} запросов</p>
+                                    <div style="max-height: 200px; overflow-y: auto;">
+                                        ${data.heavy_hitters.alerts.length === 0 ? '<p>Всплесков не было</p>' : data.heavy_hitters.alerts.map(a => `
+                                            <p><strong>${a.time}</strong> ${escapeHtml(a.dimension)}: ${escapeHtml(a.value)} - ${a.estimate} запросов${a.action === 'block' ? ' (заблокировано)' : ''}</p>
+                                        `).join('')}
+                                    </div>
+                                </div>
                                 <div class="stat-card">
                                     <h3>⚙️ Система</h3>
                                     <p><strong>Сервер:</strong> <span class="status status-online">${data.services.server}</span></p>
@@ -3071,6 +6376,78 @@ class ClanRequestHandler(BaseHTTPRequestHandler):
                     }
                 }
 
+                async function importBlocklist() {
+                    const file = document.getElementById('import_file').files[0];
+                    const body = file ? await file.text() : document.getElementById('import_text').value;
+                    if (!body.trim()) {
+                        alert('Выберите файл или вставьте список');
+                        return;
+                    }
+
+                    const reason = document.getElementById('import_reason').value;
+                    const response = await fetch('/admin/api/manual-blocks/import?reason=' + encodeURIComponent(reason), {
+                        method: 'POST',
+                        headers: {
+                            'Content-Type': 'text/plain; charset=utf-8',
+                        },
+                        body: body
+                    });
+                    const data = await response.json();
+                    document.getElementById('importResult').innerHTML = data.success
+                        ? `Заблокировано: <strong>${data.imported}</strong>, некорректных строк: ${data.invalid}` +
+                          (data.invalid_lines.length ? `<br><small>Строки: ${data.invalid_lines.join(', ')}</small>` : '')
+                        : 'Ошибка импорта: ' + data.message;
+                    loadManualBlocks();
+                }
+
+                function loadProfiler() {
+                    fetch('/admin/api/profiler')
+                        .then(response => response.json())
+                        .then(data => {
+                            document.getElementById('profilerStatus').innerHTML = data.running
+                                ? `<span class="status status-offline">Идет профилирование, осталось ${data.remaining_seconds} с</span>`
+                                : `<span class="status status-online">Профилировщик остановлен</span>`;
+
+                            document.getElementById('profilerTop').innerHTML = data.last
+                                ? `<p>${data.last.name}: ${data.last.samples} выборок</p>` + data.last.top.map(entry => `
+                                    <p><strong>${entry.own_percent}%</strong> ${entry.function}</p>
+                                `).join('')
+                                : '<p>Профилей еще не было</p>';
+
+                            document.getElementById('profilerFiles').innerHTML = data.files.length
+                                ? data.files.map(name => `
+                                    <p><a href="/admin/api/profiler/download?file=${encodeURIComponent(name)}">${name}</a></p>
+                                `).join('')
+                                : '<p>Нет сохраненных профилей</p>';
+
+                            if (data.running) {
+                                setTimeout(loadProfiler, 2000);
+                            }
+                        });
+                }
+
+                function startProfiler() {
+                    fetch('/admin/api/profiler/start', {
+                        method: 'POST',
+                        headers: {
+                            'Content-Type': 'application/json',
+                        },
+                        body: JSON.stringify({ seconds: document.getElementById('profile_seconds').value })
+                    })
+                    .then(response => response.json())
+                    .then(data => {
+                        if (!data.success) {
+                            alert('Ошибка запуска профилирования: ' + data.message);
+                        }
+                        loadProfiler();
+                    });
+                }
+
+                function stopProfiler() {
+                    fetch('/admin/api/profiler/stop', { method: 'POST' })
+                        .then(() => loadProfiler());
+                }
+
                 // Обработчик формы блокировки IP
                 document.getElementById('blockIpForm').addEventListener('submit', function(e) {
                     e.preventDefault();
@@ -3249,7 +6626,7 @@ class ClanRequestHandler(BaseHTTPRequestHandler):
         """
 
     def log_message(self, format, *args):
-        logger.info("%s - %s" % (self.client_address[0], format % args))
+        logger.info("%s - %s" % (self.client_ip, format % args))
 
 
 # ==================== ЗАПУСК СЕРВИСОВ ====================
@@ -3258,9 +6635,19 @@ def run_server():
     """Запуск веб-сервера"""
     global server_httpd
     try:
-        server_address = ('', SERVER_PORT)
-        server_httpd = HTTPServer(server_address, ClanRequestHandler)
-        logger.info(f"Сервер запущен на порту {SERVER_PORT}")
+        MIDDLEWARE.configure(MIDDLEWARE_ORDER)
+        trusted_proxies.configure(TRUSTED_PROXIES)
+        protection_allowlist.configure(PROTECTION_ALLOWLIST)
+        if SERVER_UNIX_SOCKET:
+            server_httpd = ThreadingUnixHTTPServer(SERVER_UNIX_SOCKET, ClanRequestHandler)
+            logger.info(f"Сервер запущен на Unix-сокете {SERVER_UNIX_SOCKET}")
+        else:
+            server_address = ('', SERVER_PORT)
+            server_httpd = ThreadingHTTPServer(server_address, ClanRequestHandler)
+            logger.info(f"Сервер запущен на порту {SERVER_PORT}")
+        if TRUSTED_PROXIES:
+            logger.info(f"Доверенные прокси: {', '.join(trusted_proxies.entries)}, адрес клиента из {PROXY_CLIENT_IP_HEADER}"
+                        f"{' и PROXY protocol' if PROXY_PROTOCOL else ''}")
         logger.info(f"Админка доступна по адресу: http://localhost:{SERVER_PORT}/admin")
         logger.info(f"Пароль для входа в админку: {MANAGE_PASSWORD}")
         logger.info(f"Режим обслуживания: {'ВКЛЮЧЕН' if MAINTENANCE_MODE else 'ВЫКЛЮЧЕН'}")
@@ -3273,6 +6660,7 @@ def run_server():
 
 def main():
     """Главная функция"""
+    setup_logging()
     print("Запуск системы управления кланом BENZ...")
     print("=" * 50)
 
@@ -3282,6 +6670,20 @@ def main():
     # Загрузка режима обслуживания
     load_maintenance_mode()
 
+    # Структурированный журнал доступа
+    if ACCESS_LOG_ENABLED:
+        access_log.start()
+
+    # Сводки подавленных предупреждений о блокировках
+    block_log.start_flusher()
+
+    # Восстановление сессий администратора и фоновая очистка просроченных
+    admin_sessions.load()
+    admin_sessions.start_sweeper(ADMIN_SESSION_SWEEP_INTERVAL)
+
+    # Заполнение локального кэша галереи в фоне
+    threading.Thread(target=prefetch_gallery_images, daemon=True).start()
+
     print("Сервер клана запущен")
     print(f"Админка доступна по адресу: http://localhost:{SERVER_PORT}/admin")
     print(f"Пароль для входа: {MANAGE_PASSWORD}")
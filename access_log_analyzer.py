@@ -0,0 +1,220 @@
+"""Потоковый анализ структурированного журнала доступа (access_logs/*.ndjson[.gz])
+
+Память постоянна независимо от объема журнала: топ IP считается алгоритмом
+Space-Saving с фиксированным числом счетчиков, перцентили задержки -
+по гистограмме с логарифмическими корзинами.
+
+Пример:
+    python access_log_analyzer.py access_logs --top 20
+    python access_log_analyzer.py access_logs/access-20261019-14.ndjson.gz --json
+"""
+import argparse
+import gzip
+import heapq
+import itertools
+import json
+import math
+import os
+import sys
+import zlib
+
+
+class SpaceSaving:
+    """Приближенный топ-K частых элементов в фиксированной памяти (Metwally et al.)
+
+    Минимальный счетчик ищется по min-куче с ленивым обновлением: увеличение
+    счетчика кучу не трогает, устаревшая запись перекладывается при извлечении.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counters = {}  # элемент -> [счетчик, ошибка]
+        self.heap = []  # (счетчик на момент вставки, порядковый номер, элемент)
+        self.sequence = itertools.count()
+
+    def add(self, item):
+        counter = self.counters.get(item)
+        if counter is not None:
+            counter[0] += 1
+            return
+        if len(self.counters) < self.capacity:
+            self.counters[item] = [1, 0]
+            heapq.heappush(self.heap, (1, next(self.sequence), item))
+            return
+
+        while True:
+            count, _, victim = self.heap[0]
+            current = self.counters[victim][0]
+            if current == count:
+                break
+            heapq.heapreplace(self.heap, (current, next(self.sequence), victim))
+
+        # Вытесняем элемент с минимальным счетчиком, новый наследует его значение как ошибку
+        heapq.heappop(self.heap)
+        minimum = self.counters.pop(victim)[0]
+        self.counters[item] = [minimum + 1, minimum]
+        heapq.heappush(self.heap, (minimum + 1, next(self.sequence), item))
+
+    def top(self, n):
+        items = sorted(self.counters.items(), key=lambda item: item[1][0], reverse=True)
+        return [(item, count, error) for item, (count, error) in items[:n]]
+
+
+class LatencyHistogram:
+    """Гистограмма задержек с логарифмическими корзинами (шаг ~5%)"""
+
+    GROWTH = 1.05
+    MIN_MS = 0.01
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def add(self, value_ms):
+        self.count += 1
+        self.total += value_ms
+        if value_ms > self.maximum:
+            self.maximum = value_ms
+        index = 0 if value_ms <= self.MIN_MS else int(math.log(value_ms / self.MIN_MS, self.GROWTH)) + 1
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+
+    def percentile(self, p):
+        if not self.count:
+            return 0.0
+        rank = p / 100 * self.count
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                # Верхняя граница корзины
+                return min(self.MIN_MS * self.GROWTH ** index, self.maximum)
+        return self.maximum
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'avg_ms': round(self.total / self.count, 3) if self.count else 0,
+            'p50_ms': round(self.percentile(50), 3),
+            'p95_ms': round(self.percentile(95), 3),
+            'p99_ms': round(self.percentile(99), 3),
+            'max_ms': round(self.maximum, 3)
+        }
+
+
+def iter_log_files(paths):
+    """Файлы журнала по путям (каталоги раскрываются, сегменты по порядку)"""
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith('.ndjson') or name.endswith('.ndjson.gz'):
+                    yield os.path.join(path, name)
+        else:
+            yield path
+
+
+def iter_records(paths):
+    """Потоковое чтение записей, битые строки пропускаются
+
+    Обрезанный .gz (например, сегмент, сжатие которого прервал перезапуск)
+    читается до места повреждения, анализ продолжается со следующего файла.
+    """
+    for path in iter_log_files(paths):
+        opener = gzip.open if path.endswith('.gz') else open
+        try:
+            with opener(path, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        continue
+        except (EOFError, gzip.BadGzipFile, zlib.error) as e:
+            print(f"Файл {path} поврежден, прочитан до ошибки: {e}", file=sys.stderr)
+
+
+def analyze(paths, top_capacity=1000, max_routes=200):
+    """Агрегация журнала: топ IP, распределение статусов и решений защиты, задержки по маршрутам"""
+    top_ips = SpaceSaving(top_capacity)
+    statuses = {}
+    decisions = {}
+    overall = LatencyHistogram()
+    routes = {}
+    total_bytes = 0
+    first_ts = last_ts = None
+
+    for record in iter_records(paths):
+        top_ips.add(record.get('ip'))
+        status = str(record.get('st'))
+        statuses[status] = statuses.get(status, 0) + 1
+        decision = str(record.get('dec'))
+        decisions[decision] = decisions.get(decision, 0) + 1
+        total_bytes += record.get('b') or 0
+
+        latency = record.get('lat') or 0.0
+        overall.add(latency)
+        # Неизвестные пути сводятся в один ключ, чтобы число маршрутов было ограничено
+        route = record.get('route') or '(404)'
+        histogram = routes.get(route)
+        if histogram is None:
+            if len(routes) >= max_routes:
+                route = '(другие)'
+                histogram = routes.setdefault(route, LatencyHistogram())
+            else:
+                histogram = routes[route] = LatencyHistogram()
+        histogram.add(latency)
+
+        ts = record.get('ts')
+        if ts is not None:
+            first_ts = ts if first_ts is None else min(first_ts, ts)
+            last_ts = ts if last_ts is None else max(last_ts, ts)
+
+    return {
+        'requests': overall.count,
+        'bytes': total_bytes,
+        'first_ts': first_ts,
+        'last_ts': last_ts,
+        'top_ips': top_ips,
+        'statuses': statuses,
+        'decisions': decisions,
+        'latency': overall.summary(),
+        'routes': {route: histogram.summary() for route, histogram in routes.items()}
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Анализ структурированного журнала доступа')
+    parser.add_argument('paths', nargs='+', help='Файлы сегментов или каталоги журнала')
+    parser.add_argument('--top', type=int, default=10, help='Сколько IP показать')
+    parser.add_argument('--capacity', type=int, default=1000, help='Число счетчиков Space-Saving')
+    parser.add_argument('--json', action='store_true', help='Вывод в JSON')
+    args = parser.parse_args(argv)
+
+    result = analyze(args.paths, top_capacity=args.capacity)
+    top_ips = [{'ip': ip, 'count': count, 'max_error': error} for ip, count, error in result['top_ips'].top(args.top)]
+
+    if args.json:
+        result['top_ips'] = top_ips
+        json.dump(result, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+        return
+
+    print(f"Запросов: {result['requests']:,}, отправлено байт: {result['bytes']:,}")
+    print(f"Задержка: {result['latency']}")
+    print("\nТоп IP:")
+    for entry in top_ips:
+        print(f"  {str(entry['ip']):<40} {entry['count']:>10,}  (погрешность до {entry['max_error']:,})")
+    print("\nСтатусы:")
+    for status, count in sorted(result['statuses'].items()):
+        print(f"  {status:<6} {count:>10,}")
+    print("\nРешения защиты:")
+    for decision, count in sorted(result['decisions'].items(), key=lambda item: -item[1]):
+        print(f"  {decision:<14} {count:>10,}")
+    print("\nМаршруты:")
+    for route, summary in sorted(result['routes'].items(), key=lambda item: -item[1]['count']):
+        print(f"  {route:<36} n={summary['count']:<8,} p50={summary['p50_ms']} p95={summary['p95_ms']} "
+              f"p99={summary['p99_ms']} max={summary['max_ms']} мс")
+
+
+if __name__ == '__main__':
+    main()
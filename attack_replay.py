@@ -0,0 +1,304 @@
+"""Воспроизведение синтетических атак против защиты сайта
+
+Для каждого сценария поднимается чистый сервер (см. load_benchmark.py),
+атакующие и обычные клиенты ходят с разных адресов 127.x.y.z. По итогам
+считается, как быстро блокируются атакующие, сколько запросов обычных
+посетителей отклонено по ошибке, сколько процессорного времени сервера
+уходит на один отклоненный запрос и насколько выросли request_logs и ip_blocks.
+
+Пример:
+    python attack_replay.py --duration 20 --output attacks.json
+    python attack_replay.py --patterns flood,mixed --baseline attacks.json
+"""
+import argparse
+import heapq
+import http.client
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import sys
+import threading
+import time
+
+from load_benchmark import check_source_addresses, client_ips, free_port, percentile, start_server
+
+REJECTED_STATUSES = (403, 408, 429)
+
+
+class Actor:
+    """Источник запросов: IP, роль и расписание (пачка из burst запросов раз в interval секунд)"""
+
+    def __init__(self, ip, role, interval, burst=1, path='/'):
+        self.ip = ip
+        self.role = role
+        self.interval = interval
+        self.burst = burst
+        self.path = path
+        self.first_request = None
+        self.first_rejection = None
+        self.requests = 0
+        self.rejected = 0
+
+
+def build_pattern(name, ips, clients):
+    """Участники сценария; пул адресов делится между ролями без пересечений"""
+    pool = iter(ips)
+    if name == 'flood':
+        # Один IP, запросы без пауз со всех рабочих потоков
+        attacker = next(pool)
+        return [Actor(attacker, 'attack', 0) for _ in range(clients)], []
+    if name == 'spray':
+        # Много IP, каждый чуть ниже лимита посещений (10 запросов в минуту)
+        return [Actor(next(pool), 'attack', 6) for _ in range(min(500, len(ips)))], []
+    if name == 'crawler':
+        # Краулеры: пачка из 20 запросов раз в 10 секунд
+        return [Actor(next(pool), 'attack', 10, burst=20) for _ in range(20)], []
+    if name == 'slow_body':
+        # Медленная передача тела POST занимает рабочие потоки, обычные посетители рядом
+        slow = [Actor(next(pool), 'attack', 0, path='/submit_application') for _ in range(clients)]
+        legit = [Actor(next(pool), 'legit', 10) for _ in range(50)]
+        return legit, slow
+    if name == 'mixed':
+        legit = [Actor(next(pool), 'legit', 10) for _ in range(100)]
+        flood = [Actor(next(pool), 'attack', 0) for _ in range(5)]
+        spray = [Actor(next(pool), 'attack', 6) for _ in range(200)]
+        return legit + flood + spray, []
+    raise ValueError(f"Неизвестный сценарий: {name}")
+
+
+def send_request(host, port, actor, timeout):
+    connection = http.client.HTTPConnection(host, port, timeout=timeout,
+                                            source_address=(actor.ip, 0) if actor.ip else None)
+    try:
+        connection.request('GET', actor.path, headers={'User-Agent': f'attack-replay/{actor.role}'})
+        response = connection.getresponse()
+        response.read()
+        return response.status
+    finally:
+        connection.close()
+
+
+def send_slow_body(host, port, actor, deadline, timeout):
+    """POST с Content-Length, тело передается по байту в секунду до ответа сервера"""
+    sock = socket.create_connection((host, port), timeout=timeout,
+                                    source_address=(actor.ip, 0) if actor.ip else None)
+    try:
+        sock.sendall(b"POST /submit_application HTTP/1.1\r\nHost: bench\r\n"
+                     b"Content-Type: application/x-www-form-urlencoded\r\nContent-Length: 4096\r\n\r\n")
+        sock.settimeout(1.0)
+        while time.monotonic() < deadline:
+            try:
+                data = sock.recv(64)
+                if not data:
+                    return 0
+                return int(data.split(b' ', 2)[1])
+            except socket.timeout:
+                sock.sendall(b'a')
+        return 0
+    except (OSError, ValueError, IndexError):
+        return 0
+    finally:
+        sock.close()
+
+
+def read_cpu_seconds(pid):
+    """Процессорное время процесса (user + system) из /proc; None вне Linux"""
+    try:
+        with open(f'/proc/{pid}/stat', 'r') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def count_rows(workdir):
+    try:
+        conn = sqlite3.connect(os.path.join(workdir, 'ddos_protection.db'))
+        counts = {table: conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+                  for table in ('request_logs', 'ip_blocks')}
+        conn.close()
+        return counts
+    except sqlite3.Error:
+        return {'request_logs': None, 'ip_blocks': None}
+
+
+def run_pattern(name, ips, duration, clients, timeout):
+    """Прогон одного сценария против свежего сервера"""
+    actors, slow_actors = build_pattern(name, ips, clients)
+    port = free_port()
+    process, workdir = start_server(port)
+    host = '127.0.0.1'
+    latencies = {'attack': [], 'legit': []}
+    lock = threading.Lock()
+    started = time.monotonic()
+    deadline = started + duration
+    cpu_before = read_cpu_seconds(process.pid)
+
+    # Расписание: куча (время следующей пачки, номер участника)
+    schedule = [(started + (i % 10) * 0.1, i) for i in range(len(actors))]
+    heapq.heapify(schedule)
+    schedule_lock = threading.Lock()
+
+    def record(actor, status, latency):
+        now = time.monotonic()
+        with lock:
+            if actor.first_request is None:
+                actor.first_request = now - latency
+            actor.requests += 1
+            latencies[actor.role].append(latency)
+            if status in REJECTED_STATUSES:
+                actor.rejected += 1
+                if actor.first_rejection is None:
+                    actor.first_rejection = now
+
+    def worker():
+        while True:
+            with schedule_lock:
+                if not schedule:
+                    return
+                due, index = heapq.heappop(schedule)
+            if due >= deadline:
+                return
+            wait = due - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            actor = actors[index]
+            for _ in range(actor.burst):
+                start = time.perf_counter()
+                try:
+                    status = send_request(host, port, actor, timeout)
+                except (OSError, http.client.HTTPException):
+                    status = 0
+                record(actor, status, time.perf_counter() - start)
+            with schedule_lock:
+                heapq.heappush(schedule, (max(due + actor.interval, time.monotonic()), index))
+
+    def slow_worker(actor):
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            status = send_slow_body(host, port, actor, deadline, timeout)
+            if status:
+                record(actor, status, time.perf_counter() - start)
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(clients)]
+    threads += [threading.Thread(target=slow_worker, args=(actor,), daemon=True) for actor in slow_actors]
+    try:
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(duration + timeout + 5)
+        cpu_after = read_cpu_seconds(process.pid)
+        rows = count_rows(workdir)
+    finally:
+        process.terminate()
+        process.wait()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return summarize(name, actors + slow_actors, latencies, rows, cpu_before, cpu_after, time.monotonic() - started)
+
+
+def summarize(name, actors, latencies, rows, cpu_before, cpu_after, elapsed):
+    # Несколько потоков flood-сценария - это один IP, объединяем по адресу
+    by_ip = {}
+    for actor in actors:
+        entry = by_ip.setdefault((actor.ip, actor.role), {'requests': 0, 'rejected': 0, 'first': None, 'blocked': None})
+        entry['requests'] += actor.requests
+        entry['rejected'] += actor.rejected
+        for key, value in (('first', actor.first_request), ('blocked', actor.first_rejection)):
+            if value is not None and (entry[key] is None or value < entry[key]):
+                entry[key] = value
+
+    attackers = [entry for (ip, role), entry in by_ip.items() if role == 'attack' and entry['requests']]
+    legit = [entry for (ip, role), entry in by_ip.items() if role == 'legit']
+    times_to_block = sorted(entry['blocked'] - entry['first'] for entry in attackers if entry['blocked'] is not None)
+    legit_requests = sum(entry['requests'] for entry in legit)
+    legit_rejected = sum(entry['rejected'] for entry in legit)
+    total_requests = sum(entry['requests'] for entry in by_ip.values())
+    rejected = sum(entry['rejected'] for entry in by_ip.values())
+    cpu = cpu_after - cpu_before if cpu_before is not None and cpu_after is not None else None
+    legit_latency = sorted(latencies['legit'])
+
+    return {
+        'pattern': name,
+        'duration': round(elapsed, 2),
+        'requests': total_requests,
+        'rejected': rejected,
+        'attackers': len(attackers),
+        'attackers_blocked': len(times_to_block),
+        'time_to_block_p50_s': round(percentile(times_to_block, 50), 3) if times_to_block else None,
+        'time_to_block_max_s': round(times_to_block[-1], 3) if times_to_block else None,
+        'legit_requests': legit_requests,
+        'false_positive_rate': round(legit_rejected / legit_requests, 4) if legit_requests else None,
+        'legit_p95_ms': round(percentile(legit_latency, 95) * 1000, 3) if legit_latency else None,
+        'server_cpu_s': round(cpu, 3) if cpu is not None else None,
+        'cpu_per_request_ms': round(cpu * 1000 / total_requests, 4) if cpu is not None and total_requests else None,
+        'cpu_per_rejected_ms': round(cpu * 1000 / rejected, 4) if cpu is not None and rejected else None,
+        'request_logs_rows': rows['request_logs'],
+        'ip_blocks_rows': rows['ip_blocks']
+    }
+
+
+COMPARED_FIELDS = ('time_to_block_p50_s', 'false_positive_rate', 'cpu_per_rejected_ms', 'request_logs_rows', 'ip_blocks_rows')
+
+
+def print_comparison(results, baseline):
+    """Изменения относительно сохраненного прогона (меньше - лучше для всех полей)"""
+    previous = {result['pattern']: result for result in baseline.get('patterns', [])}
+    print("\nСравнение с базовым прогоном:")
+    for result in results:
+        before = previous.get(result['pattern'])
+        if not before:
+            continue
+        changes = []
+        for field in COMPARED_FIELDS:
+            old, new = before.get(field), result.get(field)
+            if old is None or new is None or old == new:
+                continue
+            change = f"{(new - old) / old * 100:+.0f}%" if old else "новое"
+            changes.append(f"{field}: {old} -> {new} ({change})")
+        print(f"  {result['pattern']}: " + ('; '.join(changes) if changes else 'без изменений'))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Воспроизведение атак против защиты сайта')
+    parser.add_argument('--patterns', default='flood,spray,crawler,slow_body,mixed',
+                        help='Сценарии через запятую: flood, spray, crawler, slow_body, mixed')
+    parser.add_argument('--duration', type=float, default=20, help='Длительность каждого сценария (секунды)')
+    parser.add_argument('--clients', type=int, default=16, help='Число рабочих потоков нагрузки')
+    parser.add_argument('--timeout', type=float, default=15, help='Таймаут одного запроса')
+    parser.add_argument('--output', help='Сохранить результат в JSON')
+    parser.add_argument('--baseline', help='Сравнить с сохраненным результатом')
+    args = parser.parse_args(argv)
+
+    ips = check_source_addresses(client_ips(2000))
+    if ips == [None]:
+        print("Без отдельных адресов клиентов сценарии с несколькими IP не имеют смысла", file=sys.stderr)
+        sys.exit(1)
+
+    results = []
+    for name in args.patterns.split(','):
+        print(f"Сценарий {name}...", flush=True)
+        results.append(run_pattern(name.strip(), ips, args.duration, args.clients, args.timeout))
+
+    print(f"\n{'сценарий':<10} {'запросов':>9} {'откл.':>7} {'блок/атак':>10} {'до блок.':>9} "
+          f"{'ложн.':>7} {'CPU/откл':>9} {'logs':>7} {'blocks':>7}")
+    for r in results:
+        print(f"{r['pattern']:<10} {r['requests']:>9,} {r['rejected']:>7,} "
+              f"{r['attackers_blocked']:>4}/{r['attackers']:<5} {str(r['time_to_block_p50_s']):>9} "
+              f"{str(r['false_positive_rate']):>7} {str(r['cpu_per_rejected_ms']):>9} "
+              f"{str(r['request_logs_rows']):>7} {str(r['ip_blocks_rows']):>7}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'patterns': results, 'config': vars(args)}, f, ensure_ascii=False, indent=2)
+        print(f"\nРезультат сохранен в {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            print_comparison(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,259 @@
+"""Микробенчмарки функций работы с данными на заполненных базах разного объема
+
+Для каждого объема (по умолчанию 1k, 100k и 1M строк) создается временный
+каталог, генератор заполняет visits, request_logs, ip_blocks, manual_blocks
+и applications правдоподобными данными, после чего каждая функция
+вызывается повторно, пока не наберется --min-time секунд и --min-rounds
+повторов. Результат - таблица min/median/mean/ops в духе pytest-benchmark.
+
+Пример:
+    python data_benchmark.py --sizes 1000,100000 --output data-bench.json
+    python data_benchmark.py --functions check_visit_limit,get_visit_stats --sizes 1000000
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+ROLES = ('Фермер', 'Строитель', 'Боец', 'Коллер', 'Универсал')
+PATHS = ('/', '/zayavka', '/statistics', '/gallery-images', '/applications', '/rate-limit-status')
+USER_AGENTS = (
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/126.0 Safari/537.36',
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 17_5 like Mac OS X) AppleWebKit/605.1.15 Mobile/15E148 Safari/604.1',
+    'Mozilla/5.0 (X11; Linux x86_64; rv:127.0) Gecko/20100101 Firefox/127.0',
+    'python-requests/2.32.3',
+    'curl/8.7.1'
+)
+
+
+class DataGenerator:
+    """Генератор данных: IP распределены по Ципфу (немного частых адресов и длинный хвост)"""
+
+    def __init__(self, size, seed=42):
+        self.size = size
+        self.rng = random.Random(seed)
+        self.ip_pool = [self.random_ip() for _ in range(max(10, size // 20))]
+        self.blocked = []  # Цели ручных блокировок, заполняет manual_blocks()
+        weights = [1 / (rank + 1) for rank in range(len(self.ip_pool))]
+        total = sum(weights)
+        self.cumulative = []
+        acc = 0.0
+        for weight in weights:
+            acc += weight / total
+            self.cumulative.append(acc)
+
+    def random_ip(self):
+        if self.rng.random() < 0.1:
+            return '2001:db8:%x:%x::%x' % (self.rng.getrandbits(16), self.rng.getrandbits(16), self.rng.getrandbits(16))
+        return '%d.%d.%d.%d' % (self.rng.randint(1, 223), self.rng.getrandbits(8), self.rng.getrandbits(8),
+                                self.rng.randint(1, 254))
+
+    def ip(self):
+        index = min(len(self.ip_pool) - 1, self._bisect(self.rng.random()))
+        return self.ip_pool[index]
+
+    def _bisect(self, value):
+        low, high = 0, len(self.cumulative)
+        while low < high:
+            middle = (low + high) // 2
+            if self.cumulative[middle] < value:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def visits(self):
+        """Посещения за последние 30 дней (время UTC, как CURRENT_TIMESTAMP)"""
+        now = datetime.utcnow()
+        for _ in range(self.size):
+            moment = now - timedelta(seconds=self.rng.randrange(30 * 86400))
+            yield (self.ip(), self.rng.choice(USER_AGENTS), moment.strftime('%Y-%m-%d %H:%M:%S'),
+                   self.rng.choice(PATHS))
+
+    def request_logs(self, key):
+        """Журнал запросов защиты за последние 2 минуты (то, что переживает cleanup_old_logs)
+
+        key - функция адрес -> целочисленный ключ подсети (site.rate_limit_key).
+        """
+        now = datetime.now()
+        for _ in range(self.size):
+            moment = now - timedelta(milliseconds=self.rng.randrange(120000))
+            yield key(self.ip())[0], moment.isoformat(), self.rng.choice(PATHS)
+
+    def ip_blocks(self, key):
+        now = datetime.now()
+        for ip in self.ip_pool:
+            blocked = self.rng.random() < 0.05
+            yield (key(ip)[1], (now - timedelta(seconds=self.rng.randrange(120))).isoformat(), self.rng.randint(1, 14),
+                   blocked, 'visit_limit' if blocked else 'normal')
+
+    def manual_blocks(self):
+        """Блокировки: половина - адреса из пула посетителей, половина - посторонние"""
+        now = datetime.now()
+        count = max(1, self.size // 1000)
+        self.blocked = self.rng.sample(self.ip_pool, min(len(self.ip_pool), (count + 1) // 2))
+        self.blocked += [self.random_ip() for _ in range(count - len(self.blocked))]
+        for ip in self.blocked:
+            expires = (now + timedelta(hours=self.rng.choice((1, 24, 168)))).isoformat() if self.rng.random() < 0.7 else None
+            yield ip, 'admin', 'Сгенерировано для бенчмарка', expires
+
+    def lookup_ip(self):
+        """Адрес для проверки блокировки: каждый пятый - из заблокированных"""
+        if self.blocked and self.rng.random() < 0.2:
+            return self.rng.choice(self.blocked)
+        return self.ip()
+
+    def applications(self):
+        now = datetime.utcnow()
+        for index in range(self.size):
+            moment = now - timedelta(seconds=self.rng.randrange(365 * 86400))
+            yield (f'player{index}', str(76561198000000000 + self.rng.getrandbits(30)), self.rng.randint(1500, 12000),
+                   f'player{index}#{self.rng.randint(1000, 9999)}', self.rng.choice(ROLES),
+                   'Хочу в клан, играю каждый день', self.ip(), moment.strftime('%Y-%m-%d %H:%M:%S'),
+                   self.rng.choice(('new', 'new', 'new', 'accepted', 'rejected')))
+
+    def application(self):
+        return {
+            'nickname': f'bench{self.rng.getrandbits(20)}',
+            'steamId': str(76561198000000000 + self.rng.getrandbits(30)),
+            'playtime': str(self.rng.randint(1500, 12000)),
+            'discord': 'bench#0001',
+            'role': self.rng.choice(ROLES),
+            'message': 'Нагрузочный тест',
+            'ip': self.random_ip()
+        }
+
+
+def seed_databases(site, generator):
+    """Заполнение баз одной транзакцией на таблицу"""
+    with sqlite3.connect(site.visits_db) as conn:
+        conn.executemany('INSERT INTO visits (ip_address, user_agent, timestamp, path) VALUES (?, ?, ?, ?)',
+                         generator.visits())
+    with sqlite3.connect(site.ddos_protection_db) as conn:
+        conn.executemany('INSERT INTO request_logs (ip_key, timestamp, path) VALUES (?, ?, ?)',
+                         generator.request_logs(site.rate_limit_key))
+        conn.executemany('INSERT OR REPLACE INTO ip_blocks (ip_address, block_start_time, request_count, is_blocked, '
+                         'block_reason, is_manual_block) VALUES (?, ?, ?, ?, ?, FALSE)', generator.ip_blocks(site.rate_limit_key))
+        conn.executemany('INSERT INTO manual_blocks (ip_address, blocked_by, block_reason, expires_at) '
+                         'VALUES (?, ?, ?, ?)', generator.manual_blocks())
+    with sqlite3.connect(site.DATABASE_NAME) as conn:
+        conn.executemany('INSERT INTO applications (nickname, steam_id, playtime, discord, role, message, '
+                         'ip_address, timestamp, status) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', generator.applications())
+    # Ручные блокировки проверяются по словарю в памяти, он читается из базы только при загрузке
+    site.manual_blocklist.load()
+
+
+BENCHMARK_FUNCTIONS = ('check_visit_limit', 'is_ip_manually_blocked', 'save_visit', 'save_application',
+                       'get_visit_stats', 'get_extended_statistics', 'get_all_applications')
+
+
+def benchmark_cases(site, generator):
+    """Функция -> вызов с правдоподобными аргументами"""
+    return {
+        'check_visit_limit': lambda: site.check_visit_limit(generator.ip(), '/'),
+        'is_ip_manually_blocked': lambda: site.is_ip_manually_blocked(generator.lookup_ip()),
+        'save_visit': lambda: site.save_visit(generator.ip(), USER_AGENTS[0], '/'),
+        'save_application': lambda: site.save_application(generator.application()),
+        'get_visit_stats': site.get_visit_stats,
+        'get_extended_statistics': site.get_extended_statistics,
+        'get_all_applications': site.get_all_applications
+    }
+
+
+def measure(call, min_rounds, min_time, max_rounds):
+    """Повторные вызовы до min_rounds и min_time; секунды на вызов"""
+    timings = []
+    started = time.perf_counter()
+    while len(timings) < max_rounds and (len(timings) < min_rounds or time.perf_counter() - started < min_time):
+        start = time.perf_counter()
+        call()
+        timings.append(time.perf_counter() - start)
+    return {
+        'rounds': len(timings),
+        'min_ms': round(min(timings) * 1000, 4),
+        'median_ms': round(statistics.median(timings) * 1000, 4),
+        'mean_ms': round(statistics.fmean(timings) * 1000, 4),
+        'stddev_ms': round(statistics.pstdev(timings) * 1000, 4),
+        'max_ms': round(max(timings) * 1000, 4),
+        'ops': round(1 / statistics.fmean(timings), 1)
+    }
+
+
+def run_size(site, size, functions, args, basedir):
+    """Бенчмарки на свежих базах заданного объема"""
+    workdir = os.path.join(basedir, f'size-{size}')
+    os.makedirs(workdir)
+    site.DATABASE_NAME = os.path.join(workdir, 'clan_benz.db')
+    site.visits_db = os.path.join(workdir, 'visits.db')
+    site.ddos_protection_db = os.path.join(workdir, 'ddos_protection.db')
+    site.init_databases()
+
+    generator = DataGenerator(size, args.seed)
+    started = time.perf_counter()
+    seed_databases(site, generator)
+    print(f"Объем {size:,}: базы заполнены за {time.perf_counter() - started:.1f} с", flush=True)
+
+    cases = benchmark_cases(site, generator)
+    results = {}
+    for name in functions:
+        results[name] = measure(cases[name], args.min_rounds, args.min_time, args.max_rounds)
+        print(f"  {name:<26} median={results[name]['median_ms']} мс  ops={results[name]['ops']}", flush=True)
+    if not args.keep_data:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Микробенчмарки функций работы с данными')
+    parser.add_argument('--sizes', default='1000,100000,1000000', help='Объемы заполнения через запятую')
+    parser.add_argument('--functions', help='Функции через запятую; по умолчанию все')
+    parser.add_argument('--min-rounds', type=int, default=5)
+    parser.add_argument('--max-rounds', type=int, default=100000)
+    parser.add_argument('--min-time', type=float, default=1.0, help='Минимальное время на функцию (секунды)')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--keep-data', action='store_true', help='Не удалять заполненные базы')
+    parser.add_argument('--output', help='Сохранить результат в JSON')
+    args = parser.parse_args(argv)
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    functions = args.functions.split(',') if args.functions else list(BENCHMARK_FUNCTIONS)
+    unknown = set(functions) - set(BENCHMARK_FUNCTIONS)
+    if unknown:
+        parser.error(f"неизвестные функции: {', '.join(sorted(unknown))}")
+
+    sys.path.insert(0, REPO_DIR)
+    import SITEBENZ as site
+    # EXPLAIN для медленных запросов исказил бы замеры
+    site.SLOW_QUERY_THRESHOLD = float('inf')
+
+    workdir = tempfile.mkdtemp(prefix='clan-data-')
+    try:
+        results = {size: run_size(site, size, functions, args, workdir) for size in sizes}
+    finally:
+        if not args.keep_data:
+            shutil.rmtree(workdir, ignore_errors=True)
+        else:
+            print(f"Базы сохранены в {workdir}")
+
+    print(f"\n{'функция':<26}" + ''.join(f"{f'{size:,}':>16}" for size in sizes) + "   (median, мс)")
+    for name in functions:
+        print(f"{name:<26}" + ''.join(f"{results[size][name]['median_ms']:>16}" for size in sizes))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'sizes': {str(size): value for size, value in results.items()}, 'seed': args.seed},
+                      f, ensure_ascii=False, indent=2)
+        print(f"\nРезультат сохранен в {args.output}")
+
+
+if __name__ == '__main__':
+    main()
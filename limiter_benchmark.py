@@ -0,0 +1,127 @@
+"""Сравнение алгоритмов ограничения скорости: скользящее окно по request_logs и GCRA в памяти
+
+Оба ограничителя получают одну и ту же последовательность запросов с
+адресов, распределенных по Ципфу (генератор из data_benchmark). Бюджет
+класса задается заведомо большим, чтобы измерялся учет разрешенных
+запросов, а не дешевый путь отказа. Для каждого алгоритма выводится время
+на проверку (настенное и процессорное) и занятая память: для окна -
+строки request_logs и размер базы, для GCRA - прирост памяти Python по
+tracemalloc.
+
+Пример:
+    python limiter_benchmark.py --keys 10000 --checks 50000 --output limiter-bench.json
+"""
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from data_benchmark import DataGenerator
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+LIMIT_CLASS = 'static'
+
+
+def run_checks(check, ips):
+    """Прогон последовательности; (настенное время, процессорное время, отклонено)"""
+    rejected = 0
+    wall_started = time.perf_counter()
+    cpu_started = time.process_time()
+    for ip in ips:
+        if not check(ip)[0]:
+            rejected += 1
+    return time.perf_counter() - wall_started, time.process_time() - cpu_started, rejected
+
+
+def database_size(path):
+    with sqlite3.connect(path) as conn:
+        page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+        page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+        rows = conn.execute('SELECT COUNT(*) FROM request_logs').fetchone()[0]
+    return page_count * page_size, rows
+
+
+def summary(name, checks, wall, cpu, rejected, memory_bytes, state):
+    return {
+        'algorithm': name,
+        'checks': checks,
+        'rejected': rejected,
+        'wall_us_per_check': round(wall / checks * 1e6, 2),
+        'cpu_us_per_check': round(cpu / checks * 1e6, 2),
+        'checks_per_second': round(checks / wall, 1),
+        'memory_bytes': memory_bytes,
+        'state': state
+    }
+
+
+def benchmark(site, ips):
+    results = []
+
+    # Скользящее окно: строка request_logs на запрос, подсчет по индексу
+    wall, cpu, rejected = run_checks(lambda ip: site.check_visit_limit(ip, '/', LIMIT_CLASS, 1), ips)
+    size, rows = database_size(site.ddos_protection_db)
+    results.append(summary('window', len(ips), wall, cpu, rejected, size, {'request_logs_rows': rows}))
+
+    # GCRA: одно число на ключ в словаре
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    wall, cpu, rejected = run_checks(lambda ip: site.check_rate_gcra(ip, LIMIT_CLASS, 1), ips)
+    memory = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    results.append(summary('gcra', len(ips), wall, cpu, rejected, memory, {'keys': site.gcra_limiter.count()}))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Сравнение скользящего окна и GCRA')
+    parser.add_argument('--keys', type=int, default=10000, help='Число различных клиентских адресов')
+    parser.add_argument('--checks', type=int, default=50000, help='Число проверок на алгоритм')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--keep-data', action='store_true', help='Не удалять базу скользящего окна')
+    parser.add_argument('--output', help='Сохранить результат в JSON')
+    args = parser.parse_args(argv)
+
+    generator = DataGenerator(args.keys * 20, args.seed)
+    ips = [generator.ip() for _ in range(args.checks)]
+
+    sys.path.insert(0, REPO_DIR)
+    import SITEBENZ as site
+    site.SLOW_QUERY_THRESHOLD = float('inf')
+
+    workdir = tempfile.mkdtemp(prefix='clan-limiter-')
+    try:
+        site.DATABASE_NAME = os.path.join(workdir, 'clan_benz.db')
+        site.visits_db = os.path.join(workdir, 'visits.db')
+        site.ddos_protection_db = os.path.join(workdir, 'ddos_protection.db')
+        site.init_databases()
+        # Бюджет, всплеск и DDoS-лимит, которые последовательность не исчерпает
+        site.RATE_LIMIT_CLASSES[LIMIT_CLASS] = args.checks * 100
+        site.RATE_LIMIT_BURST[LIMIT_CLASS] = args.checks * 100
+        site.REQUEST_LIMIT = args.checks * 100
+        results = benchmark(site, ips)
+    finally:
+        if not args.keep_data:
+            shutil.rmtree(workdir, ignore_errors=True)
+        else:
+            print(f"База сохранена в {workdir}")
+
+    print(f"Проверок: {args.checks:,}, различных адресов: {len(set(ips)):,}\n")
+    print(f"{'алгоритм':<10} {'мкс/проверка':>13} {'CPU мкс':>9} {'проверок/с':>12} {'память, байт':>14}  состояние")
+    for result in results:
+        print(f"{result['algorithm']:<10} {result['wall_us_per_check']:>13} {result['cpu_us_per_check']:>9} "
+              f"{result['checks_per_second']:>12,} {result['memory_bytes']:>14,}  {result['state']}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'keys': args.keys, 'checks': args.checks, 'seed': args.seed, 'results': results},
+                      f, ensure_ascii=False, indent=2)
+        print(f"\nРезультат сохранен в {args.output}")
+
+
+if __name__ == '__main__':
+    main()
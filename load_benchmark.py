@@ -0,0 +1,308 @@
+"""Нагрузочный бенчмарк маршрутов сайта
+
+Сервер запускается отдельным процессом во временном каталоге с чистыми
+базами данных. Клиенты ходят к нему с адресов 127.x.y.z (на Linux вся сеть
+127.0.0.0/8 - loopback), поэтому ограничения по IP срабатывают так же, как
+на реальном трафике от многих посетителей.
+
+Пример:
+    python load_benchmark.py --duration 30 --clients 32 --ips 2000 --output bench.json
+    python load_benchmark.py --mix "/=5,/statistics=1,/submit_application=1" --baseline bench.json
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import urlencode
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Сервер в отдельном процессе, чтобы клиенты не делили с ним GIL
+SERVER_BOOTSTRAP = """
+import os, sys
+os.chdir(sys.argv[1])
+sys.path.insert(0, sys.argv[2])
+import SITEBENZ as site
+site.SERVER_PORT = int(sys.argv[3])
+# Без ограничения "одна заявка в час" каждая отправка проходит до сохранения в базу, а не отклоняется сразу
+site.APPLICATION_INTERVAL = 0
+site.setup_logging()
+site.init_databases()
+if site.ACCESS_LOG_ENABLED:
+    site.access_log.start()
+site.run_server()
+"""
+
+# На сервере, запущенном отдельно (--url), действует его ограничение заявок (одна с IP в час):
+# повторные /submit_application с того же адреса измеряют путь отказа с ответом 400
+DEFAULT_MIX = {
+    '/': 30,
+    '/zayavka': 10,
+    '/gallery-images': 15,
+    '/statistics': 10,
+    '/rate-limit-status': 5,
+    '/submit_application': 5,
+    '/admin/api/stats': 5,
+    '/admin/api/applications': 3,
+    '/admin/api/manual-blocks': 2
+}
+
+
+def application_form():
+    """Тело заявки, проходящее валидацию"""
+    return urlencode({
+        'nickname': f'bench{random.randrange(10 ** 6)}',
+        'steamId': str(76561198000000000 + random.randrange(10 ** 9)),
+        'playtime': str(random.randint(1500, 9000)),
+        'discord': 'bench#0001',
+        'role': 'Штурмовик',
+        'message': 'Нагрузочный тест'
+    }).encode('utf-8')
+
+
+def build_request(path, admin_cookie):
+    """Метод, тело и заголовки запроса к маршруту"""
+    headers = {'User-Agent': 'load-benchmark'}
+    if path == '/submit_application':
+        headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        return 'POST', application_form(), headers
+    if path.startswith('/admin/'):
+        headers['Cookie'] = admin_cookie
+    return 'GET', None, headers
+
+
+def client_ips(count):
+    """Адреса 127.1.0.1, 127.1.0.2, ... без .0 в последнем октете (127.0.0.1 не используется)"""
+    ips = []
+    i = 0
+    while len(ips) < count:
+        i += 1
+        if i & 255:
+            ips.append(f"127.{1 + (i >> 16)}.{(i >> 8) & 255}.{i & 255}")
+    return ips
+
+
+def check_source_addresses(ips):
+    """Можно ли отправлять запросы с этих адресов (на macOS loopback - только 127.0.0.1)"""
+    try:
+        with socket.socket() as s:
+            s.bind((ips[-1], 0))
+        return ips
+    except OSError:
+        print(f"Адреса {ips[-1]} нет в системе, все клиенты идут с одного IP", file=sys.stderr)
+        return [None]
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
+
+
+class RouteStats:
+    """Задержки и статусы ответов одного маршрута"""
+
+    def __init__(self):
+        self.latencies = []
+        self.statuses = {}
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def add(self, latency, status):
+        with self.lock:
+            self.latencies.append(latency)
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    def add_error(self):
+        with self.lock:
+            self.errors += 1
+
+    def summary(self, duration):
+        values = sorted(self.latencies)
+        return {
+            'requests': len(values),
+            'rps': round(len(values) / duration, 1),
+            'errors': self.errors,
+            'statuses': {str(status): count for status, count in sorted(self.statuses.items())},
+            'p50_ms': round(percentile(values, 50) * 1000, 3),
+            'p95_ms': round(percentile(values, 95) * 1000, 3),
+            'p99_ms': round(percentile(values, 99) * 1000, 3),
+            'max_ms': round(values[-1] * 1000, 3) if values else 0.0
+        }
+
+
+def start_server(port):
+    """Запуск сервера во временном каталоге, возвращает процесс после готовности порта"""
+    workdir = tempfile.mkdtemp(prefix='clan-bench-')
+    process = subprocess.Popen([sys.executable, '-c', SERVER_BOOTSTRAP, workdir, REPO_DIR, str(port)],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Сервер завершился с кодом {process.returncode}, журнал в {workdir}")
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return process, workdir
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("Сервер не начал принимать соединения за 15 секунд")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def admin_login(host, port, password):
+    connection = http.client.HTTPConnection(host, port, timeout=10)
+    connection.request('POST', '/admin/api/login', body=json.dumps({'password': password}),
+                       headers={'Content-Type': 'application/json'})
+    response = connection.getresponse()
+    response.read()
+    cookie = response.getheader('Set-Cookie', '')
+    connection.close()
+    return cookie.split(';')[0]
+
+
+def run_load(host, port, mix, duration, clients, ips, admin_cookie, timeout):
+    """Нагрузка: clients потоков до истечения duration, запросы со случайных IP пула"""
+    paths = list(mix)
+    weights = [mix[path] for path in paths]
+    stats = {path: RouteStats() for path in paths}
+    deadline = time.monotonic() + duration
+
+    def worker():
+        rng = random.Random()
+        while time.monotonic() < deadline:
+            path = rng.choices(paths, weights)[0]
+            source = rng.choice(ips)
+            method, body, headers = build_request(path, admin_cookie)
+            start = time.perf_counter()
+            try:
+                connection = http.client.HTTPConnection(
+                    host, port, timeout=timeout, source_address=(source, 0) if source else None)
+                connection.request(method, path, body=body, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                stats[path].add(time.perf_counter() - start, response.status)
+                connection.close()
+            except (OSError, http.client.HTTPException):
+                stats[path].add_error()
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(clients)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    routes = {path: route_stats.summary(elapsed) for path, route_stats in stats.items()}
+    total = RouteStats()
+    for route_stats in stats.values():
+        total.latencies.extend(route_stats.latencies)
+        total.errors += route_stats.errors
+        for status, count in route_stats.statuses.items():
+            total.statuses[status] = total.statuses.get(status, 0) + count
+    return {'duration': round(elapsed, 2), 'total': total.summary(elapsed), 'routes': routes}
+
+
+def compare_with_baseline(result, baseline, tolerance):
+    """Регрессии относительно сохраненного результата: рост p95 или падение пропускной способности"""
+    regressions = []
+    for path, current in result['routes'].items():
+        previous = baseline.get('routes', {}).get(path)
+        if not previous or not previous['requests'] or not current['requests']:
+            continue
+        if current['p95_ms'] > previous['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{path}: p95 {previous['p95_ms']} -> {current['p95_ms']} мс")
+        if current['rps'] < previous['rps'] * (1 - tolerance):
+            regressions.append(f"{path}: {previous['rps']} -> {current['rps']} запросов/с")
+    return regressions
+
+
+def parse_mix(text):
+    """Смесь вида "/=5,/statistics=1" (вес по умолчанию 1)"""
+    mix = {}
+    for part in text.split(','):
+        path, _, weight = part.strip().partition('=')
+        if path:
+            mix[path] = float(weight) if weight else 1.0
+    return mix
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Нагрузочный бенчмарк маршрутов сайта')
+    parser.add_argument('--duration', type=float, default=20, help='Длительность нагрузки (секунды)')
+    parser.add_argument('--clients', type=int, default=16, help='Число параллельных клиентов')
+    parser.add_argument('--ips', type=int, default=1000, help='Размер пула клиентских IP')
+    parser.add_argument('--mix', help='Смесь маршрутов "/=5,/statistics=1"; по умолчанию все маршруты')
+    parser.add_argument('--url', help='Нагружать уже запущенный сервер host:port вместо временного')
+    parser.add_argument('--password', default='admin123', help='Пароль админки для маршрутов /admin/api')
+    parser.add_argument('--timeout', type=float, default=10, help='Таймаут одного запроса')
+    parser.add_argument('--output', help='Сохранить результат в JSON')
+    parser.add_argument('--baseline', help='Сравнить с сохраненным результатом')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Допустимое ухудшение (доля)')
+    parser.add_argument('--keep-data', action='store_true', help='Не удалять каталог с базами временного сервера')
+    args = parser.parse_args(argv)
+
+    mix = parse_mix(args.mix) if args.mix else DEFAULT_MIX
+    process = None
+    if args.url:
+        host, _, port = args.url.rpartition(':')
+        port = int(port)
+    else:
+        host, port = '127.0.0.1', free_port()
+        process, workdir = start_server(port)
+        print(f"Сервер запущен на порту {port}, данные в {workdir}")
+
+    try:
+        ips = check_source_addresses(client_ips(args.ips))
+        admin_cookie = admin_login(host, port, args.password)
+        result = run_load(host, port, mix, args.duration, args.clients, ips, admin_cookie, args.timeout)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+            if not args.keep_data:
+                shutil.rmtree(workdir, ignore_errors=True)
+
+    result['config'] = {'clients': args.clients, 'ips': len(ips), 'mix': mix, 'target': args.url or 'local'}
+
+    total = result['total']
+    print(f"\nВсего: {total['requests']:,} запросов за {result['duration']} с, {total['rps']} запросов/с, "
+          f"ошибок соединения: {total['errors']}")
+    print(f"Задержка: p50={total['p50_ms']} p95={total['p95_ms']} p99={total['p99_ms']} мс")
+    print(f"\n{'маршрут':<28} {'n':>8} {'rps':>8} {'p50':>9} {'p95':>9} {'p99':>9}  статусы")
+    for path, summary in result['routes'].items():
+        print(f"{path:<28} {summary['requests']:>8,} {summary['rps']:>8} {summary['p50_ms']:>9} "
+              f"{summary['p95_ms']:>9} {summary['p99_ms']:>9}  {summary['statuses']}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"\nРезультат сохранен в {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            regressions = compare_with_baseline(result, json.load(f), args.tolerance)
+        if regressions:
+            print("\nРегрессии относительно базового результата:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print("\nРегрессий относительно базового результата нет")
+
+
+if __name__ == '__main__':
+    main()
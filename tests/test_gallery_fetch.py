@@ -0,0 +1,135 @@
+"""Тесты загрузчика галереи против локального HTTP-сервера вместо внешнего хостинга
+
+Запуск:
+    python -m unittest discover tests
+"""
+import io
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import SITEBENZ  # noqa: E402
+
+MAX_IMAGE_SIZE = 64 * 1024
+FETCH_TIMEOUT = 0.5
+
+
+def make_png(size):
+    """PNG заданного размера (при наличии Pillow) или минимальный PNG 1x1"""
+    if SITEBENZ.Image is None:
+        return (b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x01\x00\x00\x00\x01\x08\x06\x00\x00\x00\x1f'
+                b'\x15\xc4\x89\x00\x00\x00\rIDATx\x9cc\xf8\xff\xff?\x00\x05\xfe\x02\xfe\xa7\x35\x81\x84\x00'
+                b'\x00\x00\x00IEND\xaeB`\x82')
+    buffer = io.BytesIO()
+    SITEBENZ.Image.new('RGB', size, (200, 40, 40)).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+IMAGE = make_png((1600, 1200))
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Заглушка хостинга изображений: ответ выбирается по пути"""
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        if self.path.startswith('/slow'):
+            time.sleep(FETCH_TIMEOUT * 4)
+        if self.path.startswith('/page'):
+            self._send(b'<html><body>Not found</body></html>', 'text/html; charset=utf-8')
+        elif self.path.startswith('/huge'):
+            self._send(b'\0' * (MAX_IMAGE_SIZE * 2), 'image/png')
+        else:
+            self._send(IMAGE, 'image/png')
+
+    def _send(self, body, content_type):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except OSError:
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+class GalleryFetchTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        cls.server.requests = []
+        cls.base_url = f'http://127.0.0.1:{cls.server.server_address[1]}'
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp(prefix='gallery-test-')
+        self.addCleanup(shutil.rmtree, self.cache_dir, ignore_errors=True)
+        for name, value in (('GALLERY_CACHE_DIR', self.cache_dir), ('GALLERY_MAX_IMAGE_SIZE', MAX_IMAGE_SIZE),
+                            ('GALLERY_FETCH_TIMEOUT', FETCH_TIMEOUT)):
+            patcher = mock.patch.object(SITEBENZ, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        SITEBENZ.gallery_fetch_failures.clear()
+        self.server.requests.clear()
+
+    def assert_not_cached(self, url):
+        with self.assertLogs(SITEBENZ.logger, 'ERROR'):
+            self.assertIsNone(SITEBENZ.fetch_gallery_image(url))
+        self.assertEqual(os.listdir(self.cache_dir), [])
+        self.assertIn(url, SITEBENZ.gallery_fetch_failures)
+
+    def test_fetches_once_into_cache(self):
+        url = f'{self.base_url}/ok/photo.png'
+        path = SITEBENZ.fetch_gallery_image(url)
+        self.assertEqual(path, SITEBENZ.get_gallery_cache_path(url))
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), IMAGE)
+
+        self.assertEqual(SITEBENZ.fetch_gallery_image(url), path)
+        self.assertEqual(self.server.requests, ['/ok/photo.png'])
+
+    @unittest.skipIf(SITEBENZ.Image is None, 'Pillow не установлен')
+    def test_thumbnail_is_downscaled(self):
+        url = f'{self.base_url}/ok/thumb.png'
+        thumb_path = SITEBENZ.make_gallery_thumbnail(url)
+        self.assertEqual(thumb_path, SITEBENZ.get_gallery_cache_path(url, thumb=True))
+        with SITEBENZ.Image.open(thumb_path) as image:
+            self.assertEqual(image.format, 'PNG')
+            self.assertLessEqual(image.width, SITEBENZ.GALLERY_THUMB_SIZE[0])
+            self.assertLessEqual(image.height, SITEBENZ.GALLERY_THUMB_SIZE[1])
+
+    def test_non_image_response_is_rejected(self):
+        self.assert_not_cached(f'{self.base_url}/page/photo.png')
+
+    def test_oversized_response_is_rejected(self):
+        self.assert_not_cached(f'{self.base_url}/huge/photo.png')
+
+    def test_timeout(self):
+        self.assert_not_cached(f'{self.base_url}/slow/photo.png')
+
+    def test_failed_source_is_not_requested_again(self):
+        url = f'{self.base_url}/page/retry.png'
+        self.assert_not_cached(url)
+        self.assertIsNone(SITEBENZ.fetch_gallery_image(url))
+        self.assertEqual(self.server.requests, ['/page/retry.png'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+"""Тесты ограничителя GCRA: всплеск, восполнение, отказ без расхода и очистка ключей
+
+Запуск:
+    python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from SITEBENZ import GcraLimiter  # noqa: E402
+
+KEY = ('203.0.113.0/24', 'static')
+RATE = 60  # единица стоимости в секунду
+BURST = 5
+
+
+class FakeClock:
+    """Часы, которые двигает тест"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class GcraLimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.limiter = GcraLimiter(clock=self.clock)
+
+    def test_burst_allowed_without_waiting(self):
+        for _ in range(BURST):
+            self.assertEqual(self.limiter.check(KEY, RATE, BURST, 1), (True, 0.0))
+        allowed, retry_after = self.limiter.check(KEY, RATE, BURST, 1)
+        self.assertFalse(allowed)
+        self.assertAlmostEqual(retry_after, 1.0)
+
+    def test_cost_spends_several_units(self):
+        self.assertTrue(self.limiter.check(KEY, RATE, BURST, 4)[0])
+        self.assertAlmostEqual(self.limiter.remaining(KEY, RATE, BURST), 1.0)
+        self.assertFalse(self.limiter.check(KEY, RATE, BURST, 2)[0])
+        self.assertTrue(self.limiter.check(KEY, RATE, BURST, 1)[0])
+
+    def test_refill_over_time(self):
+        for _ in range(BURST):
+            self.limiter.check(KEY, RATE, BURST, 1)
+        self.assertAlmostEqual(self.limiter.remaining(KEY, RATE, BURST), 0.0)
+
+        self.clock.advance(2)
+        self.assertAlmostEqual(self.limiter.remaining(KEY, RATE, BURST), 2.0)
+        self.assertTrue(self.limiter.check(KEY, RATE, BURST, 2)[0])
+        self.assertFalse(self.limiter.check(KEY, RATE, BURST, 1)[0])
+
+        # Ведро не наполняется больше всплеска
+        self.clock.advance(60)
+        self.assertAlmostEqual(self.limiter.remaining(KEY, RATE, BURST), BURST)
+
+    def test_rejection_does_not_consume(self):
+        for _ in range(BURST):
+            self.limiter.check(KEY, RATE, BURST, 1)
+        tat = self.limiter.tat[KEY]
+        for _ in range(10):
+            self.assertFalse(self.limiter.check(KEY, RATE, BURST, 1)[0])
+        self.assertEqual(self.limiter.tat[KEY], tat)
+
+        # После ожидания одного интервала отказы не отодвинули разрешение
+        self.clock.advance(1)
+        self.assertTrue(self.limiter.check(KEY, RATE, BURST, 1)[0])
+
+    def test_keys_are_independent(self):
+        for _ in range(BURST):
+            self.limiter.check(KEY, RATE, BURST, 1)
+        self.assertFalse(self.limiter.check(KEY, RATE, BURST, 1)[0])
+        self.assertTrue(self.limiter.check(('203.0.113.0/24', 'api'), RATE, BURST, 1)[0])
+
+    def test_remaining_for_unknown_key(self):
+        self.assertEqual(self.limiter.remaining(KEY, RATE, BURST), BURST)
+
+    def test_sweep_removes_only_full_buckets(self):
+        other = ('198.51.100.0/24', 'static')
+        self.limiter.check(KEY, RATE, BURST, 1)
+        self.limiter.check(other, RATE, BURST, 3)
+        self.assertEqual(self.limiter.count(), 2)
+
+        self.clock.advance(1)
+        self.assertEqual(self.limiter.sweep(), 1)
+        self.assertNotIn(KEY, self.limiter.tat)
+        self.assertIn(other, self.limiter.tat)
+
+        self.clock.advance(2)
+        self.assertEqual(self.limiter.sweep(), 1)
+        self.assertEqual(self.limiter.count(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()